@@ -6,8 +6,10 @@ Represents the entrypoint for command line tools.
 import argparse
 import os
 import json
+import sys
 
-from dug.config import Config
+from dug.config import Config, TRANQL_SOURCE
+from dug.core import kg_store
 from dug.core import Dug, logger, DugFactory
 
 
@@ -74,6 +76,62 @@ def get_argparser():
         action="store_true"
     )
 
+    crawl_parser.add_argument(
+        "--annotation-concurrency",
+        help="[Optional] Number of elements to annotate concurrently (default: serial)",
+        dest="annotation_concurrency",
+        type=int,
+        default=None
+    )
+
+    crawl_parser.add_argument(
+        "--annotation-batch-size",
+        help="[Optional] Number of element descriptions sent per call to annotators that support batches",
+        dest="annotation_batch_size",
+        type=int,
+        default=None
+    )
+
+    crawl_parser.add_argument(
+        "--expansion-concurrency",
+        help="[Optional] Number of TranQL queries to keep in flight while expanding concepts (default: serial)",
+        dest="expansion_concurrency",
+        type=int,
+        default=None
+    )
+
+    crawl_parser.add_argument(
+        "--chunk-size",
+        help="[Optional] Stream the crawl, annotating and indexing this many elements at a time",
+        dest="chunk_size",
+        type=int,
+        default=None
+    )
+
+    crawl_parser.add_argument(
+        "--workers",
+        help="[Optional] Number of processes crawling targets in parallel (default: serial)",
+        dest="workers",
+        type=int,
+        default=None
+    )
+
+    crawl_parser.add_argument(
+        "--incremental",
+        help="[Optional] Skip files unchanged since their last crawl and only annotate new or changed elements",
+        dest="incremental",
+        default=False,
+        action="store_true"
+    )
+
+    crawl_parser.add_argument(
+        "--engine",
+        help="[Optional] Crawl engine: sync (threads) or async (asyncio, pooled connections)",
+        dest="crawler_engine",
+        choices=["sync", "async"],
+        default=None
+    )
+
     # Search subcommand
     search_parser = subparsers.add_parser('search', help='Apply semantic search')
     search_parser.set_defaults(func=search)
@@ -100,6 +158,34 @@ def get_argparser():
         help="Optional keyword arguments that will be passed into the search target",
     )
 
+    # Migrate crawlspace subcommand
+    migrate_parser = subparsers.add_parser(
+        'migrate-crawlspace', help='Move TranQL answer files of a crawlspace into the KG answer store')
+    migrate_parser.set_defaults(func=migrate_crawlspace)
+
+    migrate_parser.add_argument(
+        'crawlspace',
+        type=str,
+        help='Crawlspace directory holding <curie>_<query>.json files',
+        nargs='?',
+        default='crawl'
+    )
+
+    migrate_parser.add_argument(
+        '--store',
+        help='[Optional] KG answer store to migrate into (default: KG_STORE_PATH)',
+        dest='store_path',
+        default=None
+    )
+
+    migrate_parser.add_argument(
+        '--remove',
+        help='[Optional] Delete answer files once they are in the store',
+        dest='remove',
+        default=False,
+        action='store_true'
+    )
+
     # Status subcommand
     # TODO implement this
     # status_parser = subparsers.add_parser('status', help='Check status of dug server')
@@ -113,9 +199,36 @@ def crawl(args):
     if not args.extract_dug_elements:
         # disable extraction
         config.node_to_element_queries = {}
+    if args.annotation_concurrency is not None:
+        config.annotation_concurrency = args.annotation_concurrency
+    if args.annotation_batch_size is not None:
+        config.annotation_batch_size = args.annotation_batch_size
+    if args.expansion_concurrency is not None:
+        config.expansion_concurrency = args.expansion_concurrency
+    if args.chunk_size is not None:
+        config.crawl_chunk_size = args.chunk_size
+    if args.workers is not None:
+        config.crawl_workers = args.workers
+    if args.incremental:
+        config.crawl_incremental = True
+    if args.crawler_engine is not None:
+        config.crawler_engine = args.crawler_engine
     factory = DugFactory(config)
     dug = Dug(factory)
-    dug.crawl(args.target, args.parser_type, args.annotator_type, args.element_type)
+    failed = dug.crawl(args.target, args.parser_type, args.annotator_type, args.element_type)
+    if failed:
+        sys.exit(1)
+
+
+def migrate_crawlspace(args):
+    config = Config.from_env()
+    store = kg_store.KGAnswerStore(args.store_path or config.kg_store_path)
+    try:
+        migrated = kg_store.migrate_crawlspace(args.crawlspace, store, config.tranql_queries,
+                                               TRANQL_SOURCE, remove=args.remove)
+    finally:
+        store.close()
+    print(f"Migrated {migrated} TranQL answers to {store.path}")
 
 
 def search(args):
@@ -28,8 +28,92 @@ class Config:
     nboost_port: int = 8000
 
     studies_path: str=""
+    # Seconds between checks of studies_path for changes
+    studies_reload_interval: int = 30
 
-    
+    # Number of elements the crawler annotates concurrently (1 == serial)
+    annotation_concurrency: int = 1
+
+    # Number of element descriptions sent to batch-capable annotators (e.g. sapbert) per call
+    # (1 == one element per call)
+    annotation_batch_size: int = 1
+
+    # Number of elements the crawler annotates, expands and indexes at a time (0 == the whole
+    # file at once). Parsers still read a whole file before the first chunk is annotated
+    crawl_chunk_size: int = 0
+
+    # Number of TranQL queries the crawler keeps in flight (1 == serial)
+    expansion_concurrency: int = 1
+
+    # SQLite file caching TranQL responses between crawls
+    # (empty == one JSON file per identifier and query in the crawlspace)
+    kg_store_path: str = "crawl/kg_answers.db"
+
+    # Cache of annotator results by description text, kept between crawls: "sqlite" (LRU file
+    # of at most annotation_cache_size entries), "redis" or "" for no cache. Either way
+    # entries expire after annotation_cache_ttl seconds (0 == never)
+    annotation_cache_backend: str = ""
+    annotation_cache_path: str = "crawl/annotations.db"
+    annotation_cache_size: int = 500000
+    annotation_cache_ttl: int = 30 * 24 * 60 * 60
+
+    # Skip files that haven't changed since they were last crawled, and only annotate and
+    # index the new or changed elements of files that have, using the manifest SQLite file
+    crawl_incremental: bool = False
+    crawl_manifest_path: str = "crawl/manifest.db"
+
+    # Counts of the texts that failed to annotate and identifiers that failed to normalize,
+    # kept per crawl run and shared by its worker processes through the crawl_failures_path
+    # SQLite file (empty == kept in the memory of each process, so workers' counts are
+    # missed) and written out as one JSON report per crawl (empty crawl_failure_report ==
+    # only logged)
+    crawl_failures_path: str = "crawl/failures.db"
+    crawl_failure_report: str = "crawl/failures.json"
+
+    # Number of processes crawling targets in parallel (1 == serial)
+    crawl_workers: int = 1
+
+    # Crawl engine: "sync" (requests, threads) or "async" (asyncio, one pooled httpx client).
+    # The async engine annotates up to async_element_concurrency elements at once, keeps at most
+    # async_service_limits requests in flight per service and times requests out after
+    # async_http_timeout seconds
+    crawler_engine: str = "sync"
+    async_element_concurrency: int = 100
+    async_http_timeout: int = 60
+    async_service_limits: dict = field(
+        default_factory=lambda: {
+            "annotator": 20,
+            "classifier": 20,
+            "normalizer": 10,
+            "synonyms": 10,
+            "bagel": 4,
+            "tranql": 10,
+        }
+    )
+
+    # Number of documents sent per elasticsearch _bulk request
+    elastic_bulk_chunk_size: int = 500
+
+
+    # Search API elasticsearch client: connections kept per node, seconds before a
+    # request times out, retries (including on timeouts) and node sniffing for
+    # multi-node clusters
+    elastic_connections_per_node: int = 25
+    elastic_request_timeout: int = 30
+    elastic_max_retries: int = 3
+    elastic_retry_on_timeout: bool = True
+    elastic_sniff: bool = False
+
+    # Most hits a single search request may return
+    search_max_page_size: int = 10000
+
+    # Search API result cache: seconds results are kept (0 == off), in-process entries,
+    # whether to share results between replicas through redis, and seconds between
+    # checks for a new index generation
+    search_cache_ttl: int = 300
+    search_cache_size: int = 1024
+    search_cache_redis: bool = False
+    search_cache_generation_interval: int = 30
 
     # Preprocessor config that will be passed to annotate.Preprocessor constructor
     preprocessor: dict = field(
@@ -49,6 +133,7 @@ class Config:
                 "classification_url": "https://med-nemo.apps.renci.org/annotate/",
                 "annotator_url": "https://sap-qdrant.apps.renci.org/annotate/",
                 "score_threshold": 0.8,
+                "term_concurrency": 8,
                 "bagel": {
                     "enabled": False,
                     "url": "https://bagel.apps.renci.org/group_synonyms_openai",
@@ -128,6 +213,7 @@ class Config:
         default_factory=lambda: {
             "url": "https://tranql-dev.renci.org/tranql/query?dynamic_id_resolution=true&asynchronous=false",
             "min_tranql_score": 0.0,
+            "timeout": 60,
         }
     )
 
@@ -156,7 +242,36 @@ class Config:
             "redis_host": "REDIS_HOST",
             "redis_port": "REDIS_PORT",
             "redis_password": "REDIS_PASSWORD",
-            "studies_path": "STUDIES_PATH"
+            "studies_path": "STUDIES_PATH",
+            "studies_reload_interval": "STUDIES_RELOAD_INTERVAL",
+            "annotation_concurrency": "ANNOTATION_CONCURRENCY",
+            "annotation_batch_size": "ANNOTATION_BATCH_SIZE",
+            "crawl_chunk_size": "CRAWL_CHUNK_SIZE",
+            "elastic_bulk_chunk_size": "ELASTIC_BULK_CHUNK_SIZE",
+            "crawl_workers": "CRAWL_WORKERS",
+            "crawl_incremental": "CRAWL_INCREMENTAL",
+            "annotation_cache_backend": "ANNOTATION_CACHE_BACKEND",
+            "annotation_cache_path": "ANNOTATION_CACHE_PATH",
+            "annotation_cache_size": "ANNOTATION_CACHE_SIZE",
+            "annotation_cache_ttl": "ANNOTATION_CACHE_TTL",
+            "crawl_manifest_path": "CRAWL_MANIFEST_PATH",
+            "crawl_failures_path": "CRAWL_FAILURES_PATH",
+            "crawl_failure_report": "CRAWL_FAILURE_REPORT",
+            "crawler_engine": "CRAWLER_ENGINE",
+            "async_element_concurrency": "ASYNC_ELEMENT_CONCURRENCY",
+            "async_http_timeout": "ASYNC_HTTP_TIMEOUT",
+            "expansion_concurrency": "EXPANSION_CONCURRENCY",
+            "kg_store_path": "KG_STORE_PATH",
+            "search_max_page_size": "SEARCH_MAX_PAGE_SIZE",
+            "search_cache_ttl": "SEARCH_CACHE_TTL",
+            "search_cache_size": "SEARCH_CACHE_SIZE",
+            "search_cache_redis": "SEARCH_CACHE_REDIS",
+            "search_cache_generation_interval": "SEARCH_CACHE_GENERATION_INTERVAL",
+            "elastic_connections_per_node": "ELASTIC_CONNECTIONS_PER_NODE",
+            "elastic_request_timeout": "ELASTIC_REQUEST_TIMEOUT",
+            "elastic_max_retries": "ELASTIC_MAX_RETRIES",
+            "elastic_retry_on_timeout": "ELASTIC_RETRY_ON_TIMEOUT",
+            "elastic_sniff": "ELASTIC_SNIFF",
         }
 
         kwargs = {}
@@ -165,6 +280,17 @@ class Config:
             env_value = os.environ.get(env_var)
             if env_value:
                 kwargs[kwarg] = env_value
-                if kwarg in ['redis_port', 'elastic_port']:
+                if kwarg in ['redis_port', 'elastic_port', 'annotation_concurrency', 'annotation_batch_size',
+                             'crawl_chunk_size', 'elastic_bulk_chunk_size',
+                             'crawl_workers', 'expansion_concurrency',
+                             'search_max_page_size', 'search_cache_ttl', 'search_cache_size',
+                             'search_cache_generation_interval', 'studies_reload_interval',
+                             'elastic_connections_per_node', 'elastic_request_timeout',
+                             'elastic_max_retries', 'async_element_concurrency',
+                             'async_http_timeout', 'annotation_cache_size',
+                             'annotation_cache_ttl']:
                     kwargs[kwarg] = int(env_value)
+                if kwarg in ['search_cache_redis', 'elastic_retry_on_timeout', 'elastic_sniff',
+                             'crawl_incremental']:
+                    kwargs[kwarg] = env_value.lower() in ['1', 'true', 'yes']
         return cls(**kwargs)
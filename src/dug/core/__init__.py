@@ -1,10 +1,13 @@
 import asyncio
 import logging
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import os
 import sys
+import uuid
 from functools import partial
 from pathlib import Path
-from typing import Iterable
+from typing import Iterable, NamedTuple
 
 import pluggy
 from dug.core.loaders.filesystem_loader import load_from_filesystem
@@ -13,9 +16,11 @@ from dug.core.loaders.network_loader import load_from_network
 from dug import hookspecs
 from dug.core import parsers
 from dug.core import annotators
+from dug.core.crawl_manifest import CrawlManifest, IncrementalParser
 from dug.core.factory import DugFactory
 from dug.core.parsers import DugConcept, Parser, get_parser
-from dug.core.annotators import DugIdentifier, Annotator, get_annotator
+from dug.core.annotators import DugIdentifier, Annotator, CachedAnnotator, get_annotator, get_failure_sink
+from dug.core.annotators.failure_sink import ANNOTATION, NORMALIZATION
 
 logger = logging.getLogger('dug')
 stdout_log_handler = logging.StreamHandler(sys.stdout)
@@ -43,10 +48,20 @@ def get_targets(target_name) -> Iterable[Path]:
     return loader(target_name)
 
 
+class IncrementalCrawl(NamedTuple):
+    manifest: CrawlManifest
+    source: str
+    content_hash: str
+    crawl_key: str
+    parser: IncrementalParser
+
+
 class Dug:
     concepts_index = "concepts_index"
     variables_index = "variables_index"
     kg_index = "kg_index"
+    studies_index = "studies_index"
+    programs_index = "programs_index"
 
     def __init__(self, factory: DugFactory):
         self._factory = factory
@@ -55,43 +70,215 @@ class Dug:
         ])
         self._index = self._factory.build_indexer_obj(
             indices=[
-                self.concepts_index, self.variables_index, self.kg_index
+                self.concepts_index, self.variables_index, self.kg_index,
+                self.studies_index, self.programs_index
             ]
         )
 
     def crawl(self, target_name: str, parser_type: str, annotator_type: str, element_type: str = None):
+        """
+        Crawl and index every target found at target_name. With crawl_workers > 1 the targets
+        are spread over a process pool and a failing target doesn't stop the others; the
+        list of targets that failed is returned.
+        """
+        targets = list(get_targets(target_name))
+        workers = self._factory.config.crawl_workers
+        # Failure counts are kept under a run id, so crawls sharing crawl_failures_path don't mix
+        crawl_id = uuid.uuid4().hex
+        failures = get_failure_sink(self._factory.config.crawl_failures_path)
+        failures.start_crawl(crawl_id)
+        if workers > 1 and len(targets) > 1:
+            failed = self._crawl_in_pool(targets, parser_type, annotator_type, element_type, workers, crawl_id)
+        else:
+            pm = get_plugin_manager()
+            parser = get_parser(pm.hook, parser_type)
+            annotator = get_annotator(pm.hook, annotator_type, self._factory.config)
+
+            for target in targets:
+                self._crawl(target, parser, annotator, element_type)
+            failed = []
+            if isinstance(annotator, CachedAnnotator):
+                annotator.log_stats()
+        self._report_failures(failures)
+        failures.discard()
+
+        if self._factory.config.crawl_incremental and not failed:
+            collection_ids = self._forget_removed_targets(target_name, targets)
+            if collection_ids:
+                self._index.update_summaries(collection_ids,
+                                             variables_index=self.variables_index,
+                                             studies_index=self.studies_index,
+                                             programs_index=self.programs_index)
+
+        # Summaries of indices built before them only cover the studies crawled since, so
+        # summarize everything once before search is told to trust them
+        if not self._index.summaries_complete(self.studies_index, self.programs_index):
+            self._index.rebuild_summaries(self.variables_index, self.studies_index, self.programs_index)
+
+        # Let search caches know the indices have changed
+        self._index.update_generation()
+        return failed
 
-        pm = get_plugin_manager()
-        parser = get_parser(pm.hook, parser_type)
-        annotator = get_annotator(pm.hook, annotator_type, self._factory.config)
-        targets = get_targets(target_name)
+    def _report_failures(self, failures):
+        report_path = self._factory.config.crawl_failure_report
+        if report_path:
+            report = failures.write_report(report_path)
+        else:
+            failures.flush()
+            report = {kind: {"total": sum(counter.values()), "distinct": len(counter)}
+                      for kind, counter in failures.counts().items()}
+        annotation, normalization = report[ANNOTATION], report[NORMALIZATION]
+        logger.info(f"{annotation['total']} texts failed to annotate ({annotation['distinct']} distinct), "
+                    f"{normalization['total']} identifiers failed to normalize ({normalization['distinct']} distinct)"
+                    + (f"; see {report_path}" if report_path else ""))
 
-        for target in targets:
-            self._crawl(target, parser, annotator, element_type)
+    def _crawl_in_pool(self, targets, parser_type, annotator_type, element_type, workers, crawl_id=""):
+        failed = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(_crawl_target, self._factory.config, target,
+                                parser_type, annotator_type, element_type, crawl_id): target
+                for target in targets
+            }
+            for completed, future in enumerate(as_completed(futures), start=1):
+                try:
+                    target, error = future.result()
+                except Exception as e:
+                    # A worker that died (BrokenProcessPool) fails every target still pending
+                    target, error = futures[future], f"{type(e).__name__}: {e}"
+                if error is None:
+                    logger.info(f"Crawled {target} ({completed}/{len(targets)})")
+                else:
+                    failed.append(target)
+                    logger.error(f"Failed to crawl {target} ({completed}/{len(targets)}): {error}")
+        if failed:
+            logger.error(f"{len(failed)} of {len(targets)} targets failed to crawl")
+        return failed
 
     def _crawl(self, target: Path, parser: Parser, annotator: Annotator, element_type):
 
+        incremental = None
+        if self._factory.config.crawl_incremental:
+            incremental = self._start_incremental_crawl(target, parser, annotator, element_type)
+            if incremental is None:
+                return
+            parser = incremental.parser
+
         # Initialize crawler
         crawler = self._factory.build_crawler(target, parser, annotator, element_type)
-        # Read elements, annotate, and expand using tranql queries
-        crawler.crawl()
-
-        # Index Annotated Elements
-        for element in crawler.elements:
-            # Only index DugElements as concepts will be indexed differently in next step
-            if not isinstance(element, DugConcept):
-                self._index.index_element(element, index=self.variables_index)
-
-        # Index Annotated/TranQLized Concepts and associated knowledge graphs
-        for concept_id, concept in crawler.concepts.items():
-            self._index.index_concept(concept, index=self.concepts_index)
-
-            # Index knowledge graph answers for each concept
-            for kg_answer_id, kg_answer in concept.kg_answers.items():
-                self._index.index_kg_answer(concept_id=concept_id,
-                                             kg_answer=kg_answer,
-                                             index=self.kg_index,
-                                             id_suffix=kg_answer_id)
+        # Studies whose summaries need rebuilding once their variables are indexed
+        collection_ids = set()
+
+        # Ids of concepts and knowledge graph answers that failed to index
+        failed = []
+        chunk_size = self._factory.config.crawl_chunk_size
+        if chunk_size > 0:
+            # Stream elements through annotation and indexing a chunk at a time
+            for elements, concepts in crawler.crawl_chunks(chunk_size):
+                collection_ids.update(self._index_elements(elements, parser))
+                failed += self._index.bulk_index_kg_answers(concepts, index=self.kg_index)
+
+            # Concepts are indexed last, once every element has contributed to them
+            failed += self._index.bulk_index_concepts(crawler.concepts.values(), index=self.concepts_index)
+        else:
+            # Read elements, annotate, and expand using tranql queries
+            crawler.crawl()
+
+            # Index Annotated Elements
+            collection_ids.update(self._index_elements(crawler.elements, parser))
+
+            # Index Annotated/TranQLized Concepts and associated knowledge graphs
+            failed += self._index.bulk_index_concepts(crawler.concepts.values(), index=self.concepts_index)
+            failed += self._index.bulk_index_kg_answers(crawler.concepts.values(), index=self.kg_index)
+
+        if incremental is not None:
+            if failed:
+                # Concepts aren't tied to the elements they came from, so every changed
+                # element is annotated and indexed again by the next crawl
+                incremental.parser.record_failures(incremental.parser.changed_ids)
+            collection_ids.update(self._finish_incremental_crawl(incremental))
+
+        self._index.update_summaries(collection_ids,
+                                     variables_index=self.variables_index,
+                                     studies_index=self.studies_index,
+                                     programs_index=self.programs_index)
+
+    def _start_incremental_crawl(self, target, parser, annotator, element_type):
+        """
+        Compare target with what the manifest recorded for its last crawl. Returns None if the
+        file and crawl settings are unchanged, so the file can be skipped, otherwise an
+        IncrementalCrawl whose parser only passes on new and changed elements.
+        """
+        manifest = self._factory.build_crawl_manifest()
+        source = manifest.source_key(target)
+        content_hash = manifest.hash_file(target)
+        crawl_key = manifest.crawl_key(parser, annotator, element_type, self._factory.config)
+
+        last_crawl = manifest.get_file(source)
+        if last_crawl == (content_hash, crawl_key):
+            logger.info(f"Skipping {target}, unchanged since its last crawl")
+            return None
+
+        previous = manifest.get_elements(source)
+        if last_crawl is not None and last_crawl[1] != crawl_key:
+            # Crawl settings changed, so every element is annotated again
+            previous = {doc_id: element._replace(fingerprint=None) for doc_id, element in previous.items()}
+        return IncrementalCrawl(manifest, source, content_hash, crawl_key, IncrementalParser(parser, previous))
+
+    def _finish_incremental_crawl(self, incremental):
+        """ Delete elements the file no longer has and record the crawl, returning affected collection ids """
+        parser = incremental.parser
+        removed = parser.removed()
+        if removed:
+            parser.record_failures(
+                self._index.bulk_delete([element.doc_id for element in removed], index=self.variables_index))
+        logger.info(f"Incremental crawl of {incremental.source}: {len(parser.changed_ids)} new or changed, "
+                    f"{parser.unchanged} unchanged and {len(removed)} removed elements")
+        content_hash = incremental.content_hash
+        if parser.failed_ids:
+            # Recorded without its content hash so the file isn't skipped next time
+            logger.warning(f"{len(parser.failed_ids)} elements of {incremental.source} failed to index or "
+                           f"delete and will be retried by its next crawl")
+            content_hash = ""
+        incremental.manifest.record(incremental.source, content_hash, incremental.crawl_key,
+                                    parser.manifest_elements())
+        return {element.collection_id for element in removed}
+
+    def _forget_removed_targets(self, target_name, targets):
+        """
+        Delete the elements of files under a crawled directory that are gone since their last
+        crawl, returning affected collection ids
+        """
+        if not os.path.isdir(target_name):
+            return set()
+        manifest = self._factory.build_crawl_manifest()
+        directory = os.path.join(manifest.source_key(target_name), "")
+        crawled = {manifest.source_key(target) for target in targets}
+        collection_ids = set()
+        for source in manifest.sources():
+            if not source.startswith(directory) or source in crawled:
+                continue
+            elements = manifest.get_elements(source).values()
+            logger.info(f"{source} was removed, deleting its {len(elements)} elements")
+            self._index.bulk_delete([element.doc_id for element in elements], index=self.variables_index)
+            collection_ids.update(element.collection_id for element in elements)
+            manifest.forget(source)
+        return collection_ids
+
+    def _index_elements(self, elements, parser=None):
+        """ Index elements, returning the collection ids they belong to """
+        # Only index DugElements as concepts will be indexed differently
+        elements = [element for element in elements if not isinstance(element, DugConcept)]
+        if isinstance(parser, IncrementalParser):
+            parser.record_annotations(elements)
+            # Elements that changed since the last crawl replace their old documents
+            replaced = [element for element in elements if element.get_id() in parser.modified_ids]
+            parser.record_failures(self._index.bulk_replace_elements(replaced, index=self.variables_index))
+            elements = [element for element in elements if element.get_id() not in parser.modified_ids]
+            parser.record_failures(self._index.bulk_index_elements(elements, index=self.variables_index))
+            return {element.collection_id for element in replaced + elements}
+        self._index.bulk_index_elements(elements, index=self.variables_index)
+        return {element.collection_id for element in elements}
 
     def search(self, target, query, **kwargs):
         event_loop = asyncio.get_event_loop()
@@ -113,3 +300,44 @@ class Dug:
 
     def status(self):
         ...
+
+
+# Dug instance of a crawl worker process, built on its first target
+_worker_dug = None
+
+# Parsers and annotators of a crawl worker process by type, built on the first target that uses them
+_worker_parsers = {}
+_worker_annotators = {}
+
+
+def _crawl_target(config, target, parser_type, annotator_type, element_type, crawl_id=""):
+    """
+    Crawl one target in a worker process. Each worker keeps its own elasticsearch clients,
+    parser and annotator (with its in-process CURIE caches and annotation cache connection)
+    for all of its targets; normalizer and synonym responses are still shared between workers
+    through the redis HTTP cache. Errors are returned rather than raised so one bad file
+    doesn't take down the rest of the crawl.
+    """
+    global _worker_dug
+    # Count this target's failures under the run id of the crawl it belongs to
+    failures = get_failure_sink(config.crawl_failures_path)
+    failures.start_crawl(crawl_id)
+    try:
+        if _worker_dug is None:
+            _worker_dug = Dug(DugFactory(config))
+        if parser_type not in _worker_parsers:
+            _worker_parsers[parser_type] = get_parser(get_plugin_manager().hook, parser_type)
+        if annotator_type not in _worker_annotators:
+            _worker_annotators[annotator_type] = get_annotator(get_plugin_manager().hook, annotator_type, config)
+        parser = _worker_parsers[parser_type]
+        annotator = _worker_annotators[annotator_type]
+        _worker_dug._crawl(target, parser, annotator, element_type)
+        if isinstance(annotator, CachedAnnotator):
+            annotator.log_stats()
+    except Exception as e:
+        logger.debug(traceback.format_exc())
+        return target, f"{type(e).__name__}: {e}"
+    finally:
+        # Hand this target's failure counts to the crawl's report
+        failures.flush()
+    return target, None
@@ -5,6 +5,8 @@ import pluggy
 
 from dug.config import Config
 from dug.core.annotators._base import DugIdentifier, Indexable, Annotator, DefaultNormalizer, DefaultSynonymFinder
+from dug.core.annotators.annotation_cache import CachedAnnotator, build_cached_annotator
+from dug.core.annotators.failure_sink import FailureSink, get_failure_sink
 from dug.core.annotators.monarch_annotator import AnnotateMonarch
 from dug.core.annotators.sapbert_annotator import AnnotateSapbert
 
@@ -30,7 +32,7 @@ def get_annotator(hook, annotator_name, config: Config) -> Annotator:
     annotator = available_annotators.get(annotator_name.lower())
     if annotator is not None:
         logger.info(f'Annotating with {annotator}')
-        return annotator
+        return build_cached_annotator(annotator, annotator_name.lower(), config)
 
     err_msg = f"Cannot find annotator of type '{annotator_name}'\n" \
               f"Supported annotators: {', '.join(available_annotators.keys())}"
@@ -43,6 +45,7 @@ def build_monarch_annotator(annotate_type: str, config: Config):
         normalizer=DefaultNormalizer(**config.normalizer),
         synonym_finder=DefaultSynonymFinder(**config.synonym_service),
         config=config,
+        failure_sink=get_failure_sink(config.crawl_failures_path),
         **config.annotator_args[annotate_type]
     )
     return annotator
@@ -52,6 +55,7 @@ def build_sapbert_annotator(annotate_type, config: Config):
     annotator = AnnotateSapbert(
         normalizer=DefaultNormalizer(**config.normalizer),
         synonym_finder=DefaultSynonymFinder(**config.synonym_service),
+        failure_sink=get_failure_sink(config.crawl_failures_path),
         **config.annotator_args[annotate_type]
     )
     return annotator
@@ -1,12 +1,15 @@
+import asyncio
 import json
 import logging
 import re
 import logging
 import urllib.parse
-from typing import Union, Callable, Any, Iterable, TypeVar, Generic, List, Optional
+from typing import Union, Callable, Any, Iterable, TypeVar, Generic, List, Optional, Dict
 from dug import utils as utils
+from dug.core.annotators.utils.curie_cache import CurieCache
 from requests import Session
 import bmt
+import httpx
 from retrying import retry
 
 logger = logging.getLogger("dug")
@@ -109,26 +112,106 @@ class DefaultNormalizer():
     separate plugin like annotator.
     """
 
-    def __init__(self, url):
+    def __init__(self, url, batch_size=100, cache_size=10000):
         self.bl_toolkit = bmt.Toolkit()
         self.url = url
+        # Max number of CURIEs sent to the normalization service in one request
+        self.batch_size = batch_size
+        # Normalization service results by CURIE, shared by every element this normalizer sees
+        self.cache = CurieCache(maxsize=cache_size)
 
     def __call__(self, identifier: DugIdentifier, http_session: Session) -> DugIdentifier:
         # Use RENCI's normalization API service to get the preferred version of an identifier
         logger.debug(f"Normalizing: {identifier.id}")
-        response = self.make_request(identifier, http_session)
-        result = self.handle_response(identifier, response)
-        return result
+        return self.normalize_batch([identifier], http_session)[0]
+
+    def normalize_batch(
+        self, identifiers: List[DugIdentifier], http_session: Session
+    ) -> List[Optional[DugIdentifier]]:
+        """Normalize many identifiers using multi-CURIE requests.
+
+        CURIEs already in the cache are not requested again. The remaining distinct
+        CURIEs are sent `batch_size` at a time and the results are fanned back out
+        to the identifiers. Returns one entry per input identifier, in order, with
+        None for identifiers that did not normalize.
+        """
+        normalized, uncached = self._split_cached(identifier.id for identifier in identifiers)
+
+        logger.debug(f"Normalizing {len(uncached)} curies in batches of {self.batch_size}")
+        for batch in self._batches(uncached):
+            self._record_batch(batch, self.make_batch_request(batch, http_session), normalized)
+        return self._handle_normalized(identifiers, normalized)
+
+    async def normalize_batch_async(
+        self, identifiers: List[DugIdentifier], http
+    ) -> List[Optional[DugIdentifier]]:
+        """normalize_batch, requesting the batches concurrently through an AsyncServicePool"""
+        normalized, uncached = self._split_cached(identifier.id for identifier in identifiers)
+
+        batches = list(self._batches(uncached))
+        responses = await asyncio.gather(*(self.make_batch_request_async(batch, http) for batch in batches))
+        for batch, response in zip(batches, responses):
+            self._record_batch(batch, response, normalized)
+        return self._handle_normalized(identifiers, normalized)
+
+    def _split_cached(self, curies: Iterable[str]):
+        normalized = {}
+        uncached = []
+        for curie in dict.fromkeys(curies):
+            cached = self.cache.get(curie)
+            if cached is CurieCache.MISSING:
+                uncached.append(curie)
+            else:
+                normalized[curie] = cached
+        return normalized, uncached
+
+    def _batches(self, curies: List[str]):
+        for start in range(0, len(curies), self.batch_size):
+            yield curies[start:start + self.batch_size]
+
+    def _record_batch(self, batch: List[str], response: dict, normalized: dict):
+        for curie in batch:
+            # Only cache curies the service answered for (including a null answer)
+            if curie in response:
+                self.cache.put(curie, response[curie])
+                normalized[curie] = response[curie]
+
+    def _handle_normalized(self, identifiers: List[DugIdentifier], normalized: dict):
+        # handle_response builds new values from the (unmodified) cached normalization, but it
+        # rewrites identifiers in place, so handle each object only once
+        results = {}
+        for identifier in identifiers:
+            if id(identifier) not in results:
+                results[id(identifier)] = self.handle_response(identifier, normalized)
+        return [results[id(identifier)] for identifier in identifiers]
 
     def make_request(self, value: DugIdentifier, http_session: Session) -> dict:
-        curie = value.id
-        url = f"{self.url}{urllib.parse.quote(curie)}"
+        return self.make_batch_request([value.id], http_session)
+
+    def batch_url(self, curies: List[str]) -> str:
+        return f"{self.url}" + "&curie=".join(urllib.parse.quote(curie) for curie in curies)
+
+    def make_batch_request(self, curies: List[str], http_session: Session) -> dict:
+        url = self.batch_url(curies)
         try:
             response = http_session.get(url)
         except Exception as get_exc:
-            logger.info(f"Error normalizing {value} at {url}")
+            logger.info(f"Error normalizing {', '.join(curies)} at {url}")
+            logger.error(f"Error {get_exc.__class__.__name__}: {get_exc}")
+            return {}
+        return self.parse_batch_response(response)
+
+    async def make_batch_request_async(self, curies: List[str], http) -> dict:
+        url = self.batch_url(curies)
+        try:
+            response = await http.get("normalizer", url)
+        except Exception as get_exc:
+            logger.info(f"Error normalizing {', '.join(curies)} at {url}")
             logger.error(f"Error {get_exc.__class__.__name__}: {get_exc}")
             return {}
+        return self.parse_batch_response(response)
+
+    def parse_batch_response(self, response) -> dict:
         try:
             normalized = response.json()
         except Exception as json_exc:
@@ -186,8 +269,12 @@ class DefaultSynonymFinder():
     \n When there is another supported SynonymFinder it will be seperated into a separate plugin like annotator.
     """
 
-    def __init__(self, url: str):
+    def __init__(self, url: str, batch_size=100, cache_size=10000):
         self.url = url
+        # Max number of CURIEs sent to the reverse lookup endpoint in one request
+        self.batch_size = batch_size
+        # Synonyms by CURIE, shared by every element this synonym finder sees
+        self.cache = CurieCache(maxsize=cache_size)
 
     # def get_identifier_synonyms
     def __call__(self, curie: str, http_session):
@@ -195,18 +282,65 @@ class DefaultSynonymFinder():
         This function uses the NCATS translator service to return a list of synonyms for
         curie id
         """
-        response = self.make_request(curie, http_session)
-        result = self.handle_response(curie, response)
-        return result
+        return self.find_synonyms_batch([curie], http_session)[curie]
+
+    def find_synonyms_batch(self, curies: List[str], http_session: Session) -> Dict[str, List[str]]:
+        """
+        Return synonyms for many curies, keyed by curie. Cached curies are not
+        requested again; the rest are posted `batch_size` distinct curies per
+        reverse lookup request.
+        """
+        synonyms, uncached = self._split_cached(curies)
+
+        for batch in self._batches(uncached):
+            response = self.make_batch_request(batch, http_session)
+            for curie in batch:
+                synonyms[curie] = self.handle_response(curie, response)
+        return synonyms
+
+    async def find_synonyms_batch_async(self, curies: List[str], http) -> Dict[str, List[str]]:
+        """find_synonyms_batch, posting the batches concurrently through an AsyncServicePool"""
+        synonyms, uncached = self._split_cached(curies)
+
+        batches = list(self._batches(uncached))
+        responses = await asyncio.gather(*(self.make_batch_request_async(batch, http) for batch in batches))
+        for batch, response in zip(batches, responses):
+            for curie in batch:
+                synonyms[curie] = self.handle_response(curie, response)
+        return synonyms
+
+    def _split_cached(self, curies: Iterable[str]):
+        synonyms = {}
+        uncached = []
+        for curie in dict.fromkeys(curies):
+            cached = self.cache.get(curie)
+            if cached is CurieCache.MISSING:
+                uncached.append(curie)
+            else:
+                synonyms[curie] = list(cached)
+        return synonyms, uncached
+
+    def _batches(self, curies: List[str]):
+        for start in range(0, len(curies), self.batch_size):
+            yield curies[start:start + self.batch_size]
 
     @retry(stop_max_attempt_number=3)
     def make_request(self, curie: str, http_session: Session):
         # Get response from namelookup reverse lookup op
         # example (https://name-resolution-sri.renci.org/docs#/lookup/lookup_names_reverse_lookup_post)
-        url = f"{self.url}"
-        payload = {"curies": [curie]}
+        response = http_session.post(f"{self.url}", json={"curies": [curie]})
+        return self.handle_request_response(curie, response)
+
+    async def make_request_async(self, curie: str, http):
+        try:
+            response = await http.post("synonyms", f"{self.url}", json={"curies": [curie]})
+        except httpx.HTTPError as e:
+            logger.error(f"No synonyms returned for: `{curie}`. Request to {self.url} failed: {e}")
+            return {curie: {"names": []}}
+        return self.handle_request_response(curie, response)
+
+    def handle_request_response(self, curie: str, response) -> dict:
         try:
-            response = http_session.post(url, json=payload)
             if str(response.status_code).startswith("4"):
                 logger.error(
                     f"No synonyms returned for: `{curie}`. Validation error: {response.text}"
@@ -217,13 +351,75 @@ class DefaultSynonymFinder():
                     f"No synonyms returned for: `{curie}`. Internal server error from {self.url}. Error: {response.text}"
                 )
                 return {curie: {"names": []}}
-            return response.json()
+            raw_synonyms = response.json()
+            self.cache_response([curie], raw_synonyms)
+            return raw_synonyms
         except json.decoder.JSONDecodeError as e:
             logger.error(
-                f"Json parse error for response from `{url}`. Exception: {str(e)}"
+                f"Json parse error for response from `{self.url}`. Exception: {str(e)}"
             )
             return {curie: {"names": []}}
 
+    def make_batch_request(self, curies: List[str], http_session: Session) -> dict:
+        # A single bad curie fails the whole batch, so on any error status fall back to one
+        # request per curie, which applies the usual per-curie 4xx/5xx handling
+        if len(curies) == 1:
+            return self.make_request(curies[0], http_session)
+        response = self.post_batch(curies, http_session)
+        raw_synonyms = self.handle_batch_response(curies, response)
+        if raw_synonyms is not None:
+            return raw_synonyms
+        raw_synonyms = {}
+        for curie in curies:
+            raw_synonyms.update(self.make_request(curie, http_session))
+        return raw_synonyms
+
+    @retry(stop_max_attempt_number=3)
+    def post_batch(self, curies: List[str], http_session: Session):
+        # Retried on its own, so single curie lookups keep make_request's 3 attempts
+        return http_session.post(f"{self.url}", json={"curies": curies})
+
+    async def make_batch_request_async(self, curies: List[str], http) -> dict:
+        if len(curies) == 1:
+            return await self.make_request_async(curies[0], http)
+        try:
+            response = await http.post("synonyms", f"{self.url}", json={"curies": curies})
+        except httpx.HTTPError as e:
+            logger.warning(f"Batch synonym lookup of {len(curies)} curies failed: {e}. "
+                           f"Retrying one curie at a time.")
+            response = None
+        raw_synonyms = self.handle_batch_response(curies, response) if response is not None else None
+        if raw_synonyms is not None:
+            return raw_synonyms
+        raw_synonyms = {}
+        for single in await asyncio.gather(*(self.make_request_async(curie, http) for curie in curies)):
+            raw_synonyms.update(single)
+        return raw_synonyms
+
+    def handle_batch_response(self, curies: List[str], response) -> Optional[dict]:
+        """Synonyms of a batch response, or None if the curies should be looked up one at a time"""
+        try:
+            if response.status_code // 100 in (4, 5):
+                logger.warning(
+                    f"Batch synonym lookup of {len(curies)} curies failed (HTTP {response.status_code}). "
+                    f"Retrying one curie at a time."
+                )
+                return None
+            raw_synonyms = response.json()
+            self.cache_response(curies, raw_synonyms)
+            return raw_synonyms
+        except json.decoder.JSONDecodeError as e:
+            logger.warning(
+                f"Json parse error for batch response from `{self.url}`. Exception: {str(e)}. "
+                f"Retrying one curie at a time."
+            )
+            return None
+
+    def cache_response(self, curies: List[str], raw_synonyms: dict):
+        # Only successful lookups are cached; error fallbacks are retried next time
+        for curie in curies:
+            self.cache.put(curie, list(self.handle_response(curie, raw_synonyms)))
+
     def handle_response(self, curie: str, raw_synonyms: List[dict]) -> List[str]:
         # Return curie synonyms
         return raw_synonyms.get(curie, {}).get('names', [])
@@ -0,0 +1,286 @@
+"""
+Persistent cache of annotator results by description text
+"""
+import copy
+import hashlib
+import inspect
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import List, Optional
+
+import redis
+
+from dug.config import Config
+from dug.core.annotators._base import DugIdentifier
+from dug.core.annotators.failure_sink import get_failure_sink
+
+logger = logging.getLogger('dug')
+
+
+class SQLiteAnnotationStore:
+    """
+    SQLite table of zlib-compressed annotation results. Like the redis store, entries expire
+    `ttl` seconds after they were stored (0 == never). Holds at most `maxsize` entries
+    (0 == unbounded); expired and then the least recently used entries are evicted every
+    `evict_every` writes.
+    """
+
+    def __init__(self, path, maxsize=500000, ttl=30 * 24 * 60 * 60, evict_every=1000):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.evict_every = evict_every
+        self._writes = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS annotations ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, last_used REAL NOT NULL, "
+                "created REAL NOT NULL DEFAULT 0) WITHOUT ROWID"
+            )
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(annotations)")]
+            if "created" not in columns:
+                # Caches written before entries expired are treated as expired
+                self._conn.execute("ALTER TABLE annotations ADD COLUMN created REAL NOT NULL DEFAULT 0")
+
+    def _expired_before(self) -> float:
+        return time.time() - self.ttl if self.ttl > 0 else float("-inf")
+
+    def get(self, key) -> Optional[list]:
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT value FROM annotations WHERE key=? AND created>=?",
+                                     (key, self._expired_before())).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE annotations SET last_used=? WHERE key=?", (time.time(), key))
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, key, value: list):
+        compressed = zlib.compress(json.dumps(value, separators=(",", ":")).encode("utf-8"))
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO annotations (key, value, last_used, created) VALUES (?, ?, ?, ?)",
+                (key, compressed, now, now))
+            self._writes += 1
+            if self._writes % self.evict_every == 0:
+                self._evict()
+
+    def _evict(self):
+        if self.ttl > 0:
+            self._conn.execute("DELETE FROM annotations WHERE created<?", (self._expired_before(),))
+        if self.maxsize <= 0:
+            return
+        count = self._conn.execute("SELECT COUNT(*) FROM annotations").fetchone()[0]
+        if count > self.maxsize:
+            self._conn.execute(
+                "DELETE FROM annotations WHERE key IN "
+                "(SELECT key FROM annotations ORDER BY last_used LIMIT ?)", (count - self.maxsize,))
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM annotations").fetchone()[0]
+
+
+class RedisAnnotationStore:
+    """ Annotation results in redis, expiring `ttl` seconds after they were stored (0 == never) """
+
+    def __init__(self, redis_client, ttl=30 * 24 * 60 * 60, key_prefix="dug:annotation"):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+
+    def get(self, key) -> Optional[list]:
+        cached = self.redis.get(f"{self.key_prefix}:{key}")
+        return json.loads(zlib.decompress(cached)) if cached is not None else None
+
+    def put(self, key, value: list):
+        compressed = zlib.compress(json.dumps(value, separators=(",", ":")).encode("utf-8"))
+        self.redis.set(f"{self.key_prefix}:{key}", compressed, ex=self.ttl or None)
+
+
+class CachedAnnotator:
+    """
+    Annotator wrapper that returns stored results for description texts annotated before,
+    with the same annotator settings, in this crawl or an earlier one.
+
+    Texts are keyed after the annotator's own preprocess_text (or whitespace normalization
+    for annotators without one) together with `fingerprint`, a hash of the annotator
+    settings, so a settings change starts a fresh set of entries. Empty results aren't
+    stored, so a text that found nothing, perhaps because a service was down, is annotated
+    again next time. Every call returns new DugIdentifier objects. annotate_batch and
+    annotate_async are offered when the wrapped annotator has them.
+
+    With a `failure_sink`, every text that annotates to nothing is recorded there as an
+    annotation failure, in place of the wrapped annotator's own record.
+    """
+
+    def __init__(self, annotator, store, fingerprint="", failure_sink=None):
+        self.annotator = annotator
+        self.store = store
+        self.fingerprint = fingerprint
+        self.failures = failure_sink
+        if failure_sink is not None and hasattr(annotator, "record_annotation_failures"):
+            annotator.record_annotation_failures = False
+        self._lock = threading.Lock()
+        self._texts_seen = set()
+        self.calls = 0
+        self.hits = 0
+        if hasattr(annotator, "annotate_batch"):
+            self.annotate_batch = self._annotate_batch
+        if inspect.iscoroutinefunction(getattr(annotator, "annotate_async", None)):
+            self.annotate_async = self._annotate_async
+
+    def __call__(self, text, http_session) -> List[DugIdentifier]:
+        key = self.key(text)
+        identifiers = self._lookup(key)
+        if identifiers is None:
+            identifiers = self.annotator(text, http_session)
+            self._store(key, identifiers)
+        self._record_failure(text, identifiers)
+        return identifiers
+
+    def _annotate_batch(self, texts: List[str], http_session) -> List[List[DugIdentifier]]:
+        results = [None] * len(texts)
+        # Distinct uncached keys, with the positions of the texts they answer
+        uncached = {}
+        for position, (text, key) in enumerate(zip(texts, self.keys(texts))):
+            cached = self._lookup(key)
+            if cached is not None:
+                results[position] = cached
+            else:
+                uncached.setdefault(key, (text, []))[1].append(position)
+
+        if uncached:
+            annotated = self.annotator.annotate_batch([text for text, _ in uncached.values()], http_session)
+            for (key, (_, positions)), identifiers in zip(uncached.items(), annotated):
+                self._store(key, identifiers)
+                results[positions[0]] = identifiers
+                for position in positions[1:]:
+                    results[position] = copy.deepcopy(identifiers)
+        for text, identifiers in zip(texts, results):
+            self._record_failure(text, identifiers)
+        return results
+
+    async def _annotate_async(self, text, http) -> List[DugIdentifier]:
+        key = self.key(text)
+        identifiers = self._lookup(key)
+        if identifiers is None:
+            identifiers = await self.annotator.annotate_async(text, http)
+            self._store(key, identifiers)
+        self._record_failure(text, identifiers)
+        return identifiers
+
+    def key(self, text) -> str:
+        preprocess = getattr(self.annotator, "preprocess_text", None)
+        text = preprocess(text) if preprocess is not None else " ".join(text.split())
+        return self._hash(text)
+
+    def keys(self, texts: List[str]) -> List[str]:
+        preprocess_batch = getattr(self.annotator, "preprocess_batch", None)
+        if preprocess_batch is None:
+            return [self.key(text) for text in texts]
+        return [self._hash(text) for text in preprocess_batch(texts)]
+
+    def _hash(self, text) -> str:
+        return hashlib.sha1(f"{self.fingerprint}\n{text}".encode("utf-8")).hexdigest()
+
+    def _lookup(self, key):
+        with self._lock:
+            self.calls += 1
+            self._texts_seen.add(key)
+        try:
+            cached = self.store.get(key)
+        except Exception as e:
+            logger.warning(f"Annotation cache lookup failed: {e}")
+            cached = None
+        if cached is None:
+            return None
+        with self._lock:
+            self.hits += 1
+        return self._to_identifiers(cached)
+
+    def _store(self, key, identifiers: List[DugIdentifier]):
+        if not identifiers:
+            return
+        try:
+            self.store.put(key, self._to_jsonable(identifiers))
+        except Exception as e:
+            logger.warning(f"Annotation cache store failed: {e}")
+
+    def _record_failure(self, text, identifiers: List[DugIdentifier]):
+        if not identifiers and self.failures is not None:
+            self.failures.record_annotation_failure(text)
+
+    @staticmethod
+    def _to_jsonable(identifiers: List[DugIdentifier]) -> list:
+        return [dict(identifier.jsonable()) for identifier in identifiers]
+
+    @staticmethod
+    def _to_identifiers(values: list) -> List[DugIdentifier]:
+        identifiers = []
+        for value in values:
+            identifier = DugIdentifier(value["id"], value["label"])
+            identifier.__dict__.update(value)
+            identifiers.append(identifier)
+        return identifiers
+
+    def stats(self) -> dict:
+        with self._lock:
+            distinct = len(self._texts_seen)
+            return {
+                "calls": self.calls,
+                "distinct_texts": distinct,
+                "dedupe_ratio": round(1 - distinct / self.calls, 4) if self.calls else 0.0,
+                "hits": self.hits,
+                "hit_ratio": round(self.hits / self.calls, 4) if self.calls else 0.0,
+                "annotated": self.calls - self.hits,
+            }
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.info(f"Annotation cache: {stats['calls']} descriptions, {stats['distinct_texts']} distinct "
+                    f"(dedupe ratio {stats['dedupe_ratio']:.1%}), {stats['hits']} served from cache "
+                    f"(hit ratio {stats['hit_ratio']:.1%}), {stats['annotated']} annotated")
+
+
+def annotator_fingerprint(annotator_name, config: Config) -> str:
+    """ Hash of the settings that can change what an annotator returns for a text """
+    settings = {
+        "annotator": annotator_name,
+        "annotator_args": config.annotator_args.get(annotator_name, {}),
+        "preprocessor": config.preprocessor,
+        "normalizer": config.normalizer,
+        "synonym_service": config.synonym_service,
+    }
+    return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def build_cached_annotator(annotator, annotator_name, config: Config):
+    """ Wrap annotator in a CachedAnnotator using the configured backend, if there is one """
+    backend = config.annotation_cache_backend
+    if not backend:
+        return annotator
+    if backend == "sqlite":
+        store = SQLiteAnnotationStore(config.annotation_cache_path,
+                                      maxsize=config.annotation_cache_size,
+                                      ttl=config.annotation_cache_ttl)
+    elif backend == "redis":
+        store = RedisAnnotationStore(redis.StrictRedis(host=config.redis_host,
+                                                       port=config.redis_port,
+                                                       password=config.redis_password),
+                                     ttl=config.annotation_cache_ttl)
+    else:
+        raise ValueError(f"Unknown annotation cache backend '{backend}', expected 'sqlite', 'redis' or ''")
+    return CachedAnnotator(annotator, store, fingerprint=annotator_fingerprint(annotator_name, config),
+                           failure_sink=get_failure_sink(config.crawl_failures_path))
@@ -0,0 +1,168 @@
+"""
+Counts of the texts that failed to annotate and the identifiers that failed to normalize
+during a crawl
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+logger = logging.getLogger('dug')
+
+ANNOTATION = "annotation"
+NORMALIZATION = "normalization"
+
+
+class FailureSink:
+    """
+    Failures are counted in memory per kind ("annotation" texts, "normalization" CURIEs) and
+    value, and flushed every `flush_every` records or `flush_interval` seconds, whichever
+    comes first. With a `path` they are flushed into a SQLite table that, like the crawl
+    manifest, is WAL-mode so the crawl worker processes can add to the same counts; without
+    one they are only kept in memory.
+
+    Counts are kept per crawl run: start_crawl switches the sink to a run id, which the
+    workers of a crawl are handed too, so crawls sharing the file don't mix or clear each
+    other's counts. write_report writes the counts of the current run as one JSON file and
+    discard drops them once reported.
+    """
+
+    def __init__(self, path=None, flush_every=1000, flush_interval=30, crawl_id=""):
+        self.path = path
+        self.crawl_id = crawl_id
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = Counter()
+        self._pending_records = 0
+        self._flushed_at = time.monotonic()
+        self._totals = Counter()
+        self._conn = None
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+            with self._conn:
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS crawl_failures ("
+                    "crawl_id TEXT NOT NULL, kind TEXT NOT NULL, value TEXT NOT NULL, count INTEGER NOT NULL, "
+                    "PRIMARY KEY (crawl_id, kind, value)) WITHOUT ROWID"
+                )
+
+    def start_crawl(self, crawl_id):
+        """ Count the failures recorded from now on under crawl_id """
+        if crawl_id == self.crawl_id:
+            return
+        self.flush()
+        with self._lock:
+            self.crawl_id = crawl_id
+            self._totals.clear()
+
+    def record(self, kind, value):
+        with self._lock:
+            self._pending[(kind, value)] += 1
+            self._pending_records += 1
+            due = (self._pending_records >= self.flush_every or
+                   time.monotonic() - self._flushed_at >= self.flush_interval)
+        if due:
+            self.flush()
+
+    def record_annotation_failure(self, text):
+        self.record(ANNOTATION, text)
+
+    def record_normalization_failure(self, curie):
+        self.record(NORMALIZATION, curie)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+            self._pending_records = 0
+            self._flushed_at = time.monotonic()
+            if not pending:
+                return
+            if self._conn is None:
+                self._totals.update(pending)
+                return
+            try:
+                with self._conn:
+                    self._conn.executemany(
+                        "INSERT INTO crawl_failures (crawl_id, kind, value, count) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT (crawl_id, kind, value) DO UPDATE SET count = count + excluded.count",
+                        [(self.crawl_id, kind, value, count) for (kind, value), count in pending.items()])
+            except sqlite3.Error as e:
+                logger.warning(f"Unable to record {sum(pending.values())} crawl failures: {e}")
+
+    def counts(self) -> Dict[str, Counter]:
+        """ Failure counts of the current crawl run by kind, then value, including those not flushed yet """
+        with self._lock:
+            if self._conn is None:
+                rows = list(self._totals.items())
+            else:
+                rows = [((kind, value), count) for kind, value, count in
+                        self._conn.execute("SELECT kind, value, count FROM crawl_failures WHERE crawl_id=?",
+                                           (self.crawl_id,))]
+            rows += list(self._pending.items())
+        counts = {ANNOTATION: Counter(), NORMALIZATION: Counter()}
+        for (kind, value), count in rows:
+            counts.setdefault(kind, Counter())[value] += count
+        return counts
+
+    def discard(self):
+        """ Drop the counts of the current crawl run """
+        with self._lock:
+            self._pending.clear()
+            self._pending_records = 0
+            self._totals.clear()
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute("DELETE FROM crawl_failures WHERE crawl_id=?", (self.crawl_id,))
+
+    def write_report(self, report_path) -> dict:
+        """ Write the failure counts, most frequent first, to report_path as JSON """
+        self.flush()
+        report = {"crawl_id": self.crawl_id, "generated_at": datetime.now(timezone.utc).isoformat()}
+        for kind, counter in self.counts().items():
+            report[kind] = {
+                "total": sum(counter.values()),
+                "distinct": len(counter),
+                "failures": [{"value": value, "count": count} for value, count in counter.most_common()],
+            }
+        directory = os.path.dirname(report_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        partial_path = f"{report_path}.partial"
+        with open(partial_path, "w") as stream:
+            json.dump(report, stream, indent=2)
+        os.replace(partial_path, report_path)
+        return report
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+# Sinks of this process by path, so every annotator of a crawl adds to the same counts
+_sinks: Dict[tuple, FailureSink] = {}
+_sinks_lock = threading.Lock()
+
+
+def get_failure_sink(path: Optional[str] = None) -> FailureSink:
+    """
+    The FailureSink of this process for path. Keyed by process id too, so a worker process
+    forked from a crawl opens its own connection rather than using its parent's.
+    """
+    key = (os.getpid(), path or None)
+    with _sinks_lock:
+        if key not in _sinks:
+            _sinks[key] = FailureSink(path)
+        return _sinks[key]
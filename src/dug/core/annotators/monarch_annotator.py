@@ -1,10 +1,16 @@
+import asyncio
+import bisect
 import logging
 import urllib.parse
 from typing import List
+
+import httpx
 from requests import Session
 
 from dug.core.annotators._base import DugIdentifier, Input
+from dug.core.annotators.failure_sink import FailureSink
 from dug.core.annotators.utils.biolink_purl_util import BioLinkPURLerizer
+from dug.core.annotators.utils.text_preprocessor import TextPreprocessor
 
 logger = logging.getLogger('dug')
 
@@ -21,6 +27,7 @@ class AnnotateMonarch:
             synonym_finder,
             config,
             ontology_greenlist=[],
+            failure_sink=None,
             **kwargs
     ):
 
@@ -28,8 +35,10 @@ class AnnotateMonarch:
         self.normalizer = normalizer
         self.synonym_finder = synonym_finder
         self.ontology_greenlist = ontology_greenlist
-        self.norm_fails_file = "norm_fails.txt"
-        self.anno_fails_file = "anno_fails.txt"
+        # Counts the texts that don't annotate and the identifiers that don't normalize
+        self.failures = failure_sink if failure_sink is not None else FailureSink()
+        # Off when a CachedAnnotator records the texts that annotate to nothing instead
+        self.record_annotation_failures = True
 
         debreviator = config.preprocessor['debreviator'] if 'debreviator' in config.preprocessor else None
         stopwords = config.preprocessor['stopwords'] if 'stopwords' in  config.preprocessor else None
@@ -41,6 +50,7 @@ class AnnotateMonarch:
         if stopwords is None:
             stopwords = []
         self.stopwords = stopwords
+        self.preprocessor = TextPreprocessor(self.decoder, self.stopwords)
 
     def __call__(self, text, http_session) -> List[DugIdentifier]:
         # Preprocess text (debraviate, remove stopwords, etc.)
@@ -49,22 +59,54 @@ class AnnotateMonarch:
         # Fetch identifiers
         raw_identifiers = self.annotate_text(text, http_session)
 
-        # Write out to file if text fails to annotate
-        if not raw_identifiers:
-            with open(self.anno_fails_file, "a") as fh:
-                fh.write(f'{text}\n')
+        # Record text that fails to annotate
+        if not raw_identifiers and self.record_annotation_failures:
+            self.failures.record_annotation_failure(text)
 
-        processed_identifiers = []
-        for identifier in raw_identifiers:
+        # Normalize all identifiers using batched requests to the normalization service
+        normalized_identifiers = self.normalizer.normalize_batch(raw_identifiers, http_session)
+        processed_identifiers = self.process_normalized(raw_identifiers, normalized_identifiers)
+
+        # Add synonyms to identifiers using batched reverse lookups
+        synonyms = self.synonym_finder.find_synonyms_batch(
+            [norm_id.id for norm_id in processed_identifiers], http_session
+        )
+        for norm_id in processed_identifiers:
+            norm_id.synonyms = list(synonyms[norm_id.id])
+
+        return processed_identifiers
 
-            # Normalize identifier using normalization service
-            norm_id = self.normalizer(identifier, http_session)
+    async def annotate_async(self, text, http) -> List[DugIdentifier]:
+        """
+        Same as calling the annotator, but every request is made through an AsyncServicePool
+        and the chunks of long texts are annotated concurrently
+        """
+        text = self.preprocess_text(text)
+
+        raw_identifiers = await self.annotate_text_async(text, http)
+
+        if not raw_identifiers and self.record_annotation_failures:
+            self.failures.record_annotation_failure(text)
+
+        normalized_identifiers = await self.normalizer.normalize_batch_async(raw_identifiers, http)
+        processed_identifiers = self.process_normalized(raw_identifiers, normalized_identifiers)
+
+        synonyms = await self.synonym_finder.find_synonyms_batch_async(
+            [norm_id.id for norm_id in processed_identifiers], http
+        )
+        for norm_id in processed_identifiers:
+            norm_id.synonyms = list(synonyms[norm_id.id])
+
+        return processed_identifiers
+
+    def process_normalized(self, raw_identifiers, normalized_identifiers) -> List[DugIdentifier]:
+        processed_identifiers = []
+        for identifier, norm_id in zip(raw_identifiers, normalized_identifiers):
 
             # Skip adding id if it doesn't normalize
             if norm_id is None:
-                # Write out to file if identifier doesn't normalize
-                with open(self.norm_fails_file, "a") as fh:
-                    fh.write(f'{identifier.id}\n')
+                # Record identifier that doesn't normalize
+                self.failures.record_normalization_failure(identifier.id)
 
                 # Discard non-normalized ident if not in greenlist
                 if identifier.id_type not in self.ontology_greenlist:
@@ -73,15 +115,11 @@ class AnnotateMonarch:
                 # If it is in greenlist just keep moving forward
                 norm_id = identifier
 
-            # Add synonyms to identifier
-            norm_id.synonyms = self.synonym_finder(norm_id.id, http_session)
-
             # Get pURL for ontology identifer for more info
             norm_id.purl = BioLinkPURLerizer.get_curie_purl(norm_id.id)
             processed_identifiers.append(norm_id)
-
         return processed_identifiers
-    
+
     def sliding_window(self, text, max_characters=2000, padding_words=5):
         """
         For long texts sliding window works as the following
@@ -91,24 +129,31 @@ class AnnotateMonarch:
         next subsequent yeilds "bbb ccc", "ccc ddd" , "ddd eeee"
         allowing context to be preserved with the scope of padding
         For a text of length 7653 , with max_characters 2000 and padding 5 , 4 chunks are yielded.
+
+        Windows are slices of text between precomputed word offsets, with each window's end
+        found by bisection, so long descriptions are windowed in linear time. A window always
+        holds at least one word and moves at least one word on, even when a word is longer
+        than max_characters, and the last window always runs to the end of the text. (The
+        original string-building version dropped the last words of a text whenever a window
+        shift landed one word short of the end.)
         """
-        words = text.split(' ')
-        total_words = len(words)
-        window_end = False
+        starts, ends = [], []
+        offset = 0
+        for word in text.split(' '):
+            starts.append(offset)
+            offset += len(word)
+            ends.append(offset)
+            offset += 1
+        total_words = len(ends)
         current_index = 0
-        while not window_end:
-            current_string = ""
-            for index, word in enumerate(words[current_index: ]):
-                if len(current_string) + len(word) + 1 >= max_characters:
-                    yield current_string + " "
-                    current_index += index - padding_words
-                    break
-                appendee = word if index == 0 else " " + word
-                current_string += appendee
-
-            if current_index + index == len(words) - 1:
-                window_end = True
-                yield current_string
+        while True:
+            # Number of words that fit in this window, i.e. the position of the first that doesn't
+            index = bisect.bisect_left(ends, starts[current_index] + max_characters, lo=current_index + 1) - current_index
+            if current_index + index == total_words:
+                yield text[starts[current_index]:]
+                return
+            yield text[starts[current_index]:ends[current_index + index - 1]] + " "
+            current_index += max(index - padding_words, 1)
 
     def annotate_text(self, text, http_session) -> List[DugIdentifier]:
         logger.debug(f"Annotating: {text}")
@@ -118,6 +163,15 @@ class AnnotateMonarch:
             identifiers += self.handle_response(chunk_text, response)
         return identifiers
 
+    async def annotate_text_async(self, text, http) -> List[DugIdentifier]:
+        logger.debug(f"Annotating: {text}")
+        chunks = list(self.sliding_window(text))
+        responses = await asyncio.gather(*(self.make_request_async(chunk_text, http) for chunk_text in chunks))
+        identifiers = []
+        for chunk_text, response in zip(chunks, responses):
+            identifiers += self.handle_response(chunk_text, response)
+        return identifiers
+
     def make_request(self, value: Input, http_session: Session):
         value = urllib.parse.quote(value)
         url = f'{self.annotatorUrl}{value}'
@@ -134,6 +188,20 @@ class AnnotateMonarch:
             raise RuntimeError(f"no response from {url}")
         return response.json()
 
+    async def make_request_async(self, value: Input, http):
+        url = f'{self.annotatorUrl}{urllib.parse.quote(value)}'
+        # The pool backs off and retries transport errors and retryable statuses; a chunk that
+        # still fails gets no spans rather than failing the whole file
+        try:
+            response = await http.get("annotator", url)
+        except httpx.HTTPError as e:
+            logger.warning(f"Annotation request failed with error: {str(e)} -- returning no annotations")
+            return {}
+        if response.status_code // 100 != 2:
+            logger.warning(f"Annotation request failed (HTTP {response.status_code}) -- returning no annotations")
+            return {}
+        return response.json()
+
     def handle_response(self, value, response: dict) -> List[DugIdentifier]:
         identifiers = []
         """ Parse each identifier and initialize identifier object """
@@ -154,7 +222,7 @@ class AnnotateMonarch:
     
     def preprocess_text(self, text: str) -> str:
         """
-        Apply debreviator to replace abbreviations and other characters
+        Apply debreviator to replace abbreviations and other characters, then remove stopwords
 
         # >>> pp = PreprocessorMonarch({"foo": "bar"}, ["baz"])
         # >>> pp.preprocess("Hello foo")
@@ -163,13 +231,10 @@ class AnnotateMonarch:
         # >>> pp.preprocess("Hello baz world")
         'Hello world'
         """
+        return self.preprocessor(text)
 
-        for key, value in self.decoder.items():
-            text = text.replace(key, value)
-
-        # Remove any stopwords
-        text = " ".join([word for word in text.split() if word not in self.stopwords])
-        return text
+    def preprocess_batch(self, texts: List[str]) -> List[str]:
+        return self.preprocessor.process_batch(texts)
 
     @staticmethod
     def default_debreviator_factory():
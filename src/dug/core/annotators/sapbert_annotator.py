@@ -1,9 +1,14 @@
+import asyncio
 import logging
-from typing import List, Dict
+from typing import List, Dict, Optional
+
+import httpx
 from requests import Session, RequestException
 from retrying import retry
 import time
+from concurrent.futures import ThreadPoolExecutor
 from dug.core.annotators._base import DugIdentifier, Input
+from dug.core.annotators.failure_sink import FailureSink
 from dug.core.annotators.utils.biolink_purl_util import BioLinkPURLerizer
 from functools import reduce
 
@@ -25,28 +30,35 @@ class BagelWrapper:
         result = self.handle_response(ids, response)
         return result
 
+    async def call_async(self, description_text, entity, ids: List[DugIdentifier], http):
+        if not ids:
+            return self.handle_response(ids, [])
+        response = await http.post("bagel", self.url, json=self.make_payload(description_text, entity, ids))
+        return self.handle_response(ids, response.json())
+
     def make_request(self, description_text, entity, ids: List[DugIdentifier], http_session: Session):
-        url = self.url
         if ids:
-            payload = {
-                "prompt_name": self.prompt_name,
-                "context": {
-                    "text": description_text,
-                    "entity": entity,
-                    "synonyms": [{
-                        "label": i.label,
-                        "identifier": i.id,
-                        "description": i.description,
-                        "entity_type": i.types.split(':')[-1],
-                        "color-code": "red"
-                    } for i in ids]
-                },
-                "config": self.llm_args
-            }
-            return http_session.post(self.url, json=payload).json()
+            return http_session.post(self.url, json=self.make_payload(description_text, entity, ids)).json()
 
         return []
 
+    def make_payload(self, description_text, entity, ids: List[DugIdentifier]) -> dict:
+        return {
+            "prompt_name": self.prompt_name,
+            "context": {
+                "text": description_text,
+                "entity": entity,
+                "synonyms": [{
+                    "label": i.label,
+                    "identifier": i.id,
+                    "description": i.description,
+                    "entity_type": i.types.split(':')[-1],
+                    "color-code": "red"
+                } for i in ids]
+            },
+            "config": self.llm_args
+        }
+
     def handle_response(self, ids: List[DugIdentifier], bagel_json_result: dict):
         selected_ids = [x['identifier'] for x in bagel_json_result]
         return list(filter(lambda x: x.id in selected_ids, ids))
@@ -57,11 +69,14 @@ class AnnotateSapbert:
     Use the RENCI Sapbert API service to fetch ontology IDs found in text
     """
 
+    RETRYABLE_STATUS_CODES = {500, 502, 503, 504, 429}
+
     def __init__(
         self,
         normalizer,
         synonym_finder,
         ontology_greenlist=[],
+        failure_sink=None,
         **kwargs
     ):
         self.classificationUrl = kwargs.get('classification_url')
@@ -74,10 +89,18 @@ class AnnotateSapbert:
         self.normalizer = normalizer
         self.synonym_finder = synonym_finder
         self.ontology_greenlist = ontology_greenlist
+        # Counts the texts that don't annotate and the identifiers that don't normalize
+        self.failures = failure_sink if failure_sink is not None else FailureSink()
+        # Off when a CachedAnnotator records the texts that annotate to nothing instead
+        self.record_annotation_failures = True
         # threshold marking cutoff point
         self.score_threshold = float(kwargs.get("score_threshold", 0.8))
         # indicate if we want values above or below the threshold.
         self.score_direction_up = True if kwargs.get("score_direction", "up") == "up" else False
+        # Number of classified terms of a text looked up at once (1 == serial)
+        self.term_concurrency = int(kwargs.get("term_concurrency", 1))
+        # Cleared when the classification service turns out not to accept lists of texts
+        self.batch_classification = True
 
         self.bagel_args = kwargs.get("bagel")
         if self.bagel_args:
@@ -94,26 +117,115 @@ class AnnotateSapbert:
     def __call__(self, text, http_session) -> List[DugIdentifier]:
         # Fetch identifiers
         classifiers: List = self.text_classification(text, http_session)
+        return self.annotate_classified([text], [classifiers], http_session)[0]
+
+    @retry(stop_max_attempt_number=3)
+    def annotate_batch(self, texts: List[str], http_session) -> List[List[DugIdentifier]]:
+        """
+        Annotate many texts, classifying them with batched requests (see classify_batch) and
+        normalizing and looking up synonyms of the identifiers of every text together.
+        Returns the identifiers of each text, in order.
+        """
+        return self.annotate_classified(texts, self.classify_batch(texts, http_session), http_session)
+
+    def annotate_classified(self, texts: List[str], classified: List[List], http_session) -> List[List[DugIdentifier]]:
+        raw_identifiers_dicts = []
+        for text, classifiers in zip(texts, classified):
+            raw_identifiers_dict: Dict[str, DugIdentifier] = self.annotate_classifiers(
+                classifiers, http_session
+            )
 
-        raw_identifiers_dict: Dict[str, DugIdentifier] = self.annotate_classifiers(
-            classifiers, http_session
-        )
+            # Record text that fails to annotate
+            if not raw_identifiers_dict and self.record_annotation_failures:
+                self.failures.record_annotation_failure(text)
+            raw_identifiers_dicts.append(raw_identifiers_dict)
+
+        # Normalize the ids of every entity using batched requests to the normalization service
+        all_raw_identifiers = [
+            identifier
+            for raw_identifiers_dict in raw_identifiers_dicts
+            for raw_identifiers in raw_identifiers_dict.values()
+            for identifier in raw_identifiers
+        ]
+        normalized_identifiers = iter(self.normalizer.normalize_batch(all_raw_identifiers, http_session))
+        processed_identifiers_dicts = [
+            self.process_normalized(raw_identifiers_dict, normalized_identifiers)
+            for raw_identifiers_dict in raw_identifiers_dicts
+        ]
+
+        # Add synonyms to identifiers using batched reverse lookups
+        all_norm_ids = [
+            norm_id
+            for processed_identifiers in processed_identifiers_dicts
+            for norm_ids in processed_identifiers.values()
+            for norm_id in norm_ids
+        ]
+        synonyms = self.synonym_finder.find_synonyms_batch([norm_id.id for norm_id in all_norm_ids], http_session)
+        for norm_id in all_norm_ids:
+            norm_id.synonyms = list(synonyms[norm_id.id])
+
+        # filter using bagel
+        if self.bagel_enabled:
+            for text, raw_identifiers_dict, processed_identifiers in zip(
+                    texts, raw_identifiers_dicts, processed_identifiers_dicts):
+                for entity in raw_identifiers_dict:
+                    processed_identifiers[entity] = self.bagel(description_text=text,
+                                                               entity=entity,
+                                                               ids=processed_identifiers.get(entity, []),
+                                                               http_session=http_session)
+        return [
+            reduce(lambda bucket, key: bucket + processed_identifiers[key], processed_identifiers, [])
+            for processed_identifiers in processed_identifiers_dicts
+        ]
+
+    async def annotate_async(self, text, http) -> List[DugIdentifier]:
+        """
+        Same as calling the annotator, but every request is made through an AsyncServicePool
+        and the classified terms (and Bagel entities) are looked up concurrently
+        """
+        response = await self.make_classification_request_async(text, http)
+        classifiers = self.handle_classification_response(response)
 
-        # Write out to file if text fails to annotate
-        if not raw_identifiers_dict:
-            logger.warning(f"Failed to annotate: {text}\n")
+        raw_identifiers_dict = await self.annotate_classifiers_async(classifiers, http)
+
+        if not raw_identifiers_dict and self.record_annotation_failures:
+            self.failures.record_annotation_failure(text)
+
+        all_raw_identifiers = [
+            identifier for raw_identifiers in raw_identifiers_dict.values() for identifier in raw_identifiers
+        ]
+        normalized_identifiers = await self.normalizer.normalize_batch_async(all_raw_identifiers, http)
+        processed_identifiers = self.process_normalized(raw_identifiers_dict, normalized_identifiers)
+
+        all_norm_ids = [norm_id for norm_ids in processed_identifiers.values() for norm_id in norm_ids]
+        synonyms = await self.synonym_finder.find_synonyms_batch_async([norm_id.id for norm_id in all_norm_ids], http)
+        for norm_id in all_norm_ids:
+            norm_id.synonyms = list(synonyms[norm_id.id])
+
+        if self.bagel_enabled:
+            entities = list(raw_identifiers_dict)
+            selected = await asyncio.gather(*(
+                self.bagel.call_async(description_text=text,
+                                      entity=entity,
+                                      ids=processed_identifiers.get(entity, []),
+                                      http=http)
+                for entity in entities
+            ))
+            processed_identifiers.update(zip(entities, selected))
+        return reduce(lambda bucket, key: bucket + processed_identifiers[key], processed_identifiers, [])
 
+    def process_normalized(self, raw_identifiers_dict: Dict[str, List[DugIdentifier]],
+                           normalized_identifiers: List) -> Dict[str, List[DugIdentifier]]:
+        normalized_identifiers = iter(normalized_identifiers)
         processed_identifiers = {}
         for entity, raw_identifiers in raw_identifiers_dict.items():
-            # normalize all ids
             for identifier in raw_identifiers:
-                # Normalize identifier using normalization service
-                norm_id = self.normalizer(identifier, http_session)
+                norm_id = next(normalized_identifiers)
 
                 # Skip adding id if it doesn't normalize
                 if norm_id is None:
-                    # Write out to file if identifier doesn't normalize
-                    logger.warning(f"Failed to normalize: {identifier.id}\n")
+                    # Record identifier that doesn't normalize
+                    self.failures.record_normalization_failure(identifier.id)
 
                     # Discard non-normalized ident if not in greenlist
                     if identifier.id_type not in self.ontology_greenlist:
@@ -122,22 +234,11 @@ class AnnotateSapbert:
                     # If it is in greenlist just keep moving forward
                     norm_id = identifier
 
-                # Add synonyms to identifier
-                norm_id.synonyms = self.synonym_finder(norm_id.id, http_session)
-
                 # Get pURL for ontology identifer for more info
                 norm_id.purl = BioLinkPURLerizer.get_curie_purl(norm_id.id)
                 processed_identifiers[entity] = processed_identifiers.get(entity, [])
                 processed_identifiers[entity].append(norm_id)
-
-
-            # filter using bagel
-            if self.bagel_enabled:
-                processed_identifiers[entity] = self.bagel(description_text=text,
-                                                           entity=entity,
-                                                           ids=processed_identifiers.get(entity, []),
-                                                           http_session=http_session)
-        return reduce(lambda bucket, key: bucket + processed_identifiers[key], processed_identifiers, [])
+        return processed_identifiers
 
     def text_classification(self, text, http_session) -> List:
         """
@@ -165,19 +266,55 @@ class AnnotateSapbert:
         classifiers = self.handle_classification_response(response)
         return classifiers
 
+    def classify_batch(self, texts: List[str], http_session) -> List[List]:
+        """
+        Classify many texts, returning the classified terms of each text in order.
+
+        The texts are sent to the classification service as one request. If the service
+        doesn't answer with one result per text they are classified one at a time instead,
+        and batches aren't tried again unless the failure looked transient (HTTP 5xx).
+        """
+        if len(texts) > 1 and self.batch_classification:
+            responses = self.make_batch_classification_request(texts, http_session)
+            if responses is not None:
+                return [self.handle_classification_response(response) for response in responses]
+        return [self.text_classification(text, http_session) for text in texts]
+
+    def make_batch_classification_request(self, texts: List[str], http_session: Session) -> Optional[List[dict]]:
+        url = self.classificationUrl
+        logger.debug(f"Requesting classification for {len(texts)} texts")
+        try:
+            response = http_session.post(url, json=self.classification_payload(texts))
+        except RequestException as e:
+            logger.warning(f"Batch classification failed with error: {str(e)} -- classifying one text at a time")
+            return None
+
+        if response.status_code // 100 == 2:
+            try:
+                responses = response.json()
+            except ValueError:
+                responses = None
+            if isinstance(responses, list) and len(responses) == len(texts):
+                return responses
+
+        if response.status_code // 100 == 5:
+            logger.warning(f"Batch classification failed (HTTP {response.status_code}) -- classifying one text at a time")
+        else:
+            logger.warning(f"Classification service doesn't accept batches (HTTP {response.status_code}) -- "
+                           f"classifying one text at a time from now on")
+            self.batch_classification = False
+        return None
+
     def make_classification_request(self, text: Input, http_session: Session):
         url = self.classificationUrl
         logger.debug(f"Requesting classification for text: {text}")
-        payload = {
-            "text": text,
-            "model_name": "token_classification",
-        }
+        payload = self.classification_payload(text)
 
         NUM_TRIES = 5
         initial_delay = 1  # seconds
         backoff_factor = 2
         max_delay = 10  # seconds
-        retryable_status_codes = {500, 502, 503, 504, 429}
+        retryable_status_codes = self.RETRYABLE_STATUS_CODES
 
         last_exception = None
         response = None
@@ -219,6 +356,32 @@ class AnnotateSapbert:
 
         return response.json()
 
+    async def make_classification_request_async(self, text: Input, http):
+        url = self.classificationUrl
+        logger.debug(f"Requesting classification for text: {text}")
+        # The pool backs off and retries transport errors and retryable statuses
+        try:
+            response = await http.post("classifier", url, json=self.classification_payload(text))
+        except httpx.HTTPError as e:
+            logger.warning(f"Classification request failed with error: {str(e)} -- returning empty annotations....")
+            return {"text": text, "denotations": []}
+
+        if response.status_code // 100 == 2:
+            return response.json()
+        if response.status_code in self.RETRYABLE_STATUS_CODES:
+            logger.warning(f"No response after retries (HTTP {response.status_code}) -- returning empty annotations....")
+            return {"text": text, "denotations": []}
+        if response.status_code == 403:
+            raise RuntimeError(f"Authorization error accessing {url}")
+        raise RuntimeError(f"API error {response.status_code}: {response.text}")
+
+    @staticmethod
+    def classification_payload(text) -> dict:
+        return {
+            "text": text,
+            "model_name": "token_classification",
+        }
+
     def handle_classification_response(self, response: dict) -> List:
         classifiers = []
         """ Parse each identifier and initialize identifier object """
@@ -264,23 +427,40 @@ class AnnotateSapbert:
           TBD: Organize the results by highest score
           Return: List of DugIdentifiers with a Curie ID
         """
-        identifiers = {}
-        for term_dict in classifiers:
+        # One lookup per distinct term, in order of first appearance; a term classified more
+        # than once maps to a single entry either way
+        terms = {term_dict['text']: term_dict for term_dict in classifiers}
+
+        def _annotate(term_dict):
             logger.debug(f"Annotating: {term_dict['text']}")
+            return self.make_annotation_request(term_dict, http_session)
 
-            response = self.make_annotation_request(term_dict, http_session)
-            identifiers[term_dict['text']] =  self.handle_annotation_response(term_dict, response)
+        if self.term_concurrency <= 1 or len(terms) <= 1:
+            responses = [_annotate(term_dict) for term_dict in terms.values()]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.term_concurrency, len(terms))) as executor:
+                # executor.map yields results in submission order
+                responses = list(executor.map(_annotate, terms.values()))
 
-        return identifiers
+        return {
+            text: self.handle_annotation_response(term_dict, response)
+            for (text, term_dict), response in zip(terms.items(), responses)
+        }
+
+    async def annotate_classifiers_async(self, classifiers: List, http) -> Dict[str, DugIdentifier]:
+        """ annotate_classifiers, looking up every classified term concurrently """
+        terms = {term_dict['text']: term_dict for term_dict in classifiers}
+        responses = await asyncio.gather(*(
+            self.make_annotation_request_async(term_dict, http) for term_dict in terms.values()
+        ))
+        return {
+            text: self.handle_annotation_response(term_dict, response)
+            for (text, term_dict), response in zip(terms.items(), responses)
+        }
 
     def make_annotation_request(self, term_dict: Input, http_session: Session):
         url = self.annotatorUrl
-        payload = {
-            "text": term_dict["text"],
-            "model_name": "sapbert",
-            "count": 10,
-            # "args": {"bl_type": term_dict["bl_type"]},
-        }
+        payload = self.annotation_payload(term_dict)
         # This could be moved to a config file
         NUM_TRIES = 5
         for _ in range(NUM_TRIES):
@@ -297,6 +477,24 @@ class AnnotateSapbert:
             raise RuntimeError(f"Annotation API is temporarily down -- vist docs here: {url.replace('annotate', 'docs')}")
         return response.json()
 
+    async def make_annotation_request_async(self, term_dict: Input, http):
+        url = self.annotatorUrl
+        response = await http.post("annotator", url, json=self.annotation_payload(term_dict))
+        if response.status_code == 403:
+            raise RuntimeError(f"You are not authorized to use this API -- {url}")
+        if response.status_code == 500:
+            raise RuntimeError(f"Annotation API is temporarily down -- vist docs here: {url.replace('annotate', 'docs')}")
+        return response.json()
+
+    @staticmethod
+    def annotation_payload(term_dict) -> dict:
+        return {
+            "text": term_dict["text"],
+            "model_name": "sapbert",
+            "count": 10,
+            # "args": {"bl_type": term_dict["bl_type"]},
+        }
+
     def handle_annotation_response(self, value, response: dict) -> List[DugIdentifier]:
         identifiers = []
         """ Parse each identifier and initialize identifier object """
@@ -0,0 +1,57 @@
+import threading
+from collections import OrderedDict
+
+
+class CurieCache:
+    """Thread-safe, size-bounded LRU cache of per-CURIE lookup results
+
+    Used by the normalizer and synonym finder so that a CURIE seen in many
+    elements is only resolved against the remote service once. Hit and miss
+    counters are kept so the effectiveness of the cache can be reported.
+    """
+
+    # Returned by get() for CURIEs that aren't cached (None is a valid cached value)
+    MISSING = object()
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, curie, default=MISSING):
+        with self._lock:
+            if curie not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(curie)
+            return self._entries[curie]
+
+    def put(self, curie, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[curie] = value
+            self._entries.move_to_end(curie)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+            }
+
+    def __len__(self):
+        return len(self._entries)
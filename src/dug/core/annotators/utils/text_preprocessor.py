@@ -0,0 +1,113 @@
+import re
+from typing import Dict, Iterable, List
+
+
+class TextPreprocessor:
+    """Compiled form of an annotator's debreviator and stopword list
+
+    Applying the debreviator is equivalent to calling str.replace once per
+    entry, in order, but consecutive entries that can't interact (no key
+    overlaps another key, or the replacement of an earlier key) are applied
+    together as a single alternation regex, longest key first. Entries that
+    could interact start a new pass, so the result is always the same as the
+    sequential replaces. Stopwords are dropped with a frozenset lookup.
+
+    >>> preprocess = TextPreprocessor({"foo": "bar"}, ["baz"])
+    >>> preprocess("Hello foo")
+    'Hello bar'
+    >>> preprocess("Hello baz world")
+    'Hello world'
+    """
+
+    # Joins the descriptions of a batch so each pass runs over all of them at once
+    BATCH_SEPARATOR = "\x00"
+
+    def __init__(self, debreviator: Dict[str, str] = None, stopwords: Iterable[str] = None):
+        self.debreviator = dict(debreviator or {})
+        self.stopwords = frozenset(stopwords or [])
+        self.passes = self._compile(self.debreviator)
+        self._batchable = not any(self.BATCH_SEPARATOR in key or self.BATCH_SEPARATOR in value
+                                  for key, value in self.debreviator.items())
+
+    @staticmethod
+    def _compile(debreviator: Dict[str, str]) -> list:
+        runs = []
+        run = None
+        for key, value in debreviator.items():
+            if run is None or not key or not run.accepts(key):
+                run = _Run()
+                runs.append(run)
+            run.add(key, value)
+            if not key:
+                # str.replace('', value) inserts value between every character, so nothing can share its pass
+                run = None
+        return [run.compile() for run in runs]
+
+    def debreviate(self, text: str) -> str:
+        for replace in self.passes:
+            text = replace(text)
+        return text
+
+    def remove_stopwords(self, text: str) -> str:
+        stopwords = self.stopwords
+        return " ".join([word for word in text.split() if word not in stopwords])
+
+    def __call__(self, text: str) -> str:
+        return self.remove_stopwords(self.debreviate(text))
+
+    def process_batch(self, texts: List[str]) -> List[str]:
+        """ Preprocess many descriptions, running each debreviator pass once over all of them """
+        separator = self.BATCH_SEPARATOR
+        if not self._batchable or any(separator in text for text in texts):
+            return [self(text) for text in texts]
+        debreviated = self.debreviate(separator.join(texts)).split(separator) if texts else []
+        return [self.remove_stopwords(text) for text in debreviated]
+
+
+class _Run:
+    """Debreviator entries that can be replaced in a single pass
+
+    A key may join the run when none of the run's keys and replacement
+    values contain it, are contained in it, or overlap it at either end, and
+    no earlier entry of the run deletes its key (which could join text into
+    a new match).
+    """
+
+    def __init__(self):
+        self.replacements = {}
+        self.strings = set()
+        self.substrings = set()
+        self.prefixes = set()
+        self.suffixes = set()
+        self.deletes = False
+
+    def accepts(self, key) -> bool:
+        if self.deletes:
+            return False
+        if key in self.substrings:
+            return False
+        length = len(key)
+        if any(key[start:end] in self.strings for start in range(length) for end in range(start + 1, length + 1)):
+            return False
+        return not any(key[:end] in self.suffixes or key[-end:] in self.prefixes for end in range(1, length))
+
+    def add(self, key, value):
+        self.replacements[key] = value
+        self.deletes = self.deletes or not value
+        for string in (key, value):
+            if not string:
+                continue
+            self.strings.add(string)
+            length = len(string)
+            self.substrings.update(string[start:end] for start in range(length) for end in range(start + 1, length + 1))
+            self.prefixes.update(string[:end] for end in range(1, length))
+            self.suffixes.update(string[-end:] for end in range(1, length))
+
+    def compile(self):
+        replacements = self.replacements
+        if len(replacements) == 1:
+            (key, value), = replacements.items()
+            return lambda text: text.replace(key, value)
+        pattern = re.compile("|".join(re.escape(key) for key in sorted(replacements, key=len, reverse=True)))
+        replace = lambda match: replacements[match.group(0)]
+        return lambda text: pattern.sub(replace, text)
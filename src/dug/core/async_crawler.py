@@ -0,0 +1,112 @@
+"""
+Crawler that talks to the annotation, normalization, synonym, Bagel and TranQL services
+from an asyncio event loop rather than from threads
+"""
+import asyncio
+import inspect
+import logging
+from typing import Dict, List
+
+from dug.core.annotators import DugIdentifier
+from dug.core.async_http import AsyncServicePool
+from dug.core.crawler import Crawler
+
+logger = logging.getLogger('dug')
+
+
+class AsyncCrawler(Crawler):
+    """
+    Drop-in Crawler whose annotation and concept expansion run as coroutines sharing one
+    AsyncServicePool, so requests to every service are in flight together and backoff doesn't
+    block a thread. `service_limits` caps the requests in flight per service and
+    `element_concurrency` the elements being annotated at once.
+
+    The event loop and pool live for the whole crawl (or chunked crawl) and are closed when it
+    finishes. Annotators without an `annotate_async` method and tranqlizers without
+    `expand_identifier_async` are run in threads with the crawler's http_session.
+    The pool's httpx client doesn't go through the redis-backed CachedSession of the sync
+    engine, so normalizer and synonym responses aren't cached over HTTP between crawls or
+    workers; only the in-process CURIE caches and the annotation cache apply.
+    Each element is annotated on its own, so annotation_batch_size is not used.
+    """
+
+    def __init__(self, *args, service_limits: Dict[str, int] = None, element_concurrency=100,
+                 http_timeout=60, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.service_limits = service_limits or {}
+        self.element_concurrency = element_concurrency
+        self.http_timeout = http_timeout
+        self._loop = None
+        self._http = None
+
+    def crawl(self):
+        try:
+            super().crawl()
+        finally:
+            self.close()
+
+    def crawl_chunks(self, chunk_size):
+        try:
+            yield from super().crawl_chunks(chunk_size)
+        finally:
+            self.close()
+
+    def close(self):
+        if self._loop is None:
+            return
+        self._loop.run_until_complete(self._http.aclose())
+        self._loop.close()
+        self._loop = None
+        self._http = None
+
+    def _run(self, coroutine):
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            self._http = AsyncServicePool(self.service_limits, timeout=self.http_timeout)
+        return self._loop.run_until_complete(coroutine)
+
+    @staticmethod
+    async def _gather(coroutines):
+        # Let every coroutine finish before raising, so nothing is left pending on the loop
+        results = await asyncio.gather(*coroutines, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    def fetch_annotations(self, elements) -> List[List[DugIdentifier]]:
+        return self._run(self._fetch_annotations(elements))
+
+    async def _fetch_annotations(self, elements):
+        total = len(elements)
+        in_flight = asyncio.Semaphore(max(self.element_concurrency, 1))
+        annotate_async = getattr(self.annotator, "annotate_async", None)
+        if not inspect.iscoroutinefunction(annotate_async):
+            annotate_async = None
+
+        async def _annotate(n, element):
+            async with in_flight:
+                logger.info(f"annotate element #{n+1}/{total} '{element.id}'")
+                if annotate_async is not None:
+                    return await annotate_async(element.ml_ready_desc, self._http)
+                return await asyncio.to_thread(self.annotator, text=element.ml_ready_desc,
+                                               http_session=self.http_session)
+
+        return await self._gather(_annotate(n, element) for n, element in enumerate(elements))
+
+    def fetch_expansions(self, expansions):
+        return self._run(self._fetch_expansions(expansions))
+
+    async def _fetch_expansions(self, expansions):
+        expand_async = getattr(self.tranqlizer, "expand_identifier_async", None)
+        if not inspect.iscoroutinefunction(expand_async):
+            expand_async = None
+
+        async def _expand(expansion):
+            concept, ident_id, query_name, query_factory = expansion
+            kg_outfile = f"{self.crawlspace}/{ident_id}_{query_name}.json"
+            if expand_async is not None:
+                return await expand_async(ident_id, query_factory, kg_outfile, self._http)
+            return await asyncio.to_thread(self.tranqlizer.expand_identifier, ident_id, query_factory, kg_outfile)
+
+        return await self._gather(_expand(expansion) for expansion in expansions)
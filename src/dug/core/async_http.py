@@ -0,0 +1,77 @@
+"""
+Pooled async HTTP client shared by the services an async crawl calls
+"""
+import asyncio
+import logging
+from typing import Dict
+
+import httpx
+
+logger = logging.getLogger('dug')
+
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+class AsyncServicePool:
+    """
+    One httpx.AsyncClient (and so one connection pool) shared by every service of a crawl.
+    Requests name the service they are for ("annotator", "normalizer", "synonyms", ...);
+    each service has its own semaphore so a slow service can't hold every connection, with
+    `default_limit` used for services missing from `service_limits`.
+
+    Transport errors and retryable statuses are retried up to `max_retries` times with
+    exponential backoff on asyncio.sleep. The semaphore is held while backing off, so a
+    struggling service isn't sent more requests than its limit. The last response is
+    returned whatever its status; the last transport error is raised.
+    """
+
+    RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+    def __init__(self, service_limits: Dict[str, int] = None, default_limit=10, timeout=60,
+                 max_retries=4, backoff=1, max_backoff=10, transport=None):
+        self.service_limits = dict(service_limits or {})
+        self.default_limit = default_limit
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        max_connections = sum(self.service_limits.values()) + default_limit
+        self.client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_connections),
+            transport=transport,
+        )
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def _semaphore(self, service) -> asyncio.Semaphore:
+        if service not in self._semaphores:
+            self._semaphores[service] = asyncio.Semaphore(self.service_limits.get(service, self.default_limit))
+        return self._semaphores[service]
+
+    async def request(self, service, method, url, **kwargs) -> httpx.Response:
+        delay = self.backoff
+        async with self._semaphore(service):
+            for attempt in range(self.max_retries + 1):
+                last_attempt = attempt == self.max_retries
+                try:
+                    response = await self.client.request(method, url, **kwargs)
+                except httpx.TransportError as e:
+                    if last_attempt:
+                        raise
+                    logger.warning(f"{service} request to {url} failed on attempt {attempt + 1}: {e}")
+                else:
+                    if last_attempt or response.status_code not in self.RETRYABLE_STATUS_CODES:
+                        return response
+                    logger.warning(f"Retryable status {response.status_code} from {service} on attempt {attempt + 1}")
+                logger.debug(f"Retrying {service} request in {delay} seconds...")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+    async def get(self, service, url, **kwargs) -> httpx.Response:
+        return await self.request(service, "GET", url, **kwargs)
+
+    async def post(self, service, url, **kwargs) -> httpx.Response:
+        return await self.request(service, "POST", url, **kwargs)
+
+    async def aclose(self):
+        await self.client.aclose()
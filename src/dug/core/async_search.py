@@ -1,13 +1,19 @@
 """Implements search methods using async interfaces"""
+import asyncio
 import logging
-from elasticsearch import AsyncElasticsearch
+from elasticsearch import AsyncElasticsearch, NotFoundError
 from elasticsearch.helpers import async_scan
-import ssl,json
+import ssl
 from dug.config import Config
+from dug.core.index import GENERATION_META_KEY, SUMMARIES_META_KEY
+from dug.core.program_catalog import ProgramCatalog
 
 
 logger = logging.getLogger('dug')
 
+# How long a point in time opened for a streamed dump is kept between pages
+DUMP_KEEP_ALIVE = "5m"
+
 
 class SearchException(Exception):
     def __init__(self, message, details):
@@ -32,6 +38,9 @@ class Search:
             indices = ['concepts_index', 'variables_index', 'kg_index']
 
         self._cfg = cfg
+        self._program_catalog = None
+        # Set once the summary indices are marked complete; they stay complete after that
+        self._summaries_complete = False
         logger.debug(f"Connecting to elasticsearch host: "
                      f"{self._cfg.elastic_host} at port: "
                      f"{self._cfg.elastic_port}")
@@ -44,18 +53,58 @@ class Search:
         logger.debug(f"Authenticating as user "
                      f"{self._cfg.elastic_username} "
                      f"to host:{self.hosts}")
+        # Connections are pooled and kept alive per node; the pool, timeout and retry
+        # settings are sized for concurrent API traffic
+        client_options = {
+            "basic_auth": (self._cfg.elastic_username, self._cfg.elastic_password),
+            "connections_per_node": self._cfg.elastic_connections_per_node,
+            "request_timeout": self._cfg.elastic_request_timeout,
+            "max_retries": self._cfg.elastic_max_retries,
+            "retry_on_timeout": self._cfg.elastic_retry_on_timeout,
+        }
+        if self._cfg.elastic_sniff:
+            # Discover the other nodes of a multi-node cluster and spread requests over them
+            client_options.update(sniff_on_start=True, sniff_on_node_failure=True,
+                                  min_delay_between_sniffing=60)
         if self._cfg.elastic_scheme == "https":
-            ssl_context = ssl.create_default_context(
+            client_options["ssl_context"] = ssl.create_default_context(
                 cafile=self._cfg.elastic_ca_path
             )
-            self.es = AsyncElasticsearch(hosts=self.hosts,
-                                     basic_auth=(self._cfg.elastic_username,
-                                                self._cfg.elastic_password),
-                                                ssl_context=ssl_context)
-        else:
-            self.es = AsyncElasticsearch(hosts=self.hosts,
-                                     basic_auth=(self._cfg.elastic_username,
-                                                self._cfg.elastic_password))
+        self.es = AsyncElasticsearch(hosts=self.hosts, **client_options)
+
+    async def warmup(self):
+        """
+        Check the cluster is reachable and open pooled connections ahead of traffic by
+        running a cheap search against each index. Failures are logged, not raised, so
+        the API still starts while elasticsearch is coming up.
+        """
+        try:
+            health = await self.es.cluster.health(wait_for_status="yellow", timeout="10s")
+            logger.info(f"Elasticsearch cluster {health['cluster_name']} is {health['status']}")
+            await asyncio.gather(*(
+                self.es.search(index=index, size=0, query={"match_all": {}})
+                for index in self.indices
+            ))
+        except Exception as e:
+            logger.warning(f"Elasticsearch warmup failed: {e}")
+
+    @property
+    def program_catalog(self) -> ProgramCatalog:
+        # Loaded on first use, as only deployments with a studies file need it
+        if self._program_catalog is None:
+            self._program_catalog = ProgramCatalog(self._cfg.studies_path,
+                                                   reload_interval=self._cfg.studies_reload_interval)
+        return self._program_catalog
+
+    async def get_index_generation(self):
+        """
+        Generation of the indices, as recorded by Index.update_generation
+        """
+        mappings = await self.es.indices.get_mapping(index=self.indices)
+        return "|".join(
+            f"{index}={mappings[index]['mappings'].get('_meta', {}).get(GENERATION_META_KEY, '')}"
+            for index in sorted(mappings)
+        )
 
     async def dump_concepts(self, index, query={}, size=None,
                             fuzziness=1, prefix_length=3):
@@ -90,6 +139,53 @@ class Search:
             "message": "Search result"
         }
 
+    async def open_dump(self, index, keep_alive=DUMP_KEEP_ALIVE):
+        """
+        Open a point in time on an index for stream_docs, returning its id
+        """
+        result = await self.es.open_point_in_time(index=index, keep_alive=keep_alive)
+        return result['id']
+
+    async def stream_docs(self, pit_id, size=0, fields=None, search_after=None,
+                          page_size=1000, keep_alive=DUMP_KEEP_ALIVE):
+        """
+        Yield every document of a point in time (see open_dump) one page at a time, so only
+        a page of hits is held in memory. Hits carry their `sort` values; passing the last
+        one back as search_after, with the same pit_id, resumes the dump after that hit.
+        `fields` limits the _source fields returned. Up to `size` hits are yielded (0 == all).
+        The point in time is closed once every document has been read.
+        """
+        remaining = size or None
+        while True:
+            page_size = page_size if remaining is None else min(page_size, remaining)
+            search_kwargs = {}
+            if search_after:
+                search_kwargs['search_after'] = search_after
+            if fields:
+                search_kwargs['source'] = fields
+            result = await self.es.search(
+                pit={"id": pit_id, "keep_alive": keep_alive},
+                query={"match_all": {}},
+                sort=["_shard_doc"],
+                size=page_size,
+                track_total_hits=False,
+                **search_kwargs
+            )
+            # Elasticsearch may hand back a new id for the same point in time
+            pit_id = result.get('pit_id', pit_id)
+            hits = result['hits']['hits']
+            for hit in hits:
+                yield hit
+
+            if len(hits) < page_size:
+                await self.es.close_point_in_time(id=pit_id)
+                return
+            if remaining is not None:
+                remaining -= len(hits)
+                if remaining <= 0:
+                    return
+            search_after = hits[-1]['sort']
+
     async def agg_data_type(self):
         aggs = {
             "data_type": {
@@ -217,18 +313,42 @@ class Search:
         }
         return query_object
 
+    def _page_size(self, size, default=None):
+        # Never ask elasticsearch for more than search_max_page_size hits at once
+        if not size:
+            return default
+        return min(size, self._cfg.search_max_page_size)
+
+    @staticmethod
+    def _pop_total_hits(search_results):
+        """
+        Remove hits.total (from track_total_hits) from a search response and return its value
+        """
+        hits = search_results.get('hits', {})
+        total = hits.pop('total', {}).get('value', 0)
+        if not hits:
+            # No matching documents; keep the response shape filter_path used to give
+            search_results.pop('hits', None)
+        return total
+
     def is_simple_search_query(self, query):
         return "*" in query or "\"" in query or "+" in query or "-" in query
 
+    def _get_concept_search_body(self, query, **kwargs):
+        if self.is_simple_search_query(query):
+            return self.get_simple_concept_search_query(query)
+        return self._get_concepts_query(query, **kwargs)
+
     async def search_concepts(self, query, offset=0, size=None, types=None,
-                              **kwargs):
+                              explain=False, **kwargs):
         """
         Changed to a long boolean match query to optimize search results
+
+        Scoring explanations are expensive to compute and serialize, so they're
+        only requested with explain=True; each hit then carries a compact
+        _score_breakdown instead of the full explanation tree.
         """
-        if self.is_simple_search_query(query):
-            search_body = self.get_simple_concept_search_query(query)
-        else:
-            search_body = self._get_concepts_query(query, **kwargs)
+        search_body = self._get_concept_search_body(query, **kwargs)
         # Get aggregated counts of biolink types
         search_body['aggs'] = {'type-count': {'terms': {'field': 'type'}}}
         if isinstance(types, list):
@@ -240,28 +360,22 @@ class Search:
                     "minimum_should_match": 1
                 }
             }
+        # Totals come back with the hits (post_filter applies to them, not to the aggs)
         search_results = await self.es.search(
             index="concepts_index",
             body=search_body,
-            filter_path=['hits.hits._id', 'hits.hits._type',
+            filter_path=['hits.total', 'hits.hits._id', 'hits.hits._type',
                          'hits.hits._source', 'hits.hits._score',
                          'hits.hits._explanation', 'aggregations'],
             from_=offset,
-            size=size,
-            explain=True
-        )
-        # Aggs/post_filter aren't supported by count
-        del search_body["aggs"]
-        if "post_filter" in search_body:
-            # We'll move the post_filter into the actual filter
-            search_body["query"]["bool"]["filter"]["bool"].update(
-                search_body["post_filter"]["bool"]
-            )
-            del search_body["post_filter"]
-        total_items = await self.es.count(
-            body=search_body,
-            index="concepts_index"
+            size=self._page_size(size),
+            track_total_hits=True,
+            explain=explain
         )
+        total_items = self._pop_total_hits(search_results)
+        if explain:
+            for hit in search_results.get('hits', {}).get('hits', []):
+                hit['_score_breakdown'] = self.get_score_breakdown(hit.pop('_explanation', {}))
 
         # Simplify the data structure we get from aggregations to put into the
         # return value. This should be a count of documents hit for every type
@@ -271,10 +385,50 @@ class Search:
             bucket['key']: bucket['doc_count'] for bucket in
             aggregations['type-count']['buckets']
         }
-        search_results.update({'total_items': total_items['count']})
+        search_results.update({'total_items': total_items})
         search_results.update({'concept_types': concept_types})
         return search_results
 
+    async def explain_concept(self, query, concept_id, **kwargs):
+        """
+        Explain how a concept scores against a concept search query. Returns the
+        compact breakdown along with the full elasticsearch explanation.
+        """
+        search_body = self._get_concept_search_body(query, **kwargs)
+        result = await self.es.explain(
+            index="concepts_index",
+            id=concept_id,
+            query=search_body['query']
+        )
+        explanation = result.get('explanation', {})
+        return {
+            'id': concept_id,
+            'matched': result.get('matched', False),
+            'score_breakdown': self.get_score_breakdown(explanation),
+            'explanation': explanation
+        }
+
+    @staticmethod
+    def get_score_breakdown(explanation):
+        """
+        Reduce an elasticsearch explanation tree to the clauses that add up to the
+        score: "sum of" nodes are expanded, anything else is reported as one clause.
+        """
+        clauses = []
+
+        def collect(node):
+            if node.get('description', '').startswith('sum of') and node.get('details'):
+                for detail in node['details']:
+                    collect(detail)
+            else:
+                clauses.append({'description': node.get('description', ''),
+                                'value': node.get('value', 0)})
+
+        if explanation:
+            collect(explanation)
+        clauses.sort(key=lambda clause: -clause['value'])
+        return {'score': explanation.get('value', 0), 'clauses': clauses}
+
     async def search_variables(self, concept="", query="", size=None,
                                data_type=None, offset=0, fuzziness=1,
                                prefix_length=3, index=None):
@@ -297,15 +451,16 @@ class Search:
         if index is None:
             index = "variables_index"
 
-        total_items = await self.es.count(body=es_query, index=index)
         search_results = await self.es.search(
             index="variables_index",
             body=es_query,
-            filter_path=['hits.hits._id', 'hits.hits._type',
+            filter_path=['hits.total', 'hits.hits._id', 'hits.hits._type',
                          'hits.hits._source', 'hits.hits._score'],
             from_=offset,
-            size=size or total_items['count']
+            size=self._page_size(size, default=self._cfg.search_max_page_size),
+            track_total_hits=True
         )
+        total_items = {'count': self._pop_total_hits(search_results)}
 
         search_result_hits = []
 
@@ -475,6 +630,11 @@ class Search:
         Search for studies by unique_id (ID or name) and/or study_name.
         """
         if use_elasticsearch:
+            studies = await self._get_program_studies(program_name)
+            if studies is not None:
+                return studies
+
+            # Summaries haven't been built, aggregate the variables index instead
             query_body = {
                 "query": {
                     "bool": {
@@ -532,41 +692,84 @@ class Search:
 
             return collection_details_list
         else:
-            with open(self._cfg.studies_path, 'r') as file:
-                missing_programs = json.load(file)
-                
-            collection_details_list = []
-            program_name_lower = program_name.lower() if program_name else None
-
-            for row in missing_programs:
-                program = row.get('Program', '')
-                study_name = row.get('Study Name', '')
-                collection_id = row.get('Accession', '')
-                description = row.get('Description', '')
-                
-                if not program or not collection_id:
-                    continue
-
-                if program_name_lower and program.lower() != program_name_lower:
-                    continue
-                    
-                # Extract base accession for URL to dbgap
-                accession_base = collection_id.split('.c')[0] if '.c' in collection_id else collection_id
-                collection_action = f"https://www.ncbi.nlm.nih.gov/projects/gap/cgi-bin/study.cgi?study_id={accession_base}"
-                
-                # Add to collection details list
-                collection_details_list.append({
-                    "collection_id": collection_id,
-                    "collection_action": collection_action,
-                    "collection_name": study_name
-                })
+            return self.program_catalog.get_collections(program_name)
 
-            collection_details_list.sort(key=lambda x: x["collection_id"])
-                
-            return collection_details_list
+    async def summaries_complete(self):
+        """
+        Whether the study and program summary indices cover every study, as marked by the
+        crawl that rebuilt them. Until then summaries may only hold the studies crawled since
+        an upgrade, so callers aggregate the variables index instead.
+        """
+        if not self._summaries_complete:
+            try:
+                mappings = await self.es.indices.get_mapping(index=["studies_index", "programs_index"])
+            except NotFoundError:
+                return False
+            self._summaries_complete = all(
+                mapping['mappings'].get('_meta', {}).get(SUMMARIES_META_KEY) for mapping in mappings.values())
+        return self._summaries_complete
+
+    async def _search_all(self, index, query, sort, source=None):
+        # Every hit of the query, a page of search_max_page_size at a time
+        page_size = self._cfg.search_max_page_size
+        hits = []
+        search_after = None
+        while True:
+            kwargs = {"search_after": search_after} if search_after is not None else {}
+            search_results = await self.es.search(index=index, query=query, source=source, sort=sort,
+                                                  size=page_size, **kwargs)
+            page = search_results['hits']['hits']
+            hits += page
+            if len(page) < page_size:
+                return hits
+            search_after = page[-1]['sort']
+
+    async def _get_program_studies(self, program_name=None):
+        """
+        Studies of a program from the studies summary index, or None if the summaries aren't
+        complete. Once they are, a program without studies is an empty list rather than a
+        reason to aggregate the variables index.
+        """
+        if not await self.summaries_complete():
+            return None
+        if program_name:
+            query = {"match": {"data_type": {"query": program_name, "analyzer": "standard"}}}
+        else:
+            query = {"match_all": {}}
+        try:
+            hits = await self._search_all("studies_index", query,
+                                          source=["collection_id", "collection_name", "collection_action"],
+                                          sort=[{"collection_id": "asc"}])
+        except NotFoundError:
+            return None
+        return [hit['_source'] for hit in hits]
+
+    async def _get_program_summaries(self):
+        """
+        Programs with their variable and study counts from the programs summary index,
+        in the bucket format of the data_type aggregation, or None if the summaries aren't
+        complete
+        """
+        if not await self.summaries_complete():
+            return None
+        try:
+            hits = await self._search_all("programs_index", {"match_all": {}},
+                                          sort=[{"variable_count": "desc"}, {"program_name": "asc"}])
+        except NotFoundError:
+            return None
+        return [{
+            "key": hit['_source']['program_name'],
+            "doc_count": hit['_source']['variable_count'],
+            "No_of_studies": {"value": hit['_source']['study_count']}
+        } for hit in hits]
 
     async def search_program_list(self,use_elasticsearch=False):
         if use_elasticsearch:
+            programs = await self._get_program_summaries()
+            if programs is not None:
+                return programs
+
+            # Summaries haven't been built, aggregate the variables index instead
             query_body = {
                 "size": 0,  # We don't need the documents themselves, so set the size to 0
                 "aggs": {
@@ -593,34 +796,8 @@ class Search:
             data=unique_data_types
             return data
         else:
-            with open(self._cfg.studies_path, 'r') as file:
-                missing_programs = json.load(file)
-
-            program_studies = {}
-            program_descriptions = {}
-            
-            for study in missing_programs:
-                program = study.get("Program", "")
-                description = study.get("Description", "")
-                
-                if program not in program_studies:
-                    program_studies[program] = []
-                    program_descriptions[program] = description
-                program_studies[program].append(study)
-
-            program_summary = []
-            for program_name, studies in program_studies.items():
-                program_summary.append({
-                    "key": program_name,
-                    "doc_count": len(studies),
-                    "No_of_studies": {"value": len(studies)},
-                    "description": program_descriptions[program_name],
-                    "parent_program": [""]
-                })
-            # Sort by program name
-            program_summary.sort(key=lambda x: x["key"])
-            return program_summary
-    
+            return self.program_catalog.get_program_summary()
+
     def _get_var_query(self, concept, fuzziness, prefix_length, query):
         """Returns ES query for variable search"""
         es_query = {
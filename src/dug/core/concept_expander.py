@@ -1,7 +1,10 @@
 import json
 import logging
 import os
+
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 
 import dug.core.tranql as tql
 
@@ -11,9 +14,17 @@ logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
 class ConceptExpander:
-    def __init__(self, url, min_tranql_score=0.2):
+    def __init__(self, url, min_tranql_score=0.2, timeout=60, pool_size=10, store=None):
         self.url = url
+        # Optional KGAnswerStore; without one responses are cached as JSON files in the crawlspace
+        self.store = store
         self.min_tranql_score = min_tranql_score
+        self.timeout = timeout
+        # Keep-alive connections shared by every query, sized for concurrent expansion
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
         self.include_node_keys = ["id", "name", "synonyms"]
         self.include_edge_keys = []
         self.tranql_headers = {"accept": "application/json", "Content-Type": "text/plain"}
@@ -21,35 +32,95 @@ class ConceptExpander:
     def is_acceptable_answer(self, answer):
         return True
 
-    def expand_identifier(self, identifier, query_factory, kg_filename, include_all_attributes=False):
-
-        answer_kgs = []
-
-        # Skip TranQL query if a file exists in the crawlspace exists already, but continue w/ answers
-        if os.path.exists(kg_filename):
-            logger.info(f"identifier {identifier} is already crawled. Skipping TranQL query.")
+    def get_saved_response(self, identifier, query_factory, kg_filename):
+        if self.store is not None:
+            response = self.store.get(identifier, self.store.query_key(query_factory), query_factory.source)
+        elif os.path.exists(kg_filename):
             with open(kg_filename, 'r') as stream:
                 response = json.load(stream)
         else:
-            query = query_factory.get_query(identifier)
-            logger.debug(query)
-            response = requests.post(
+            return None
+        if response is not None:
+            logger.info(f"identifier {identifier} is already crawled. Skipping TranQL query.")
+        return response
+
+    def save_response(self, identifier, query_factory, kg_filename, response):
+        if self.store is not None:
+            self.store.put(identifier, self.store.query_key(query_factory), query_factory.source, response)
+            return
+        with open(kg_filename, 'w') as stream:
+            json.dump(response, stream, indent=2)
+
+    def query_tranql(self, identifier, query_factory):
+        """
+        Run the query for an identifier, returning None if it failed or found no knowledge graph
+        """
+        query = query_factory.get_query(identifier)
+        logger.debug(query)
+        try:
+            response = self.session.post(
                 url=self.url,
                 headers=self.tranql_headers,
-                data=query).json()
+                data=query,
+                timeout=self.timeout).json()
+        except requests.exceptions.RequestException as e:
+            # Nothing is saved, so the query is retried on the next crawl
+            logger.error(f"TranQL query for {identifier} failed: {e}")
+            return None
+        return self.check_tranql_response(query, response)
+
+    async def query_tranql_async(self, identifier, query_factory, http):
+        """
+        query_tranql through an AsyncServicePool
+        """
+        query = query_factory.get_query(identifier)
+        logger.debug(query)
+        try:
+            response = await http.post("tranql", self.url,
+                                       headers=self.tranql_headers,
+                                       content=query,
+                                       timeout=self.timeout)
+            response = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            # Nothing is saved, so the query is retried on the next crawl
+            logger.error(f"TranQL query for {identifier} failed: {e}")
+            return None
+        return self.check_tranql_response(query, response)
+
+    def check_tranql_response(self, query, response):
+        # Case: Skip if empty KG
+        try:
+            if response["message"] == 'Internal Server Error' or len(response["message"]["knowledge_graph"]["nodes"]) == 0:
+                logger.debug(f"Did not find a knowledge graph for {query}")
+                logger.debug(f"{self.url} returned response: {response}")
+                return None
+        except KeyError as e:
+            logger.error(f"Could not find key: {e} in response: {response}")
+        return response
 
-            # Case: Skip if empty KG
-            try:
-                if response["message"] == 'Internal Server Error' or len(response["message"]["knowledge_graph"]["nodes"]) == 0:
-                    logger.debug(f"Did not find a knowledge graph for {query}")
-                    logger.debug(f"{self.url} returned response: {response}")
-                    return []
-            except KeyError as e:
-                logger.error(f"Could not find key: {e} in response: {response}")
-
-            # Dump out to file if there's a knowledge graph
-            with open(kg_filename, 'w') as stream:
-                json.dump(response, stream, indent=2)
+    def expand_identifier(self, identifier, query_factory, kg_filename, include_all_attributes=False):
+
+        # Skip TranQL query if the response was saved by an earlier crawl, but continue w/ answers
+        response = self.get_saved_response(identifier, query_factory, kg_filename)
+        if response is None:
+            response = self.query_tranql(identifier, query_factory)
+            if response is None:
+                return []
+            self.save_response(identifier, query_factory, kg_filename, response)
+        return self.get_answer_kgs(identifier, response, kg_filename, include_all_attributes)
+
+    async def expand_identifier_async(self, identifier, query_factory, kg_filename, http,
+                                      include_all_attributes=False):
+        response = self.get_saved_response(identifier, query_factory, kg_filename)
+        if response is None:
+            response = await self.query_tranql_async(identifier, query_factory, http)
+            if response is None:
+                return []
+            self.save_response(identifier, query_factory, kg_filename, response)
+        return self.get_answer_kgs(identifier, response, kg_filename, include_all_attributes)
+
+    def get_answer_kgs(self, identifier, response, kg_filename, include_all_attributes=False):
+        answer_kgs = []
 
         # Get nodes in knowledge graph hashed by ids for easy lookup
         noMessage = (len(response.get("message",{})) == 0)
@@ -0,0 +1,203 @@
+"""
+Record of what earlier crawls read from each input file, used by incremental crawls
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set
+
+from dug.config import Config
+from dug.core.annotators import CachedAnnotator
+from dug.core.annotators.annotation_cache import annotator_fingerprint
+from dug.core.parsers import DugConcept, DugElement
+
+logger = logging.getLogger('dug')
+
+
+class ManifestElement(NamedTuple):
+    doc_id: str
+    collection_id: str
+    fingerprint: Optional[str]
+    concept_ids: List[str]
+
+
+class CrawlManifest:
+    """
+    SQLite tables of the files crawled, with the content hash and crawl settings (parser,
+    annotator, element type and a hash of the annotation and expansion config) they were
+    crawled with, and of the elements each file produced:
+    their variables_index document id, collection, a fingerprint of their parsed content and
+    the concepts they were annotated with. Like the KG answer store it is WAL-mode, so crawl
+    worker processes can share the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS crawled_files ("
+                "source TEXT PRIMARY KEY, content_hash TEXT NOT NULL, crawl_key TEXT NOT NULL, "
+                "crawled_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS crawled_elements ("
+                "source TEXT NOT NULL, doc_id TEXT NOT NULL, collection_id TEXT NOT NULL, "
+                "fingerprint TEXT, concept_ids TEXT NOT NULL, "
+                "PRIMARY KEY (source, doc_id)) WITHOUT ROWID"
+            )
+
+    @staticmethod
+    def source_key(target) -> str:
+        return os.path.abspath(str(target))
+
+    @staticmethod
+    def crawl_key(parser, annotator, element_type, config: Config = None) -> str:
+        # Crawling with a different parser, annotator, element type or annotation and expansion
+        # settings re-annotates everything
+        if isinstance(annotator, CachedAnnotator):
+            annotator = annotator.annotator
+        key = f"{type(parser).__name__}:{type(annotator).__name__}:{element_type or ''}"
+        if config is not None:
+            key += f":{crawl_settings_fingerprint(config)}"
+        return key
+
+    @staticmethod
+    def hash_file(path, block_size=1 << 20) -> str:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as stream:
+            for block in iter(lambda: stream.read(block_size), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def get_file(self, source):
+        """ (content_hash, crawl_key) of the last crawl of source, or None """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT content_hash, crawl_key FROM crawled_files WHERE source=?", (source,)).fetchone()
+
+    def get_elements(self, source) -> Dict[str, ManifestElement]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT doc_id, collection_id, fingerprint, concept_ids FROM crawled_elements WHERE source=?",
+                (source,)).fetchall()
+        return {doc_id: ManifestElement(doc_id, collection_id, fingerprint, json.loads(concept_ids))
+                for doc_id, collection_id, fingerprint, concept_ids in rows}
+
+    def sources(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT source FROM crawled_files")]
+
+    def record(self, source, content_hash, crawl_key, elements: Iterable[ManifestElement]):
+        """ Replace what is recorded for source """
+        rows = [(source, element.doc_id, element.collection_id, element.fingerprint,
+                 json.dumps(element.concept_ids)) for element in elements]
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM crawled_elements WHERE source=?", (source,))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO crawled_elements (source, doc_id, collection_id, fingerprint, concept_ids) "
+                "VALUES (?, ?, ?, ?, ?)", rows)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO crawled_files (source, content_hash, crawl_key, crawled_at) "
+                "VALUES (?, ?, ?, ?)", (source, content_hash, crawl_key, time.time()))
+
+    def forget(self, source):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM crawled_elements WHERE source=?", (source,))
+            self._conn.execute("DELETE FROM crawled_files WHERE source=?", (source,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def crawl_settings_fingerprint(config: Config) -> str:
+    """
+    Hash of the config that can change what a crawl makes of an unchanged file: the settings of
+    every annotator, the TranQL expansion queries and the node to element extraction queries
+    """
+    settings = {
+        "annotators": {name: annotator_fingerprint(name, config) for name in sorted(config.annotator_args)},
+        "tranql_queries": config.tranql_queries,
+        "tranql_exclude_identifiers": config.tranql_exclude_identifiers,
+        "node_to_element_queries": config.node_to_element_queries,
+    }
+    return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def element_fingerprint(element: DugElement) -> str:
+    """ Hash of everything the parser set on an element that annotation and indexing depend on """
+    content = {**element.get_searchable_dict(), "ml_ready_desc": element.ml_ready_desc}
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class IncrementalParser:
+    """
+    Wraps a parser so that only elements that are new, or whose fingerprint differs from
+    `previous` (the manifest elements of the file's last crawl), come out of it. Pre-loaded
+    concepts always pass through. Every parsed element is remembered so the manifest can be
+    rewritten and removed elements found once the file has been crawled; the concepts of
+    changed elements are picked up through record_annotations once they are annotated.
+    """
+
+    def __init__(self, parser, previous: Dict[str, ManifestElement]):
+        self.parser = parser
+        self.previous = previous
+        self.seen: Dict[str, ManifestElement] = {}
+        # Document ids of the elements handed on to the crawler
+        self.changed_ids: Set[str] = set()
+        # Document ids of changed elements that were indexed by an earlier crawl
+        self.modified_ids: Set[str] = set()
+        # Document ids of elements that failed to index or delete
+        self.failed_ids: Set[str] = set()
+
+    def __call__(self, input_file):
+        for element in self.parser(input_file):
+            if isinstance(element, DugConcept):
+                yield element
+                continue
+            doc_id = element.get_id()
+            fingerprint = element_fingerprint(element)
+            self.seen[doc_id] = ManifestElement(doc_id, element.collection_id, fingerprint, [])
+            previous = self.previous.get(doc_id)
+            if previous is not None and previous.fingerprint == fingerprint:
+                continue
+            if previous is not None:
+                self.modified_ids.add(doc_id)
+            self.changed_ids.add(doc_id)
+            yield element
+
+    @property
+    def unchanged(self) -> int:
+        return len(self.seen) - len(self.changed_ids)
+
+    def record_annotations(self, elements: Iterable[DugElement]):
+        for element in elements:
+            doc_id = element.get_id()
+            if doc_id in self.changed_ids:
+                self.seen[doc_id] = self.seen[doc_id]._replace(concept_ids=list(element.concepts))
+
+    def record_failures(self, doc_ids: Iterable[str]):
+        self.failed_ids.update(doc_ids)
+
+    def removed(self) -> List[ManifestElement]:
+        """ Elements of the last crawl that the file no longer has """
+        return [element for doc_id, element in self.previous.items() if doc_id not in self.seen]
+
+    def manifest_elements(self) -> List[ManifestElement]:
+        elements = [seen if doc_id in self.changed_ids else seen._replace(concept_ids=self.previous[doc_id].concept_ids)
+                    for doc_id, seen in self.seen.items()]
+        # Elements that failed to index, and removed elements that failed to delete, are kept
+        # without a fingerprint so the next crawl of the file tries them again
+        elements += [element for element in self.removed() if element.doc_id in self.failed_ids]
+        return [element._replace(fingerprint=None) if element.doc_id in self.failed_ids else element
+                for element in elements]
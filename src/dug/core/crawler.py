@@ -1,7 +1,10 @@
+import collections
+import itertools
 import json
 import logging
 import os
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
 from dug.core.parsers import Parser, DugElement, DugConcept
@@ -16,7 +19,8 @@ class Crawler:
     def __init__(self, crawl_file: str, parser: Parser, annotator: Annotator,
                  tranqlizer, tranql_queries,
                  http_session, exclude_identifiers=None, element_type=None,
-                 element_extraction=None):
+                 element_extraction=None, annotation_concurrency=1, expansion_concurrency=1,
+                 annotation_batch_size=1):
 
         if exclude_identifiers is None:
             exclude_identifiers = []
@@ -30,6 +34,13 @@ class Crawler:
         self.http_session = http_session
         self.exclude_identifiers = exclude_identifiers
         self.element_extraction = element_extraction
+        # Number of elements that may be annotated in flight at once (1 == serial)
+        self.annotation_concurrency = annotation_concurrency
+        # Number of element descriptions sent to annotators that have annotate_batch at once
+        # (1 == one element per call)
+        self.annotation_batch_size = annotation_batch_size
+        # Number of TranQL queries that may be in flight at once (1 == serial)
+        self.expansion_concurrency = expansion_concurrency
         self.elements = []
         self.concepts = {}
         self.crawlspace = "crawl"
@@ -48,12 +59,10 @@ class Crawler:
         self.make_crawlspace()
 
         # Read in elements from parser
-        self.elements = self.parser(self.crawl_file)
+        self.elements = list(self.parser(self.crawl_file))
 
         # Optionally coerce all elements to be a specific type
-        for element in self.elements:
-            if isinstance(element, DugElement) and self.element_type is not None:
-                element.type = self.element_type
+        self.coerce_element_types(self.elements)
 
         # Annotate elements
         self.annotate_elements()
@@ -61,63 +70,140 @@ class Crawler:
         # if elements are extracted from the graph this array will contain the new dug elements
         dug_elements_from_graph = []
 
+        # Use TranQL queries to fetch knowledge graphs containing related but not synonymous biological terms
+        self.expand_concepts(self.concepts.values())
+
         # Expand concepts to other concepts
         concept_file = open(f"{self.crawlspace}/concept_file.json", "w")
         for concept_id, concept in self.concepts.items():
-            # Use TranQL queries to fetch knowledge graphs containing related but not synonymous biological terms
-            self.expand_concept(concept)
-
-            # Traverse identifiers to create single list of of search targets/synonyms for concept
-            concept.set_search_terms()
-
-            # Traverse kg answers to create list of optional search targets containing related concepts
-            concept.set_optional_terms()
-
-            # Remove duplicate search terms and optional search terms
-            concept.clean()
+            dug_elements_from_graph += self.process_concept(concept)
 
             # Write concept out to a file
             concept_file.write(f"{json.dumps(concept.get_searchable_dict(), indent=2)}")
 
-            if self.element_extraction:
-                for element_extraction_config in self.element_extraction:
-                    casting_config = element_extraction_config['casting_config']
-                    tranql_source = element_extraction_config['tranql_source']
-                    dug_element_type = element_extraction_config['output_dug_type']
-                    dug_elements_from_graph += self.expand_to_dug_element(
-                        concept=concept,
-                        casting_config=casting_config,
-                        dug_element_type=dug_element_type,
-                        tranql_source=tranql_source
-                    )
-
         # add new elements to parsed elements
         self.elements += dug_elements_from_graph
 
         # Set element optional terms now that concepts have been expanded
         # Open variable file for writing
         variable_file = open(f"{self.crawlspace}/element_file.json", "w")
-        for element in self.elements:
-            if isinstance(element, DugElement):
-                element.set_optional_terms()
-                variable_file.write(f"{element.get_searchable_dict()}\n")
+        self.finalize_elements(self.elements, variable_file)
 
         # Close concept, element files
         concept_file.close()
         variable_file.close()
 
+    def crawl_chunks(self, chunk_size):
+        """
+        Streaming alternative to crawl(). Elements are pulled from the parser `chunk_size` at a
+        time, annotated, and the concepts first seen in the chunk are expanded. Each chunk is
+        yielded as (elements, new_concepts) so the caller can index it; once the caller asks for
+        the next chunk its elements and the knowledge graph answers of its concepts are released.
+        The concept table stays resident, so it should be indexed after the generator is exhausted.
+
+        What is chunked is the annotation, expansion and indexing state. The file parsers return
+        every parsed element of a file as a list (and parse XML files whole), so the parsed but
+        not yet annotated elements of the file are still held in memory at the start.
+        """
+        # Create directory for storing temporary results
+        self.make_crawlspace()
+
+        expanded_concept_ids = set()
+        parsed_elements = self.parser(self.crawl_file)
+        if isinstance(parsed_elements, list):
+            # Take elements off the parser's list so annotated chunks aren't kept alive by it
+            parsed_elements = _drain(collections.deque(parsed_elements))
+        parsed_elements = iter(parsed_elements)
+        with open(f"{self.crawlspace}/element_file.json", "w") as variable_file:
+            while True:
+                self.elements = list(itertools.islice(parsed_elements, chunk_size))
+                if not self.elements:
+                    break
+
+                self.coerce_element_types(self.elements)
+                self.annotate_elements()
+
+                new_concepts = [concept for concept_id, concept in self.concepts.items()
+                                if concept_id not in expanded_concept_ids]
+                self.expand_concepts(new_concepts)
+                for concept in new_concepts:
+                    expanded_concept_ids.add(concept.id)
+                    self.elements += self.process_concept(concept)
+
+                self.finalize_elements(self.elements, variable_file)
+
+                yield self.elements, new_concepts
+
+                # Related terms now live in optional_terms, so the answer subgraphs can be dropped
+                for concept in new_concepts:
+                    concept.kg_answers = {}
+
+        self.elements = []
+
+        # Identifiers may have picked up search text from elements in later chunks
+        with open(f"{self.crawlspace}/concept_file.json", "w") as concept_file:
+            for concept_id, concept in self.concepts.items():
+                concept.set_search_terms()
+                concept.clean()
+                concept_file.write(f"{json.dumps(concept.get_searchable_dict(), indent=2)}")
+
+    def coerce_element_types(self, elements):
+        if self.element_type is None:
+            return
+        for element in elements:
+            if isinstance(element, DugElement):
+                element.type = self.element_type
+
+    def process_concept(self, concept) -> List[DugElement]:
+        """
+        Set search terms of an expanded concept and return any elements extracted from the graph
+        """
+        # Traverse identifiers to create single list of of search targets/synonyms for concept
+        concept.set_search_terms()
+
+        # Traverse kg answers to create list of optional search targets containing related concepts
+        concept.set_optional_terms()
+
+        # Remove duplicate search terms and optional search terms
+        concept.clean()
+
+        dug_elements_from_graph = []
+        if self.element_extraction:
+            for element_extraction_config in self.element_extraction:
+                casting_config = element_extraction_config['casting_config']
+                tranql_source = element_extraction_config['tranql_source']
+                dug_element_type = element_extraction_config['output_dug_type']
+                dug_elements_from_graph += self.expand_to_dug_element(
+                    concept=concept,
+                    casting_config=casting_config,
+                    dug_element_type=dug_element_type,
+                    tranql_source=tranql_source
+                )
+        return dug_elements_from_graph
+
+    @staticmethod
+    def finalize_elements(elements, variable_file):
+        # Set element optional terms now that concepts have been expanded and write them out
+        for element in elements:
+            if isinstance(element, DugElement):
+                element.set_optional_terms()
+                variable_file.write(f"{element.get_searchable_dict()}\n")
+
     def annotate_elements(self):
 
         # Annotate elements/concepts and create new concepts based on the ontology identifiers returned
         logger.info(f"annotate {len(self.elements)} elements")
-        for n, element in enumerate(self.elements):
+
+        # Annotator calls don't depend on crawler state, so they can be fetched up front (possibly
+        # concurrently). Identifiers are then merged in element order so results match a serial run.
+        annotations = self.fetch_annotations(self.elements)
+        for element, identifiers in zip(self.elements, annotations):
             # If element is actually a pre-loaded concept (e.g. TOPMed Tag), add that to list of concepts
             if isinstance(element, DugConcept):
                 self.concepts[element.id] = element
 
             # Annotate element with normalized ontology identifiers
-            logger.info(f"annotate element #{n+1}/{len(self.elements)} '{element.id}'")
-            self.annotate_element(element)
+            self.add_identifiers(element, identifiers)
             if isinstance(element, DugElement):
                 element.set_search_terms()
 
@@ -141,14 +227,57 @@ class Crawler:
             for concept_to_add in concepts_to_add:
                 element.add_concept(concept_to_add)
 
+    def fetch_annotations(self, elements) -> List[List[DugIdentifier]]:
+        """
+        Call the annotator for each element and return the identifiers in element order.
+        Up to `annotation_concurrency` annotator calls are kept in flight at once.
+        """
+        total = len(elements)
+        if self.annotation_batch_size > 1 and hasattr(self.annotator, "annotate_batch"):
+            return self.fetch_batch_annotations(elements)
+
+        def _annotate(numbered_element):
+            n, element = numbered_element
+            logger.info(f"annotate element #{n+1}/{total} '{element.id}'")
+            return self.annotator(text=element.ml_ready_desc, http_session=self.http_session)
+
+        if self.annotation_concurrency <= 1:
+            return [_annotate(numbered) for numbered in enumerate(elements)]
+
+        with ThreadPoolExecutor(max_workers=self.annotation_concurrency) as executor:
+            # executor.map yields results in submission order
+            return list(executor.map(_annotate, enumerate(elements)))
+
+    def fetch_batch_annotations(self, elements) -> List[List[DugIdentifier]]:
+        """
+        Annotate elements `annotation_batch_size` at a time with the annotator's annotate_batch.
+        Up to `annotation_concurrency` batches are kept in flight at once.
+        """
+        total = len(elements)
+        batches = [(start, elements[start:start + self.annotation_batch_size])
+                   for start in range(0, total, self.annotation_batch_size)]
+
+        def _annotate_batch(numbered_batch):
+            start, batch = numbered_batch
+            logger.info(f"annotate elements #{start+1}-{start+len(batch)}/{total}")
+            return self.annotator.annotate_batch([element.ml_ready_desc for element in batch],
+                                                 http_session=self.http_session)
+
+        if self.annotation_concurrency <= 1:
+            results = [_annotate_batch(numbered) for numbered in batches]
+        else:
+            with ThreadPoolExecutor(max_workers=self.annotation_concurrency) as executor:
+                results = list(executor.map(_annotate_batch, batches))
+        return [identifiers for batch_identifiers in results for identifiers in batch_identifiers]
+
     def annotate_element(self, element):
 
         # Annotate with a set of normalized ontology identifiers
-        # self.DugAnnotator.annotator()
         identifiers: List[DugIdentifier] = self.annotator(text=element.ml_ready_desc,
-                                              http_session=self.http_session)
-        # Future thoughts... should we be passing in the stpe DugIdentifier here instead?
+                                                          http_session=self.http_session)
+        self.add_identifiers(element, identifiers)
 
+    def add_identifiers(self, element, identifiers: List[DugIdentifier]):
 
         # Each identifier then becomes a concept that links elements together
         logger.info("Got %d identifiers for %s", len(identifiers) , element.ml_ready_desc)
@@ -176,29 +305,56 @@ class Crawler:
                 element.add_identifier(identifier)
 
     def expand_concept(self, concept):
+        self.expand_concepts([concept])
 
-        # Get knowledge graphs of terms related to each identifier
-        for ident_id, identifier in concept.identifiers.items():
+    def expand_concepts(self, concepts):
+        """
+        Get knowledge graphs of terms related to each identifier of each concept. Each
+        (identifier, query) pair is queried once, however many concepts share the identifier,
+        and up to `expansion_concurrency` TranQL queries are kept in flight at once; answers
+        are added to the concepts in the same order as a serial expansion would add them.
+        """
+        # (identifier, query name) pairs to expand, with the first concept asking for each
+        expansions = {}
+        requests = []
+        for concept in concepts:
+            for ident_id, identifier in concept.identifiers.items():
+
+                # Conditionally skip some identifiers if they are listed in config
+                if ident_id in self.exclude_identifiers:
+                    continue
 
-            # Conditionally skip some identifiers if they are listed in config
-            if ident_id in self.exclude_identifiers:
-                continue
+                # Use pre-defined queries to search for related knowledge graphs that include the identifier
+                for query_name, query_factory in self.tranql_queries.items():
 
-            # Use pre-defined queries to search for related knowledge graphs that include the identifier
-            for query_name, query_factory in self.tranql_queries.items():
+                    # Skip query if the identifier is not a valid query for the query class
+                    if not query_factory.is_valid_curie(ident_id):
+                        logger.info(f"identifier {ident_id} is not valid for query type {query_name}. Skipping!")
+                        continue
 
-                # Skip query if the identifier is not a valid query for the query class
-                if not query_factory.is_valid_curie(ident_id):
-                    logger.info(f"identifier {ident_id} is not valid for query type {query_name}. Skipping!")
-                    continue
+                    key = (ident_id, query_name)
+                    if key not in expansions:
+                        expansions[key] = (concept, ident_id, query_name, query_factory)
+                    requests.append((concept, key))
 
-                # Fetch kg and answer
-                kg_outfile = f"{self.crawlspace}/{ident_id}_{query_name}.json"
-                answers = self.tranqlizer.expand_identifier(ident_id, query_factory, kg_outfile)
+        answers = dict(zip(expansions, self.fetch_expansions(list(expansions.values()))))
+        for concept, key in requests:
+            # Add any answer knowledge graphs to the concept; concepts sharing an identifier share its answers
+            for answer in answers[key]:
+                concept.add_kg_answer(answer, query_name=key[1])
 
-                # Add any answer knowledge graphs to
-                for answer in answers:
-                    concept.add_kg_answer(answer, query_name=query_name)
+    def fetch_expansions(self, expansions):
+        def _expand(expansion):
+            concept, ident_id, query_name, query_factory = expansion
+            # Fetch kg and answer
+            kg_outfile = f"{self.crawlspace}/{ident_id}_{query_name}.json"
+            return self.tranqlizer.expand_identifier(ident_id, query_factory, kg_outfile)
+
+        if self.expansion_concurrency <= 1:
+            return [_expand(expansion) for expansion in expansions]
+
+        with ThreadPoolExecutor(max_workers=self.expansion_concurrency) as executor:
+            return list(executor.map(_expand, expansions))
 
     def expand_to_dug_element(self,
                               concept,
@@ -274,3 +430,8 @@ class Crawler:
                                 element.add_concept(concept)
                                 elements.append(element)
         return elements
+
+
+def _drain(elements: collections.deque):
+    while elements:
+        yield elements.popleft()
@@ -0,0 +1,92 @@
+"""
+Filtering and facet counting for grouped variable search results
+"""
+from typing import Any, Dict, Iterable, List, Set
+
+STUDY_NAME = "Study Name"
+
+
+class FacetIndex:
+    """
+    Matches every variable against every filter once, keeping one bitmask per variable of
+    the filters it satisfies. Filtered lists and facet counts (where each facet ignores its
+    own filter) are then mask comparisons, instead of re-running all filters per facet.
+
+    Filters are objects with a `key` and a list of `value`s. Keys match variable keys
+    case-insensitively, except "Study Name" which matches the c_name of any of the
+    variable's studies; values match case-insensitively. Filters are ANDed together.
+    """
+
+    def __init__(self, variables: List[Dict[str, Any]], filters: Iterable):
+        filters = list(filters)
+        self.variables = variables
+        self.filter_keys = [f.key.lower() for f in filters]
+        self._filter_values = [{str(v).lower() for v in f.value} for f in filters]
+        self._all_filters = (1 << len(filters)) - 1
+        self._masks = [self._match(variable) for variable in variables]
+
+    def _match(self, variable: Dict[str, Any]) -> int:
+        mask = 0
+        keys_lower = None
+        study_names = None
+        for i, (key, values) in enumerate(zip(self.filter_keys, self._filter_values)):
+            if key == STUDY_NAME.lower():
+                if study_names is None:
+                    study_names = [study['c_name'].lower() for study in variable.get('studies', [])]
+                matched = any(name in values for name in study_names)
+            else:
+                if keys_lower is None:
+                    keys_lower = {k.lower(): k for k in variable.keys()}
+                original_key = keys_lower.get(key)
+                matched = original_key is not None and str(variable.get(original_key, '')).lower() in values
+            if matched:
+                mask |= 1 << i
+        return mask
+
+    def _required(self, exclude_key: str = None) -> int:
+        required = self._all_filters
+        if exclude_key is not None:
+            for i, key in enumerate(self.filter_keys):
+                if key == exclude_key.lower():
+                    required &= ~(1 << i)
+        return required
+
+    def _passing(self, required: int):
+        return (variable for variable, mask in zip(self.variables, self._masks)
+                if mask & required == required)
+
+    def filter(self, exclude_key: str = None) -> List[Dict[str, Any]]:
+        """ Variables passing every filter, optionally ignoring the filters on exclude_key """
+        return list(self._passing(self._required(exclude_key)))
+
+    def counts(self, count_keys: Set[str]) -> Dict[str, Dict[str, int]]:
+        """
+        Value counts for each of count_keys plus "Study Name", keyed by title-cased facet name.
+        Each facet is counted over the variables that pass all filters but its own; facets
+        that share the same set of applicable filters are counted in a single pass.
+        """
+        facets_by_required: Dict[int, List[str]] = {}
+        for facet in sorted(count_keys | {STUDY_NAME}):
+            facets_by_required.setdefault(self._required(facet), []).append(facet)
+
+        facet_counts: Dict[str, Dict[str, int]] = {}
+        for required, facets in facets_by_required.items():
+            counts: Dict[str, Dict[str, int]] = {facet: {} for facet in facets}
+            study_facets = [facet for facet in facets if facet.lower() == STUDY_NAME.lower()]
+            value_facets = set(facets) - set(study_facets)
+
+            for variable in self._passing(required):
+                if study_facets:
+                    for study in variable.get('studies', []):
+                        study_name = study.get('c_name', 'Unknown Study')
+                        for facet in study_facets:
+                            counts[facet][study_name] = counts[facet].get(study_name, 0) + 1
+                for facet in value_facets.intersection(variable):
+                    value_raw = variable[facet]
+                    value = (str(value_raw) if value_raw is not None else "").title()
+                    counts[facet][value] = counts[facet].get(value, 0) + 1
+
+            for facet in facets:
+                if counts[facet]:
+                    facet_counts[facet.title()] = counts[facet]
+        return facet_counts
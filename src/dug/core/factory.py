@@ -1,22 +1,27 @@
-from typing import Dict
+from typing import Dict, Optional
 
 import redis
 from requests_cache import CachedSession
 
 import dug.core.tranql as tql
 from dug.core.concept_expander import ConceptExpander
+from dug.core.crawl_manifest import CrawlManifest
 from dug.config import Config as DugConfig, TRANQL_SOURCE
+from dug.core.async_crawler import AsyncCrawler
 from dug.core.crawler import Crawler
 from dug.core.parsers import Parser
 from dug.core.annotators import Annotator
 from dug.core.async_search import Search
 from dug.core.index import Index
+from dug.core.kg_store import KGAnswerStore
 
 
 class DugFactory:
 
     def __init__(self, config: DugConfig):
         self.config = config
+        self._kg_store = None
+        self._crawl_manifest = None
 
     def build_http_session(self) -> CachedSession:
 
@@ -33,7 +38,7 @@ class DugFactory:
         )
 
     def build_crawler(self, target, parser: Parser, annotator: Annotator, element_type: str, tranql_source=None) -> Crawler:
-        crawler = Crawler(
+        crawler_args = dict(
             crawl_file=str(target),
             parser=parser,
             annotator=annotator,
@@ -43,12 +48,41 @@ class DugFactory:
             exclude_identifiers=self.config.tranql_exclude_identifiers,
             element_type=element_type,
             element_extraction=self.build_element_extraction_parameters(),
+            annotation_concurrency=self.config.annotation_concurrency,
+            annotation_batch_size=self.config.annotation_batch_size,
+            expansion_concurrency=self.config.expansion_concurrency,
         )
 
-        return crawler
+        if self.config.crawler_engine == "async":
+            return AsyncCrawler(
+                service_limits=self.config.async_service_limits,
+                element_concurrency=self.config.async_element_concurrency,
+                http_timeout=self.config.async_http_timeout,
+                **crawler_args
+            )
+        if self.config.crawler_engine != "sync":
+            raise ValueError(f"Unknown crawler engine '{self.config.crawler_engine}', expected 'sync' or 'async'")
+        return Crawler(**crawler_args)
 
     def build_tranqlizer(self) -> ConceptExpander:
-        return ConceptExpander(**self.config.concept_expander)
+        return ConceptExpander(**{
+            "pool_size": max(self.config.expansion_concurrency, 10),
+            "store": self.build_kg_store(),
+            **self.config.concept_expander
+        })
+
+    def build_kg_store(self) -> Optional[KGAnswerStore]:
+        # One store per factory; its connection is shared by every crawler built here
+        if not self.config.kg_store_path:
+            return None
+        if self._kg_store is None:
+            self._kg_store = KGAnswerStore(self.config.kg_store_path)
+        return self._kg_store
+
+    def build_crawl_manifest(self) -> CrawlManifest:
+        if self._crawl_manifest is None:
+            self._crawl_manifest = CrawlManifest(self.config.crawl_manifest_path)
+        return self._crawl_manifest
 
     def build_tranql_queries(self, source=None) -> Dict[str, tql.QueryFactory]:
 
@@ -2,14 +2,22 @@
 This class is used for adding documents to elastic search index
 """
 import logging
+from datetime import datetime, timezone
 
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, NotFoundError, helpers
 import ssl
 
 from dug.config import Config
 
 logger = logging.getLogger('dug')
 
+# Key in each index's mapping _meta that changes whenever a crawl is indexed
+GENERATION_META_KEY = "dug_generation"
+
+# Key in the studies and programs indices' mapping _meta set once their summaries cover every
+# study in the variables index, so search doesn't trust summaries of only some studies
+SUMMARIES_META_KEY = "dug_summaries_complete"
+
 
 class Index:
     def __init__(self, cfg: Config, indices=None):
@@ -156,10 +164,44 @@ class Index:
             }
         }
 
+        # Study and program summaries, rebuilt from the variables index after each crawl
+        studies_index = {
+            "settings": {
+                "number_of_shards": 1,
+                "number_of_replicas": self.replicas
+            },
+            "mappings": {
+                "dynamic": "strict",
+                "properties": {
+                    "collection_id": {"type": "keyword"},
+                    "collection_name": {"type": "text"},
+                    "collection_action": {"type": "keyword", "index": False},
+                    "data_type": {"type": "text", "fields": {"keyword": {"type": "keyword"}}},
+                    "variable_count": {"type": "integer"}
+                }
+            }
+        }
+        programs_index = {
+            "settings": {
+                "number_of_shards": 1,
+                "number_of_replicas": self.replicas
+            },
+            "mappings": {
+                "dynamic": "strict",
+                "properties": {
+                    "program_name": {"type": "keyword"},
+                    "variable_count": {"type": "integer"},
+                    "study_count": {"type": "integer"}
+                }
+            }
+        }
+
         settings = {
             'kg_index': kg_index,
             'concepts_index': concepts_index,
             'variables_index': variables_index,
+            'studies_index': studies_index,
+            'programs_index': programs_index,
         }
 
         logger.info(f"creating indices")
@@ -183,6 +225,25 @@ class Index:
                 logger.error(f"exception: {e}")
                 raise e
 
+    def update_generation(self):
+        """
+        Record a new index generation in the mapping _meta of every index, so search
+        caches know their results are stale. Called once a crawl has been indexed.
+        """
+        generation = datetime.now(timezone.utc).isoformat()
+        for index in self.indices:
+            self.put_meta(index, **{GENERATION_META_KEY: generation})
+        logger.info(f"Index generation is now {generation}")
+        return generation
+
+    def get_meta(self, index) -> dict:
+        mappings = self.es.indices.get_mapping(index=index)
+        return mappings[index]["mappings"].get("_meta", {})
+
+    def put_meta(self, index, **values):
+        # put_mapping replaces the whole _meta, so merge with what's there
+        self.es.indices.put_mapping(index=index, meta={**self.get_meta(index), **values})
+
     def index_doc(self, index, doc, doc_id):
         self.es.index(
             index=index,
@@ -222,6 +283,16 @@ class Index:
             self.update_doc(index=index, doc=doc, doc_id=elem.get_id())
 
     def index_kg_answer(self, concept_id, kg_answer, index, id_suffix=None):
+        unique_doc_id, doc = self.get_kg_answer_doc(concept_id, kg_answer, id_suffix)
+
+        """ Index the document. """
+        self.index_doc(
+            index=index,
+            doc=doc,
+            doc_id=unique_doc_id)
+
+    @staticmethod
+    def get_kg_answer_doc(concept_id, kg_answer, id_suffix=None):
 
         # Get search targets by extracting names/synonyms from non-curie nodes in answer knoweldge graph
         search_targets = kg_answer.get_node_names(include_curie=False)
@@ -238,12 +309,234 @@ class Index:
         logger.debug("Indexing TranQL query answer...")
         id_suffix = list(kg_answer.nodes.keys()) if id_suffix is None else id_suffix
         unique_doc_id = f"{concept_id}_{id_suffix}"
+        return unique_doc_id, doc
+
+    def bulk_index(self, actions):
+        """
+        Send an iterable of bulk actions to elasticsearch through the _bulk API, chunk_size
+        actions per request. Failed items are logged rather than raised, except that a 409 on
+        a create action just means the document is already indexed, and a 404 on a delete
+        that it is already gone.
+        Returns the ids of the documents whose actions failed.
+        """
+        failed = []
+        for ok, item in helpers.streaming_bulk(self.es,
+                                               actions,
+                                               chunk_size=self._cfg.elastic_bulk_chunk_size,
+                                               raise_on_error=False):
+            if ok:
+                continue
+            op_type, result = next(iter(item.items()))
+            if op_type == "create" and result.get("status") == 409:
+                continue
+            if op_type == "delete" and result.get("status") == 404:
+                continue
+            failed.append(result.get('_id'))
+            logger.error(f"Failed to {op_type} document {result.get('_id')} in {result.get('_index')}: "
+                         f"{result.get('error')}")
+        return failed
+
+    def bulk_index_concepts(self, concepts, index):
+        # "create" leaves concepts that are already in the index untouched
+        actions = ({
+            "_op_type": "create",
+            "_index": index,
+            "_id": concept.id,
+            "_source": concept.get_searchable_dict()
+        } for concept in concepts)
+        return self.bulk_index(actions)
+
+    def bulk_index_elements(self, elements, index):
+        # Upsert, merging in any new identifiers that weren't there last time around
+        actions = ({
+            "_op_type": "update",
+            "_index": index,
+            "_id": elem.get_id(),
+            "script": {
+                "lang": "painless",
+                "source": MERGE_IDENTIFIERS_SCRIPT,
+                "params": {"identifiers": list(elem.concepts.keys())}
+            },
+            "upsert": elem.get_searchable_dict()
+        } for elem in elements)
+        return self.bulk_index(actions)
+
+    def bulk_replace_elements(self, elements, index):
+        # Overwrite elements whose content changed, dropping identifiers from earlier crawls
+        actions = ({
+            "_op_type": "index",
+            "_index": index,
+            "_id": elem.get_id(),
+            "_source": elem.get_searchable_dict()
+        } for elem in elements)
+        return self.bulk_index(actions)
+
+    def bulk_delete(self, doc_ids, index):
+        actions = ({
+            "_op_type": "delete",
+            "_index": index,
+            "_id": doc_id
+        } for doc_id in doc_ids)
+        return self.bulk_index(actions)
+
+    def bulk_index_kg_answers(self, concepts, index):
+        def actions():
+            for concept in concepts:
+                for kg_answer_id, kg_answer in concept.kg_answers.items():
+                    doc_id, doc = self.get_kg_answer_doc(concept.id, kg_answer, kg_answer_id)
+                    yield {
+                        "_op_type": "index",
+                        "_index": index,
+                        "_id": doc_id,
+                        "_source": doc
+                    }
+        return self.bulk_index(actions())
+
+
+    def update_summaries(self, collection_ids, variables_index, studies_index, programs_index,
+                         program_names=()):
+        """
+        Recompute the study documents for collection_ids, and the program documents of the
+        programs (data types) those studies belong or belonged to, plus program_names, from
+        what's in the variables index. Studies and programs that no longer have any variables
+        are deleted. Counts are read back from elasticsearch rather than tallied during the
+        crawl, so re-crawling a study doesn't double count its variables.
+        """
+        collection_ids = sorted({collection_id for collection_id in collection_ids if collection_id})
+        if not collection_ids and not program_names:
+            return
+        self.es.indices.refresh(index=variables_index)
+
+        # Programs the studies were summarized in before, which need recounting if a study left them
+        programs = set(program_names) | self._summarized_programs(collection_ids, studies_index)
+        study_docs = []
+        summarized = set()
+        for start in range(0, len(collection_ids), SUMMARY_BATCH_SIZE):
+            batch = collection_ids[start:start + SUMMARY_BATCH_SIZE]
+            result = self.es.search(
+                index=variables_index,
+                size=0,
+                query={"terms": {"collection_id.keyword": batch}},
+                aggs={"studies": {
+                    "terms": {"field": "collection_id.keyword", "size": len(batch)},
+                    "aggs": {
+                        "details": {"top_hits": {
+                            "_source": ["collection_id", "collection_name", "collection_action"],
+                            "size": 1
+                        }},
+                        "programs": {"terms": {"field": "data_type.keyword", "size": 100}}
+                    }
+                }})
+            for bucket in result["aggregations"]["studies"]["buckets"]:
+                study_programs = [program["key"] for program in bucket["programs"]["buckets"]]
+                programs.update(study_programs)
+                summarized.add(bucket["key"])
+                study_docs.append({
+                    "_op_type": "index",
+                    "_index": studies_index,
+                    "_id": bucket["key"],
+                    "_source": {
+                        **bucket["details"]["hits"]["hits"][0]["_source"],
+                        "data_type": study_programs,
+                        "variable_count": bucket["doc_count"]
+                    }
+                })
+        removed_studies = [collection_id for collection_id in collection_ids if collection_id not in summarized]
+        self.bulk_index(study_docs + [{"_op_type": "delete", "_index": studies_index, "_id": collection_id}
+                                      for collection_id in removed_studies])
+
+        if not programs:
+            return
+        result = self.es.search(
+            index=variables_index,
+            size=0,
+            query={"terms": {"data_type.keyword": sorted(programs)}},
+            aggs={"programs": {
+                "terms": {"field": "data_type.keyword", "size": len(programs)},
+                "aggs": {"study_count": {"cardinality": {"field": "collection_id.keyword"}}}
+            }})
+        program_docs = [{
+            "_op_type": "index",
+            "_index": programs_index,
+            "_id": bucket["key"],
+            "_source": {
+                "program_name": bucket["key"],
+                "variable_count": bucket["doc_count"],
+                "study_count": bucket["study_count"]["value"]
+            }
+        } for bucket in result["aggregations"]["programs"]["buckets"]]
+        counted = {doc["_id"] for doc in program_docs}
+        removed_programs = sorted(program for program in programs if program not in counted)
+        self.bulk_index(program_docs + [{"_op_type": "delete", "_index": programs_index, "_id": program}
+                                        for program in removed_programs])
+        logger.info(f"Updated summaries of {len(study_docs)} studies in {len(counted)} programs, "
+                    f"removed {len(removed_studies)} studies and {len(removed_programs)} programs")
+
+    def _summarized_programs(self, collection_ids, studies_index) -> set:
+        programs = set()
+        for start in range(0, len(collection_ids), SUMMARY_BATCH_SIZE):
+            try:
+                result = self.es.mget(index=studies_index, ids=collection_ids[start:start + SUMMARY_BATCH_SIZE],
+                                      source=["data_type"])
+            except NotFoundError:
+                return programs
+            for doc in result["docs"]:
+                if doc.get("found"):
+                    programs.update(doc["_source"].get("data_type", []))
+        return programs
+
+    def summaries_complete(self, studies_index, programs_index) -> bool:
+        try:
+            return all(self.get_meta(index).get(SUMMARIES_META_KEY) for index in (studies_index, programs_index))
+        except NotFoundError:
+            return False
+
+    def rebuild_summaries(self, variables_index, studies_index, programs_index):
+        """
+        Summarize every study in the variables index, and delete summaries of studies and
+        programs that are gone, then mark the summaries complete. Run by a crawl when the
+        summary indices aren't marked complete, e.g. on the first crawl of indices built
+        before summaries were.
+        """
+        self.es.indices.refresh(index=variables_index)
+        collection_ids = set()
+        after = None
+        while True:
+            composite = {"size": SUMMARY_BATCH_SIZE, "sources": [{"collection_id": {"terms": {"field": "collection_id.keyword"}}}]}
+            if after is not None:
+                composite["after"] = after
+            result = self.es.search(index=variables_index, size=0, aggs={"studies": {"composite": composite}})
+            buckets = result["aggregations"]["studies"]["buckets"]
+            collection_ids.update(bucket["key"]["collection_id"] for bucket in buckets)
+            after = result["aggregations"]["studies"].get("after_key")
+            if len(buckets) < SUMMARY_BATCH_SIZE or after is None:
+                break
+
+        # Summaries left from studies and programs that have since been removed
+        collection_ids.update(hit["_id"] for hit in helpers.scan(self.es, index=studies_index, _source=False))
+        program_names = [hit["_id"] for hit in helpers.scan(self.es, index=programs_index, _source=False)]
+
+        self.update_summaries(collection_ids, variables_index, studies_index, programs_index,
+                              program_names=program_names)
+        for index in (studies_index, programs_index):
+            self.put_meta(index, **{SUMMARIES_META_KEY: True})
+        logger.info(f"Rebuilt summaries of {len(collection_ids)} studies")
+
+
+# Number of studies summarized per aggregation request
+SUMMARY_BATCH_SIZE = 1000
+
+MERGE_IDENTIFIERS_SCRIPT = """
+if (ctx._source.identifiers == null) {
+    ctx._source.identifiers = [];
+}
+for (identifier in params.identifiers) {
+    if (!ctx._source.identifiers.contains(identifier)) {
+        ctx._source.identifiers.add(identifier);
+    }
+}
+"""
 
-        """ Index the document. """
-        self.index_doc(
-            index=index,
-            doc=doc,
-            doc_id=unique_doc_id)
 
 class SearchException(Exception):
     def __init__(self, message, details):
@@ -0,0 +1,129 @@
+"""
+Single-file store for TranQL responses, replacing the per-identifier JSON files
+that used to be written into the crawlspace
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import zlib
+from typing import Dict, List, Optional
+
+logger = logging.getLogger('dug')
+
+
+class KGAnswerStore:
+    """
+    SQLite table of zlib-compressed TranQL responses keyed by (curie, query, source), where
+    query is the question graph of the query (e.g. "disease->phenotypic_feature").
+    The connection is shared between expansion threads; WAL mode lets crawl worker
+    processes read and write the same file.
+    """
+
+    def __init__(self, path, compression_level=6):
+        self.path = path
+        self.compression_level = compression_level
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS kg_responses ("
+                "curie TEXT NOT NULL, query TEXT NOT NULL, source TEXT NOT NULL, response BLOB NOT NULL, "
+                "PRIMARY KEY (curie, query, source)) WITHOUT ROWID"
+            )
+
+    @staticmethod
+    def query_key(query_factory) -> str:
+        return "->".join(query_factory.question_graph)
+
+    def exists(self, curie, query, source) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM kg_responses WHERE curie=? AND query=? AND source=?",
+                (curie, query, source)).fetchone()
+        return row is not None
+
+    def get(self, curie, query, source) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM kg_responses WHERE curie=? AND query=? AND source=?",
+                (curie, query, source)).fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, curie, query, source, response: dict):
+        self.put_many([(curie, query, source, response)])
+
+    def put_many(self, entries):
+        rows = [(curie, query, source, self._compress(response))
+                for curie, query, source, response in entries]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO kg_responses (curie, query, source, response) VALUES (?, ?, ?, ?)",
+                rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM kg_responses").fetchone()[0]
+
+    def _compress(self, response: dict) -> bytes:
+        return zlib.compress(json.dumps(response, separators=(",", ":")).encode("utf-8"),
+                             self.compression_level)
+
+
+def migrate_crawlspace(crawlspace, store: KGAnswerStore, tranql_queries: Dict[str, List[str]],
+                       source, remove=False, batch_size=1000) -> int:
+    """
+    Load the <curie>_<query name>.json files of an existing crawlspace into a KGAnswerStore.
+    tranql_queries maps query names to question graphs, as in Config.tranql_queries. Files of
+    queries that aren't listed (e.g. element extraction answers) are left in place.
+    Returns the number of responses migrated.
+    """
+    # Longest names first so "chem_to_disease" isn't taken for "disease"
+    query_names = sorted(tranql_queries, key=len, reverse=True)
+    migrated = 0
+    batch, batch_files = [], []
+
+    def flush():
+        nonlocal migrated
+        store.put_many(batch)
+        migrated += len(batch)
+        if remove:
+            for filename in batch_files:
+                os.remove(filename)
+        batch.clear()
+        batch_files.clear()
+
+    for entry in os.scandir(crawlspace):
+        if not entry.is_file() or not entry.name.endswith(".json"):
+            continue
+        stem = entry.name[:-len(".json")]
+        query_name = next((name for name in query_names if stem.endswith(f"_{name}")), None)
+        if query_name is None:
+            logger.debug(f"Skipping {entry.path}, not a TranQL answer file for a known query")
+            continue
+        curie = stem[:-len(f"_{query_name}")]
+        try:
+            with open(entry.path) as stream:
+                response = json.load(stream)
+        except ValueError as e:
+            logger.warning(f"Skipping unreadable answer file {entry.path}: {e}")
+            continue
+        batch.append((curie, "->".join(tranql_queries[query_name]), source, response))
+        batch_files.append(entry.path)
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+
+    logger.info(f"Migrated {migrated} TranQL answers from {crawlspace} to {store.path}")
+    return migrated
@@ -0,0 +1,105 @@
+"""
+In-memory catalog of the programs and studies listed in the STUDIES_PATH JSON file
+"""
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List
+
+logger = logging.getLogger('dug')
+
+
+class ProgramCatalog:
+    """
+    Loads the studies file once and indexes it by lower-cased program name, along with
+    the program summary served by /program_list. The file's mtime is checked at most
+    every `reload_interval` seconds and the catalog is rebuilt when it changes.
+
+    Returned lists are shared between requests and must not be modified.
+    """
+
+    def __init__(self, path, reload_interval=30):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked_at = None
+        self._collections: List[Dict[str, str]] = []
+        self._collections_by_program: Dict[str, List[Dict[str, str]]] = {}
+        self._program_summary: List[dict] = []
+
+    def get_collections(self, program_name=None) -> List[Dict[str, str]]:
+        """ Studies of a program (matched case-insensitively), or of every program """
+        self._refresh()
+        if not program_name:
+            return self._collections
+        return self._collections_by_program.get(program_name.lower(), [])
+
+    def get_program_summary(self) -> List[dict]:
+        self._refresh()
+        return self._program_summary
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.reload_interval:
+            return
+        with self._lock:
+            if self._checked_at is not None and now - self._checked_at < self.reload_interval:
+                return
+            mtime = os.stat(self.path).st_mtime
+            if mtime != self._mtime:
+                self._load()
+                self._mtime = mtime
+            self._checked_at = now
+
+    def _load(self):
+        logger.info(f"Loading program catalog from {self.path}")
+        with open(self.path, 'r') as file:
+            studies = json.load(file)
+
+        collections = []
+        collections_by_program = {}
+        program_studies = {}
+        program_descriptions = {}
+
+        for study in studies:
+            program = study.get('Program', '')
+            collection_id = study.get('Accession', '')
+
+            if program not in program_studies:
+                program_studies[program] = 0
+                program_descriptions[program] = study.get('Description', '')
+            program_studies[program] += 1
+
+            if not program or not collection_id:
+                continue
+
+            # Extract base accession for URL to dbgap
+            accession_base = collection_id.split('.c')[0] if '.c' in collection_id else collection_id
+            collection = {
+                "collection_id": collection_id,
+                "collection_action": f"https://www.ncbi.nlm.nih.gov/projects/gap/cgi-bin/study.cgi?study_id={accession_base}",
+                "collection_name": study.get('Study Name', '')
+            }
+            collections.append(collection)
+            collections_by_program.setdefault(program.lower(), []).append(collection)
+
+        collections.sort(key=lambda x: x["collection_id"])
+        for program_collections in collections_by_program.values():
+            program_collections.sort(key=lambda x: x["collection_id"])
+
+        program_summary = [{
+            "key": program_name,
+            "doc_count": count,
+            "No_of_studies": {"value": count},
+            "description": program_descriptions[program_name],
+            "parent_program": [""]
+        } for program_name, count in program_studies.items()]
+        # Sort by program name
+        program_summary.sort(key=lambda x: x["key"])
+
+        self._collections = collections
+        self._collections_by_program = collections_by_program
+        self._program_summary = program_summary
@@ -0,0 +1,175 @@
+"""
+Result cache for the search API, invalidated when a crawl changes the indices
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import redis.asyncio
+
+logger = logging.getLogger('dug')
+
+
+class SearchCache:
+    """
+    TTL + LRU cache of search results keyed by endpoint and normalized request parameters.
+
+    Entries are tagged with the index generation (see Index.update_generation) that was
+    current when they were cached. The generation is looked up at most once every
+    `generation_interval` seconds; when it changes, the in-process entries are dropped and
+    redis entries, whose keys include the generation, stop being read and age out by TTL.
+
+    With a redis client, results are shared between API replicas through redis and the
+    in-process LRU is not used.
+    """
+
+    def __init__(self, ttl=300, maxsize=1024, get_generation=None, generation_interval=30,
+                 redis_client=None, key_prefix="dug:search"):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.get_generation = get_generation
+        self.generation_interval = generation_interval
+        self.redis = redis_client
+        self.key_prefix = key_prefix
+        self.generation = None
+        self._generation_checked_at = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @classmethod
+    def from_config(cls, cfg, get_generation=None):
+        redis_client = None
+        if cfg.search_cache_redis:
+            redis_client = redis.asyncio.StrictRedis(host=cfg.redis_host,
+                                                     port=cfg.redis_port,
+                                                     password=cfg.redis_password)
+        return cls(ttl=cfg.search_cache_ttl,
+                   maxsize=cfg.search_cache_size,
+                   get_generation=get_generation,
+                   generation_interval=cfg.search_cache_generation_interval,
+                   redis_client=redis_client)
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and (self.redis is not None or self.maxsize > 0)
+
+    @staticmethod
+    def make_key(endpoint, params) -> str:
+        params = dict(params)
+        query = params.get("query")
+        if isinstance(query, str):
+            # Spacing doesn't change results, but case can: query_string only treats
+            # uppercase AND/OR/NOT as operators
+            params["query"] = " ".join(query.split())
+        normalized = json.dumps(params, sort_keys=True, default=str)
+        return f"{endpoint}:{hashlib.sha1(normalized.encode('utf-8')).hexdigest()}"
+
+    async def get_or_fetch(self, endpoint, params, fetch):
+        """
+        Return the cached result for endpoint/params, calling `await fetch()` on a miss
+        """
+        if not self.enabled:
+            return await fetch()
+
+        await self._check_generation()
+        key = self.make_key(endpoint, params)
+        result = await self._get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+
+        self.misses += 1
+        result = await fetch()
+        # elasticsearch responses wrap the JSON body
+        result = getattr(result, "body", result)
+        await self._put(key, result)
+        return result
+
+    async def _check_generation(self):
+        if self.get_generation is None:
+            return
+        now = time.monotonic()
+        if self._generation_checked_at is not None and \
+                now - self._generation_checked_at < self.generation_interval:
+            return
+        self._generation_checked_at = now
+        try:
+            generation = await self.get_generation()
+        except Exception as e:
+            logger.warning(f"Unable to read index generation, keeping cached results: {e}")
+            return
+        if generation != self.generation:
+            if self.generation is not None:
+                logger.info(f"Index generation changed to {generation}, invalidating search cache")
+                self.invalidations += 1
+            self.generation = generation
+            self.clear()
+
+    async def _get(self, key):
+        if self.redis is not None:
+            try:
+                cached = await self.redis.get(self._redis_key(key))
+            except Exception as e:
+                logger.warning(f"Search cache lookup failed: {e}")
+                return None
+            return json.loads(cached) if cached is not None else None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, result = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return result
+
+    async def _put(self, key, result):
+        if self.redis is not None:
+            try:
+                await self.redis.set(self._redis_key(key), json.dumps(result), ex=self.ttl)
+            except Exception as e:
+                logger.warning(f"Search cache store failed: {e}")
+            return
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _redis_key(self, key):
+        return f"{self.key_prefix}:{self.generation}:{key}"
+
+    async def close(self):
+        if self.redis is not None:
+            await self.redis.aclose()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "backend": "redis" if self.redis is not None else "memory",
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "generation": self.generation,
+        }
@@ -1,19 +1,50 @@
+import json
 import logging
 import os
 import uvicorn
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from dug.config import Config
 from dug.core.async_search import Search
+from dug.core.facets import FacetIndex
+from dug.core.search_cache import SearchCache
 from pydantic import BaseModel
 from typing import List, Dict, Set, Any
-import asyncio
 from typing import Optional, Any
 
 logger = logging.getLogger (__name__)
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The search client and cache belong to the server's event loop: built on startup,
+    # warmed before taking traffic and closed on shutdown
+    config = Config.from_env()
+    search = Search(config)
+    search_cache = SearchCache.from_config(config, get_generation=search.get_index_generation)
+    app.state.search = search
+    app.state.search_cache = search_cache
+    await search.warmup()
+    try:
+        yield
+    finally:
+        await search_cache.close()
+        await search.es.close()
+
+
+def get_search(request: Request) -> Search:
+    return request.app.state.search
+
+
+def get_search_cache(request: Request) -> SearchCache:
+    return request.app.state.search_cache
+
+
 APP = FastAPI(
+    lifespan=lifespan,
     title="Dug Search API",
     root_path=os.environ.get("ROOT_PATH", ""),
     terms_of_service=os.environ.get("DUG_TOS_URL", None),
@@ -30,6 +61,13 @@ APP.add_middleware(
 class GetFromIndex(BaseModel):
     index: str = "concepts_index"
     size: int = 0
+    # Stream hits as NDJSON instead of returning one JSON document
+    stream: bool = False
+    # Streaming only: _source fields to return, and a cursor to resume from
+    # (the X-Dug-Pit-Id header and the sort values of the last hit received)
+    fields: Optional[List[str]] = None
+    pit_id: Optional[str] = None
+    search_after: Optional[List[Any]] = None
 
 
 class SearchConceptQuery(BaseModel):
@@ -38,6 +76,11 @@ class SearchConceptQuery(BaseModel):
     offset: int = 0
     size: int = 20
     types: list = None
+    explain: bool = False
+
+class ExplainConceptQuery(BaseModel):
+    query: str
+    concept_id: str
 
 class SearchVariablesQuery(BaseModel):
     query: str
@@ -71,66 +114,100 @@ class SearchProgramQuery(BaseModel):
     #index: str = "variables_index"
     size:int = 100   
 
-search = Search(Config.from_env())
 
-@APP.on_event("shutdown")
-def shutdown_event():
-    asyncio.run(search.es.close())
+
+async def cached_search(search_cache, endpoint, search_method, params):
+    return await search_cache.get_or_fetch(endpoint, params, lambda: search_method(**params))
+
+
+@APP.get('/cache_stats')
+async def cache_stats(search_cache: SearchCache = Depends(get_search_cache)):
+    return {
+        "message": "Search cache statistics",
+        "result": search_cache.stats(),
+        "status": "success"
+    }
 
 
 @APP.post('/dump_concepts')
-async def dump_concepts(request: GetFromIndex):
+async def dump_concepts(request: GetFromIndex, search: Search = Depends(get_search)):
+    if request.stream:
+        pit_id = request.pit_id or await search.open_dump(request.index)
+
+        async def ndjson():
+            async for hit in search.stream_docs(pit_id, size=request.size, fields=request.fields,
+                                                search_after=request.search_after):
+                yield json.dumps(hit) + "\n"
+
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson",
+                                 headers={"X-Dug-Pit-Id": pit_id})
     return {
         "message": "Dump result",
-        "result": await search.dump_concepts(**request.dict()),
+        "result": await search.dump_concepts(**request.dict(include={"index", "size"})),
         "status": "success"
     }
 
 
 @APP.get('/agg_data_types')
-async def agg_data_types():
+async def agg_data_types(search: Search = Depends(get_search),
+                         search_cache: SearchCache = Depends(get_search_cache)):
     return {
         "message": "Dump result",
-        "result": await search.agg_data_type(),
+        "result": await search_cache.get_or_fetch("agg_data_types", {}, search.agg_data_type),
         "status": "success"
     }
 
 
 @APP.post('/search')
-async def search_concepts(search_query: SearchConceptQuery):
+async def search_concepts(search_query: SearchConceptQuery, search: Search = Depends(get_search),
+                          search_cache: SearchCache = Depends(get_search_cache)):
     return {
         "message": "Search result",
         # Although index in provided by the query we will keep it around for backward compatibility, but
         # search concepts should always search against "concepts_index"
-        "result": await search.search_concepts(**search_query.dict(exclude={"index"})),
+        "result": await cached_search(search_cache, "search", search.search_concepts, search_query.dict(exclude={"index"})),
+        "status": "success"
+    }
+
+
+@APP.post('/explain_concept')
+async def explain_concept(explain_query: ExplainConceptQuery, search: Search = Depends(get_search)):
+    """
+    Debugging aid: explains how a single concept scores against a concept search query.
+    """
+    return {
+        "message": "Explain result",
+        "result": await search.explain_concept(**explain_query.dict()),
         "status": "success"
     }
 
 
 @APP.post('/search_kg')
-async def search_kg(search_query: SearchKgQuery):
+async def search_kg(search_query: SearchKgQuery, search: Search = Depends(get_search),
+                    search_cache: SearchCache = Depends(get_search_cache)):
     return {
         "message": "Search result",
         # Although index in provided by the query we will keep it around for backward compatibility, but
         # search concepts should always search against "kg_index"
-        "result": await search.search_kg(**search_query.dict(exclude={"index"})),
+        "result": await cached_search(search_cache, "search_kg", search.search_kg, search_query.dict(exclude={"index"})),
         "status": "success"
     }
 
 
 @APP.post('/search_var')
-async def search_var(search_query: SearchVariablesQuery):
+async def search_var(search_query: SearchVariablesQuery, search: Search = Depends(get_search),
+                     search_cache: SearchCache = Depends(get_search_cache)):
     return {
         "message": "Search result",
         # Although index in provided by the query we will keep it around for backward compatibility, but
         # search concepts should always search against "variables_index"
-        "result": await search.search_variables(**search_query.dict(exclude={"index"})),
+        "result": await cached_search(search_cache, "search_var", search.search_variables, search_query.dict(exclude={"index"})),
         "status": "success"
     }
 
 
 @APP.post('/search_var_grouped')
-async def search_var_grouped(search_query: SearchVariablesQueryFiltered):
+async def search_var_grouped(search_query: SearchVariablesQueryFiltered, search: Search = Depends(get_search)):
     """
     Searches for variables, groups them by variable ID across studies.
     Filters the variables based on provided criteria for the main results list.
@@ -194,85 +271,19 @@ async def search_var_grouped(search_query: SearchVariablesQueryFiltered):
         if var_info:
             final_variables.append(var_info)
 
-    # --- 5. Filtering Variables Based on Request Criteria (Helper Function) ---
-    def filter_variables(vars_to_filter: List[Dict[str, Any]], filters: List[FilterGrouped]) -> List[Dict[str, Any]]:
-        """
-        Filters a list of variables based on a list of filter criteria.
-        Used both for the final result list and for calculating faceted aggregations.
-        """
-        filtered_vars = vars_to_filter.copy()
-        for f_group in filters:
-            to_keep: List[Dict[str, Any]] = []
-            filter_key_lower = f_group.key.lower()
-            filter_values_lower = [str(v).lower() for v in f_group.value]
-
-            for var in filtered_vars:
-                if filter_key_lower == "study name":
-                    study_names_in_var = [study['c_name'].lower() for study in var.get('studies', [])]
-                    if any(s_name in filter_values_lower for s_name in study_names_in_var):
-                        to_keep.append(var)
-                else:
-                    var_keys_lower_map = {key.lower(): key for key in var.keys()}
-                    if filter_key_lower in var_keys_lower_map:
-                        original_key = var_keys_lower_map[filter_key_lower]
-                        # Handle potential non-string values during filtering comparison
-                        var_value_str = str(var.get(original_key, '')) # Get value safely and convert to string
-                        var_value_lower = var_value_str.lower()
-                        if var_value_lower in filter_values_lower:
-                            to_keep.append(var)
-
-            filtered_vars = to_keep
-            if not filtered_vars:
-                break
-        return filtered_vars
+    # --- 5. Matching Variables Against Request Criteria ---
+    # Each variable is checked against each filter once; the response list and every facet
+    # below reuse those matches
+    facet_index = FacetIndex(final_variables, search_query.filter)
 
     # --- 6. Calculate Final Filtered List for Response ---
     # Apply *all* filters to get the list of variables to return in the response
-    filtered_variables_for_response = filter_variables(final_variables, filters=search_query.filter)
+    filtered_variables_for_response = facet_index.filter()
 
     # --- 7. Calculating Faceted Aggregation Counts ---
-    agg_counts: Dict[str, Dict[str, int]] = {}
-    # Define all categories for which we want aggregations
-    all_aggregation_keys_original_case = count_keys | {"Study Name"} # Use original case for display keys later
-
-    # Iterate through each potential aggregation category
-    for agg_key_orig in all_aggregation_keys_original_case:
-        agg_key_lower = agg_key_orig.lower()
-        display_key = agg_key_orig.title() # Key used in the response JSON (e.g., "DataType", "Study Name")
-
-        # Determine filters to apply for *this* aggregation calculation
-        # Exclude the filter matching the current aggregation key (case-insensitive)
-        filters_for_this_agg = [
-            f for f in search_query.filter if f.key.lower() != agg_key_lower
-        ]
-
-        # Apply these filters to the *original* set of variables (`final_variables`)
-        temp_filtered_vars = filter_variables(final_variables, filters=filters_for_this_agg)
-
-        # Calculate counts for the current aggregation key based on the temp_filtered_vars
-        current_key_counts: Dict[str, int] = {}
-        if agg_key_lower == "study name":
-            # Calculate Study Name counts
-            for var in temp_filtered_vars:
-                studies = var.get('studies', [])
-                for s in studies:
-                    study_name = s.get('c_name', 'Unknown Study')
-                    current_key_counts[study_name] = current_key_counts.get(study_name, 0) + 1
-        elif agg_key_orig in count_keys:# Check if it's one of the metadata keys
-             # Calculate counts for other metadata keys
-             for var in temp_filtered_vars:
-                # Check if the variable dictionary actually contains this key
-                if agg_key_orig in var:
-                    # Handle potential non-string values before title-casing
-                    val_raw = var[agg_key_orig]
-                    val_str = str(val_raw) if val_raw is not None else ""
-                    val = val_str.title() # Title-case the string representation
-                    current_key_counts[val] = current_key_counts.get(val, 0) + 1
-
-        # Store the calculated counts for this category if there are any counts
-        if current_key_counts:
-            agg_counts[display_key] = current_key_counts
-        # Optionally: else: agg_counts[display_key] = {} # Include the key even if empty
+    # Counts for each category (metadata keys and "Study Name") are calculated over the
+    # variables matching every filter except the one on that category
+    agg_counts: Dict[str, Dict[str, int]] = facet_index.counts(count_keys)
 
     # --- 8. Sorting Aggregation Counts ---
     def sort_inner_dicts(data: Dict[str, Dict[str, int]]) -> Dict[str, Dict[str, int]]:
@@ -304,7 +315,8 @@ async def search_var_grouped(search_query: SearchVariablesQueryFiltered):
 
 
 @APP.get('/search_study')
-async def search_study(study_id: Optional[str] = None, study_name: Optional[str] = None):
+async def search_study(study_id: Optional[str] = None, study_name: Optional[str] = None,
+                       search: Search = Depends(get_search)):
     """
     Search for studies by unique_id (ID or name) and/or study_name.
     """
@@ -317,7 +329,8 @@ async def search_study(study_id: Optional[str] = None, study_name: Optional[str]
 
 
 @APP.get('/search_program')
-async def search_program(program_name: Optional[str] = None, use_elasticsearch: bool = False):
+async def search_program(program_name: Optional[str] = None, use_elasticsearch: bool = False,
+                         search: Search = Depends(get_search)):
     """
     Search for studies by unique_id (ID or name) and/or study_name.
     """
@@ -329,7 +342,7 @@ async def search_program(program_name: Optional[str] = None, use_elasticsearch:
     }
 
 @APP.get('/program_list')
-async def get_program_list(use_elasticsearch: bool = False):
+async def get_program_list(use_elasticsearch: bool = False, search: Search = Depends(get_search)):
     """
     Search for program by program name.
     By default, uses JSON file. Set use_elasticsearch=true to use Elasticsearch.
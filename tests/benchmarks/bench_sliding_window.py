@@ -0,0 +1,28 @@
+"""
+Micro-benchmark of AnnotateMonarch.sliding_window against the original string-building
+implementation on long study descriptions.
+
+    python -m tests.benchmarks.bench_sliding_window
+"""
+import random
+import timeit
+
+from tests.unit.test_annotators import make_monarch_annotator, random_description, reference_sliding_window
+
+
+def main(sizes=(10_000, 100_000, 250_000, 1_000_000), repeat=5):
+    annotator = make_monarch_annotator()
+    rng = random.Random(0)
+    print(f"{'description':>12} {'chunks':>7} {'reference':>11} {'offsets':>11} {'speedup':>8}")
+    for size in sizes:
+        # Words average 6 characters, plus the space
+        text = random_description(rng, size // 7, 12)
+        chunks = list(annotator.sliding_window(text))
+        reference = min(timeit.repeat(lambda: list(reference_sliding_window(text)), number=1, repeat=repeat))
+        offsets = min(timeit.repeat(lambda: list(annotator.sliding_window(text)), number=1, repeat=repeat))
+        print(f"{len(text):>10,}ch {len(chunks):>7} {reference * 1000:>9.2f}ms {offsets * 1000:>9.2f}ms "
+              f"{reference / offsets:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -21,7 +21,6 @@ class APISearchTestCase(TestCase):
                 "environment variables. See dug.config for more.")
 
         from dug.server import APP
-        client = TestClient(APP)
         types = ['anatomical entity', 'drug']
         body = {
             "index": "concepts_index",
@@ -31,7 +30,9 @@ class APISearchTestCase(TestCase):
             "types": types
         }
         try:
-            response = client.post("/search", json=body)
+            # Entering the client runs the lifespan, which builds the search client
+            with TestClient(APP) as client:
+                response = client.post("/search", json=body)
         except ConnectionError:
             self.fail("For the integration test, a populated elasticsearch "
                       "instance must be available and configured in the "
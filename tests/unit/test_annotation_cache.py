@@ -0,0 +1,101 @@
+import time
+from unittest.mock import MagicMock
+
+from dug.config import Config
+from dug.core.annotators import AnnotateMonarch, DugIdentifier
+from dug.core.annotators.annotation_cache import (
+    CachedAnnotator,
+    SQLiteAnnotationStore,
+    annotator_fingerprint,
+)
+
+
+class CountingAnnotator:
+    def __init__(self):
+        self.texts = []
+
+    def __call__(self, text, http_session):
+        self.texts.append(text)
+        identifier = DugIdentifier(f"HP:{len(self.texts)}", text, types="phenotype", search_text=text)
+        identifier.synonyms = [text.upper()]
+        return [identifier]
+
+    def annotate_batch(self, texts, http_session):
+        return [self(text, http_session) for text in texts]
+
+
+def test_cached_annotator_dedupes_texts(tmp_path):
+    store = SQLiteAnnotationStore(str(tmp_path / "annotations.db"))
+    annotator = CountingAnnotator()
+    cached = CachedAnnotator(annotator, store, fingerprint="v1")
+
+    first = cached("body  mass index", None)
+    second = cached("body mass index ", None)
+    assert annotator.texts == ["body  mass index"]
+    assert [i.__dict__ for i in second] == [i.__dict__ for i in first]
+    # Callers get their own identifiers
+    assert second[0] is not first[0]
+    second[0].synonyms.append("BMI")
+    assert cached("body mass index", None)[0].synonyms == ["BODY  MASS INDEX"]
+
+    # Persisted for the next crawl, but not shared with other annotator settings
+    assert CachedAnnotator(annotator, store, fingerprint="v1")("body mass index", None)[0].id == "HP:1"
+    assert CachedAnnotator(annotator, store, fingerprint="v2")("body mass index", None)[0].id == "HP:2"
+
+    assert cached.stats() == {"calls": 3, "distinct_texts": 1, "dedupe_ratio": 0.6667,
+                              "hits": 2, "hit_ratio": 0.6667, "annotated": 1}
+
+
+def test_cached_annotator_batch(tmp_path):
+    annotator = CountingAnnotator()
+    cached = CachedAnnotator(annotator, SQLiteAnnotationStore(str(tmp_path / "annotations.db")))
+    cached("age", None)
+
+    results = cached.annotate_batch(["age", "sex", "height", "sex"], None)
+    assert annotator.texts == ["age", "sex", "height"]
+    assert [[i.label for i in ids] for ids in results] == [["age"], ["sex"], ["height"], ["sex"]]
+    assert results[1][0] is not results[3][0]
+    assert not hasattr(CachedAnnotator(MagicMock(spec=["__call__"]), None), "annotate_batch")
+
+
+def test_sqlite_store_evicts_least_recently_used(tmp_path):
+    store = SQLiteAnnotationStore(str(tmp_path / "annotations.db"), maxsize=2, evict_every=1)
+    store.put("a", [1])
+    store.put("b", [2])
+    assert store.get("a") == [1]
+    store.put("c", [3])
+    assert len(store) == 2
+    assert store.get("b") is None
+    assert store.get("a") == [1]
+
+
+def test_cached_annotator_keys_on_preprocessed_text(tmp_path):
+    cfg = Config(preprocessor={"debreviator": {"BMI": "body mass index"}, "stopwords": ["the"]})
+    monarch = AnnotateMonarch(normalizer=None, synonym_finder=None, config=cfg, url="http://annotator.api/")
+    cached = CachedAnnotator(monarch, None, fingerprint=annotator_fingerprint("monarch", cfg))
+    assert cached.key("the BMI") == cached.key("body mass index")
+
+    changed = Config(preprocessor={"debreviator": {}, "stopwords": []})
+    assert annotator_fingerprint("monarch", cfg) != annotator_fingerprint("monarch", changed)
+
+
+def test_sqlite_store_expires_entries(tmp_path, monkeypatch):
+    store = SQLiteAnnotationStore(str(tmp_path / "annotations.db"), ttl=60, evict_every=1)
+    store.put("a", [1])
+    assert store.get("a") == [1]
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert store.get("a") is None
+    store.put("b", [2])
+    assert len(store) == 1
+    assert store.get("b") == [2]
+
+
+def test_cached_annotator_does_not_store_empty_results(tmp_path):
+    annotator = MagicMock(return_value=[])
+    cached = CachedAnnotator(annotator, SQLiteAnnotationStore(str(tmp_path / "annotations.db")))
+    assert cached("nothing to find", None) == []
+    assert cached("nothing to find", None) == []
+    assert annotator.call_count == 2
+    assert len(cached.store) == 0
@@ -1,14 +1,20 @@
+import random
+import string
 from copy import copy
 from typing import List
 from attr import field
 
 import pytest
+import requests
 from dug.core.annotators.utils.biolink_purl_util import BioLinkPURLerizer
+from dug.core.annotators.utils.curie_cache import CurieCache
+from dug.core.annotators.utils.text_preprocessor import TextPreprocessor
 
 from tests.unit.mocks.data.mock_config import MockConfig
 from dug.core.annotators import (
     DugIdentifier,
     AnnotateMonarch,
+    AnnotateSapbert,
     DefaultNormalizer,
     DefaultSynonymFinder,
 )
@@ -60,6 +66,45 @@ def test_normalizer(normalizer_api):
     assert output.types == 'anatomical entity'
 
 
+def test_normalizer_batch():
+    url = "http://normalizer.api/?curie="
+
+    def _normalization(curie, label):
+        return {
+            "id": {"identifier": curie, "label": label},
+            "equivalent_identifiers": [{"identifier": curie, "label": label}],
+            "type": ["biolink:AnatomicalEntity"],
+        }
+
+    http_session = MagicMock()
+    http_session.get.return_value.json.return_value = {
+        "UBERON:0007100": _normalization("UBERON:0007100", "primary circulatory organ"),
+        "UBERON:0000948": _normalization("UBERON:0000948", "heart"),
+        "XAO:0000336": None,
+    }
+    identifiers = [
+        DugIdentifier("UBERON:0007100", "primary circulatory organ", search_text="heart"),
+        DugIdentifier("XAO:0000336", "heart primordium", search_text="heart"),
+        DugIdentifier("UBERON:0000948", "heart", search_text="heart"),
+        DugIdentifier("UBERON:0007100", "primary circulatory organ", search_text="heart attack"),
+    ]
+
+    normalizer = DefaultNormalizer(url, batch_size=2)
+    output = normalizer.normalize_batch(identifiers, http_session)
+
+    # Three distinct curies in batches of two
+    assert [call.args[0] for call in http_session.get.call_args_list] == [
+        f"{url}UBERON%3A0007100&curie=XAO%3A0000336",
+        f"{url}UBERON%3A0000948",
+    ]
+    assert output[1] is None
+    assert [ident.label for ident in (output[0], output[2], output[3])] == [
+        "primary circulatory organ", "heart", "primary circulatory organ"
+    ]
+    assert output[3].search_text == ["heart attack"]
+    assert output[2].types == "anatomical entity"
+
+
 def test_synonym_finder(synonym_api):
     curie = "UBERON:0007100"
     url = f"http://synonyms.api"
@@ -99,4 +144,321 @@ def test_synonym_finder(synonym_api):
 
 #     print(counter)
 #     # since spaces are trimmed by tokenizer , we can execuled all spaces and do char
-#     assert chunks == text
\ No newline at end of file
+#     assert chunks == text
+
+
+def reference_sliding_window(text, max_characters=2000, padding_words=5):
+    # The original string-building AnnotateMonarch.sliding_window, kept to check the offset-based one against
+    words = text.split(' ')
+    total_words = len(words)
+    window_end = False
+    current_index = 0
+    while not window_end:
+        current_string = ""
+        for index, word in enumerate(words[current_index: ]):
+            if len(current_string) + len(word) + 1 >= max_characters:
+                yield current_string + " "
+                current_index += index - padding_words
+                break
+            appendee = word if index == 0 else " " + word
+            current_string += appendee
+
+        if current_index + index == len(words) - 1:
+            window_end = True
+            yield current_string
+
+
+def random_description(rng, total_words, max_word_length):
+    # Words of random length, with the odd empty word from runs of spaces
+    return " ".join("".join(rng.choices(string.ascii_lowercase, k=rng.randint(0, max_word_length)))
+                    for _ in range(total_words))
+
+
+def make_monarch_annotator():
+    cfg = MockConfig.test_from_env()
+    return AnnotateMonarch(normalizer=DefaultNormalizer(cfg.normalizer),
+                           synonym_finder=DefaultSynonymFinder(cfg.synonym_service),
+                           config=cfg, **cfg.annotator_args["monarch"])
+
+
+def covers_every_word(text, chunks):
+    # The words of the text, in order, within the words of the (overlapping) chunks
+    words = iter(" ".join(chunks).split(" "))
+    return all(word in words for word in text.split(" "))
+
+
+def test_sliding_window_covers_every_word():
+    annotator = make_monarch_annotator()
+    rng = random.Random(0)
+    texts = ["", "heart", "heart attack", "aaaa bbb ccc ddd eeee"] + \
+            [random_description(rng, rng.randint(1, 400), 12) for _ in range(200)]
+    for text in texts:
+        for max_characters, padding_words in ((2000, 5), (100, 5), (40, 1), (60, 3), (28, 3)):
+            chunks = list(annotator.sliding_window(text, max_characters, padding_words))
+            assert covers_every_word(text, chunks), (text, max_characters, padding_words)
+            assert all(len(chunk) <= max_characters or len(chunk.strip(" ").split(" ")) == 1
+                       for chunk in chunks[:-1])
+
+
+def test_sliding_window_matches_reference_at_defaults():
+    # At the default window the chunks are the reference's, unless it dropped the last words
+    annotator = make_monarch_annotator()
+    rng = random.Random(0)
+    for _ in range(200):
+        text = random_description(rng, rng.randint(300, 1500), 12)
+        reference = list(reference_sliding_window(text))
+        if covers_every_word(text, reference):
+            assert list(annotator.sliding_window(text)) == reference
+
+
+def test_sliding_window_keeps_the_tail():
+    # A window shift landing one word short of the end made the reference repeat its last
+    # window and stop, dropping the words after it
+    annotator = make_monarch_annotator()
+    text = "hfznwx giqidto spxlfejg o hhf iaefvw cnrkiry bxxieg lokxjycc n  itpcoauv cpkd ywheeydw " \
+           "mhth d zewanm tt x utad trk mb yrlrl rejh"
+    reference = list(reference_sliding_window(text, max_characters=40, padding_words=1))
+    assert reference[-1] == " itpcoauv cpkd ywheeydw mhth d zewanm"
+    chunks = list(annotator.sliding_window(text, max_characters=40, padding_words=1))
+    assert chunks[:3] == reference[:3]
+    assert chunks[3:] == ["zewanm tt x utad trk mb yrlrl rejh"]
+
+
+def test_sliding_window_long_words():
+    # The original never finished windowing a text with a word longer than max_characters
+    annotator = make_monarch_annotator()
+    text = "short words " + "x" * 50 + " then more short words"
+    chunks = list(annotator.sliding_window(text, max_characters=20, padding_words=2))
+    assert "x" * 50 + " " in chunks
+    assert chunks[-1].endswith("more short words")
+    assert all(word in " ".join(chunks) for word in text.split(" "))
+
+def test_synonym_finder_batch():
+    url = "http://synonyms.api"
+    http_session = MagicMock()
+    http_session.post.return_value.status_code = 200
+    http_session.post.return_value.json.return_value = {
+        "UBERON:0007100": {"names": ["primary circulatory organ", "heart"]},
+        "MONDO:0005068": {"names": ["myocardial infarction"]},
+    }
+
+    finder = DefaultSynonymFinder(url)
+    result = finder.find_synonyms_batch(
+        ["UBERON:0007100", "MONDO:0005068", "UBERON:0007100", "XAO:0000336"], http_session
+    )
+
+    http_session.post.assert_called_once_with(
+        url, json={"curies": ["UBERON:0007100", "MONDO:0005068", "XAO:0000336"]}
+    )
+    assert result == {
+        "UBERON:0007100": ["primary circulatory organ", "heart"],
+        "MONDO:0005068": ["myocardial infarction"],
+        "XAO:0000336": [],
+    }
+
+
+def test_synonym_finder_batch_falls_back_per_curie():
+    url = "http://synonyms.api"
+
+    def post(url, json):
+        response = MagicMock()
+        curies = json["curies"]
+        if len(curies) > 1 or curies[0] == "BAD:1":
+            response.status_code = 422
+        else:
+            response.status_code = 200
+            response.json.return_value = {curies[0]: {"names": [f"{curies[0]} name"]}}
+        return response
+
+    http_session = MagicMock()
+    http_session.post.side_effect = post
+
+    finder = DefaultSynonymFinder(url)
+    result = finder.find_synonyms_batch(["HP:1", "BAD:1", "HP:2"], http_session)
+
+    assert http_session.post.call_count == 4
+    assert result == {"HP:1": ["HP:1 name"], "BAD:1": [], "HP:2": ["HP:2 name"]}
+
+
+def test_synonym_finder_retries_once_per_request():
+    # The batch retry doesn't wrap the single curie lookup's own retry
+    http_session = MagicMock()
+    http_session.post.side_effect = requests.exceptions.ConnectionError("service down")
+
+    finder = DefaultSynonymFinder("http://synonyms.api")
+    with pytest.raises(requests.exceptions.ConnectionError):
+        finder("HP:1", http_session)
+    assert http_session.post.call_count == 3
+
+    http_session.post.reset_mock()
+    with pytest.raises(requests.exceptions.ConnectionError):
+        finder.find_synonyms_batch(["HP:2", "HP:3"], http_session)
+    assert http_session.post.call_count == 3
+
+
+def test_sapbert_annotate_classifiers_concurrent_matches_serial():
+    def post(url, json):
+        response = MagicMock()
+        response.status_code = 200
+        response.json.return_value = [
+            {"name": json["text"], "curie": f"HP:{json['text']}", "category": "biolink:PhenotypicFeature", "score": 0.9},
+            {"name": "unlikely", "curie": "HP:0", "category": "biolink:PhenotypicFeature", "score": 0.1},
+        ]
+        return response
+
+    classifiers = [{"text": text, "bl_type": "biolink:PhenotypicFeature"}
+                   for text in ("seizure", "ataxia", "fever", "seizure", "cough")]
+    results = {}
+    for term_concurrency in (1, 4):
+        http_session = MagicMock()
+        http_session.post.side_effect = post
+        annotator = AnnotateSapbert(normalizer=None, synonym_finder=None,
+                                    classification_url="http://classifier.api/",
+                                    annotator_url="http://sapbert.api/",
+                                    term_concurrency=term_concurrency)
+        identifiers = annotator.annotate_classifiers(classifiers, http_session)
+        results[term_concurrency] = [(text, [(i.id, i.search_text) for i in ids]) for text, ids in identifiers.items()]
+        # Repeated terms are only looked up once
+        assert http_session.post.call_count == 4
+
+    assert results[1] == results[4]
+    assert [text for text, _ in results[4]] == ["seizure", "ataxia", "fever", "cough"]
+    assert results[4][0] == ("seizure", [("HP:seizure", ["seizure"])])
+
+
+def _sapbert_session(batch_status=200):
+    """ Classifier tags each word of a text, entity linker maps a term to HP:<term> """
+    def denotations(text):
+        return {"text": text, "denotations": [{"text": word, "obj": "biolink:PhenotypicFeature"}
+                                              for word in text.split()]}
+
+    def post(url, json):
+        response = MagicMock()
+        response.status_code = 200
+        if url == "http://classifier.api/":
+            if isinstance(json["text"], list):
+                response.status_code = batch_status
+                response.json.return_value = [denotations(text) for text in json["text"]]
+            else:
+                response.json.return_value = denotations(json["text"])
+        elif url == "http://synonyms.api":
+            response.json.return_value = {curie: {"names": []} for curie in json["curies"]}
+        else:
+            response.json.return_value = [{"name": json["text"], "curie": f"HP:{json['text']}",
+                                           "category": "biolink:PhenotypicFeature", "score": 0.9}]
+        return response
+
+    http_session = MagicMock()
+    http_session.post.side_effect = post
+    http_session.get.side_effect = lambda url: MagicMock(**{"json.return_value": {}})
+    return http_session
+
+
+@pytest.mark.parametrize("batch_status", [200, 422])
+def test_sapbert_annotate_batch_matches_per_text(batch_status):
+    texts = ["seizure ataxia", "fever", "", "ataxia cough"]
+
+    def make_annotator():
+        return AnnotateSapbert(normalizer=DefaultNormalizer("http://normalizer.api/?curie="),
+                               synonym_finder=DefaultSynonymFinder("http://synonyms.api"),
+                               ontology_greenlist=["HP"],
+                               classification_url="http://classifier.api/",
+                               annotator_url="http://sapbert.api/")
+
+    annotator = make_annotator()
+    expected = [annotator(text, _sapbert_session()) for text in texts]
+
+    annotator = make_annotator()
+    http_session = _sapbert_session(batch_status)
+    results = annotator.annotate_batch(texts, http_session)
+
+    assert [[i.id for i in ids] for ids in results] == [[i.id for i in ids] for ids in expected]
+    assert [[i.id for i in ids] for ids in results] == [["HP:seizure", "HP:ataxia"], ["HP:fever"], [],
+                                                       ["HP:ataxia", "HP:cough"]]
+    classification_calls = [call for call in http_session.post.call_args_list
+                            if call.args[0] == "http://classifier.api/"]
+    if batch_status == 200:
+        assert len(classification_calls) == 1
+    else:
+        # Batch rejected, so each text is classified on its own and batches aren't tried again
+        assert len(classification_calls) == 1 + len(texts)
+        assert not annotator.batch_classification
+
+
+def reference_preprocess(text, debreviator, stopwords):
+    # The original AnnotateMonarch.preprocess_text
+    for key, value in debreviator.items():
+        text = text.replace(key, value)
+    return " ".join([word for word in text.split() if word not in stopwords])
+
+
+def test_text_preprocessor_matches_sequential_replace():
+    rng = random.Random(0)
+    alphabet = "abc_ "
+    for _ in range(300):
+        debreviator = {"".join(rng.choices(alphabet, k=rng.randint(1, 3))): "".join(rng.choices(alphabet, k=rng.randint(0, 4)))
+                       for _ in range(rng.randint(1, 6))}
+        stopwords = ["".join(rng.choices("abc", k=rng.randint(1, 2))) for _ in range(3)]
+        texts = ["".join(rng.choices(alphabet, k=rng.randint(0, 40))) for _ in range(5)]
+        preprocessor = TextPreprocessor(debreviator, stopwords)
+        expected = [reference_preprocess(text, debreviator, stopwords) for text in texts]
+        assert [preprocessor(text) for text in texts] == expected, debreviator
+        assert preprocessor.process_batch(texts) == expected, debreviator
+
+
+def test_text_preprocessor_single_pass():
+    debreviator = {"BMI": "body mass index", "HDL": "high density lipoprotein", "_": " "}
+    preprocessor = TextPreprocessor(debreviator, ["the", "of"])
+    assert len(preprocessor.passes) == 1
+    assert preprocessor.process_batch(["the BMI_of HDL", "", "the"]) == \
+           ["body mass index high density lipoprotein", "", ""]
+    # "ab" overlaps the replacement of "a", so it needs a pass of its own
+    assert len(TextPreprocessor({"a": "xa", "ab": "y"}).passes) == 2
+
+
+def test_curie_cache_lru():
+    cache = CurieCache(maxsize=2)
+    cache.put("HP:1", None)
+    cache.put("HP:2", ["two"])
+    assert cache.get("HP:1") is None
+    cache.put("HP:3", ["three"])
+
+    # HP:2 was least recently used
+    assert cache.get("HP:2") is CurieCache.MISSING
+    assert cache.get("HP:3") == ["three"]
+    assert cache.stats() == {"hits": 2, "misses": 1, "size": 2, "maxsize": 2}
+
+
+def test_normalizer_and_synonym_finder_cache():
+    normalizer_session = MagicMock()
+    normalizer_session.get.return_value.json.return_value = {
+        "HP:0001250": {
+            "id": {"identifier": "HP:0001250", "label": "Seizure"},
+            "equivalent_identifiers": [{"identifier": "HP:0001250"}],
+            "type": ["biolink:PhenotypicFeature"],
+        }
+    }
+    synonym_session = MagicMock()
+    synonym_session.post.return_value.status_code = 200
+    synonym_session.post.return_value.json.return_value = {"HP:0001250": {"names": ["seizures"]}}
+
+    normalizer = DefaultNormalizer("http://normalizer.api/?curie=")
+    synonym_finder = DefaultSynonymFinder("http://synonyms.api")
+    outputs = []
+    for search_text in ("seizure", "fits"):
+        norm_id = normalizer(DugIdentifier("HP:0001250", "", search_text=search_text), normalizer_session)
+        norm_id.synonyms = synonym_finder(norm_id.id, synonym_session)
+        outputs.append(norm_id)
+
+    assert normalizer_session.get.call_count == 1
+    assert synonym_session.post.call_count == 1
+    assert normalizer.cache.stats()["hits"] == 1
+    assert synonym_finder.cache.stats()["hits"] == 1
+
+    # Each caller gets its own identifier and synonym list
+    assert outputs[0] is not outputs[1]
+    assert [o.search_text for o in outputs] == [["seizure"], ["fits"]]
+    outputs[0].synonyms.append("convulsion")
+    outputs[0].equivalent_identifiers.append("MESH:D012640")
+    assert outputs[1].synonyms == ["seizures"]
+    assert outputs[1].equivalent_identifiers == ["HP:0001250"]
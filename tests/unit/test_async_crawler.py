@@ -0,0 +1,208 @@
+import asyncio
+import json
+import urllib.parse
+from unittest.mock import MagicMock
+
+import httpx
+
+from dug.core import DugConcept
+from dug.core.annotators import DugIdentifier, AnnotateMonarch, DefaultNormalizer, DefaultSynonymFinder
+from dug.core.async_crawler import AsyncCrawler
+from dug.core.async_http import AsyncServicePool
+from dug.core.crawler import Crawler
+from dug.core.parsers import DugElement
+from tests.unit.mocks.data.mock_config import MockConfig
+from tests.unit.mocks.MockCrawler import *
+
+ANNOTATOR_URL = "http://annotator.api/?content="
+NORMALIZER_URL = "http://normalizer.api/?curie="
+SYNONYMS_URL = "http://synonyms.api/reverse_lookup"
+
+
+def services(request: httpx.Request) -> httpx.Response:
+    url = str(request.url)
+    if url.startswith(ANNOTATOR_URL):
+        text = urllib.parse.unquote(url[len(ANNOTATOR_URL):])
+        return httpx.Response(200, json={"spans": [
+            {"text": word, "token": [{"id": f"HP:{word}", "category": ["phenotype"], "terms": [word]}]}
+            for word in text.split()
+        ]})
+    if url.startswith(NORMALIZER_URL):
+        curies = urllib.parse.unquote(url[len(NORMALIZER_URL):]).split("&curie=")
+        return httpx.Response(200, json={
+            curie: None if curie == "HP:unknown" else {
+                "id": {"identifier": curie, "label": curie.split(":")[1]},
+                "equivalent_identifiers": [{"identifier": curie}],
+                "type": ["biolink:PhenotypicFeature"],
+            } for curie in curies
+        })
+    if url.startswith(SYNONYMS_URL):
+        curies = json.loads(request.content)["curies"]
+        return httpx.Response(200, json={curie: {"names": [curie.lower()]} for curie in curies})
+    return httpx.Response(404)
+
+
+def make_annotator():
+    cfg = MockConfig.test_from_env()
+    return AnnotateMonarch(normalizer=DefaultNormalizer(NORMALIZER_URL),
+                           synonym_finder=DefaultSynonymFinder(SYNONYMS_URL),
+                           config=cfg, url=ANNOTATOR_URL)
+
+
+def sync_session():
+    # requests-style session answering from the same handler as the mock transport
+    session = MagicMock()
+    session.get.side_effect = lambda url: services(httpx.Request("GET", url))
+    session.post.side_effect = lambda url, json: services(httpx.Request("POST", url, json=json))
+    return session
+
+
+def test_service_pool_retries_with_backoff():
+    attempts = []
+
+    def flaky(request):
+        attempts.append(request.url.path)
+        if len(attempts) < 3:
+            return httpx.Response(503)
+        return httpx.Response(200, json={"ok": True})
+
+    async def run():
+        pool = AsyncServicePool(backoff=0, transport=httpx.MockTransport(flaky))
+        try:
+            return await pool.get("annotator", "http://annotator.api/")
+        finally:
+            await pool.aclose()
+
+    response = asyncio.run(run())
+    assert response.json() == {"ok": True}
+    assert len(attempts) == 3
+
+
+def test_service_pool_limits_requests_per_service():
+    in_flight = {"annotator": 0, "normalizer": 0}
+    peak = {"annotator": 0, "normalizer": 0}
+
+    async def handler(request):
+        service = request.url.host.split(".")[0]
+        in_flight[service] += 1
+        peak[service] = max(peak[service], in_flight[service])
+        await asyncio.sleep(0.01)
+        in_flight[service] -= 1
+        return httpx.Response(200)
+
+    async def run():
+        pool = AsyncServicePool({"annotator": 2, "normalizer": 5}, transport=httpx.MockTransport(handler))
+        await asyncio.gather(*(pool.get(service, f"http://{service}.api/")
+                               for service in ("annotator", "normalizer") for _ in range(10)))
+        await pool.aclose()
+
+    asyncio.run(run())
+    assert peak == {"annotator": 2, "normalizer": 5}
+
+
+def test_monarch_annotate_async_matches_sync():
+    text = "seizure ataxia unknown seizure"
+
+    expected = make_annotator()(text, sync_session())
+
+    async def run():
+        pool = AsyncServicePool(transport=httpx.MockTransport(services))
+        try:
+            return await make_annotator().annotate_async(text, pool)
+        finally:
+            await pool.aclose()
+
+    result = asyncio.run(run())
+    assert [(i.id, i.label, i.synonyms, i.search_text) for i in result] == \
+           [(i.id, i.label, i.synonyms, i.search_text) for i in expected]
+    assert [i.id for i in result] == ["HP:seizure", "HP:ataxia", "HP:seizure"]
+
+
+def test_monarch_annotate_async_survives_failed_chunk():
+    def unavailable(request):
+        if str(request.url).startswith(ANNOTATOR_URL):
+            return httpx.Response(503, text="<html>Service Unavailable</html>")
+        return services(request)
+
+    async def run():
+        pool = AsyncServicePool(backoff=0, max_retries=1, transport=httpx.MockTransport(unavailable))
+        try:
+            return await annotator.annotate_async("seizure ataxia", pool)
+        finally:
+            await pool.aclose()
+
+    annotator = make_annotator()
+    assert asyncio.run(run()) == []
+    assert annotator.failures.counts()["annotation"] == {"seizure ataxia": 1}
+
+
+def test_synonym_finder_async_falls_back_per_curie():
+    def handler(request):
+        curies = json.loads(request.content)["curies"]
+        if len(curies) > 1 or curies[0] == "BAD:1":
+            return httpx.Response(422)
+        return httpx.Response(200, json={curies[0]: {"names": [f"{curies[0]} name"]}})
+
+    async def run():
+        pool = AsyncServicePool(transport=httpx.MockTransport(handler))
+        try:
+            return await DefaultSynonymFinder(SYNONYMS_URL).find_synonyms_batch_async(["HP:1", "BAD:1", "HP:2"], pool)
+        finally:
+            await pool.aclose()
+
+    assert asyncio.run(run()) == {"HP:1": ["HP:1 name"], "BAD:1": [], "HP:2": ["HP:2 name"]}
+
+
+def test_async_crawler_matches_crawler(crawler_init_args_no_graph_extraction, monkeypatch):
+    # Route the pool's client through the mock services
+    pool_init = AsyncServicePool.__init__
+    monkeypatch.setattr(AsyncServicePool, "__init__", lambda self, *args, **kwargs: pool_init(
+        self, *args, **{**kwargs, "transport": httpx.MockTransport(services)}))
+
+    def make_elements():
+        return [DugElement(f"test-{i}", "name", f"seizure ataxia_{i % 3}", "test-type") for i in range(6)]
+
+    results = {}
+    for crawler_class in (Crawler, AsyncCrawler):
+        crawler = crawler_class(**{**crawler_init_args_no_graph_extraction,
+                                   "annotator": make_annotator(),
+                                   "http_session": sync_session()})
+        crawler.elements = make_elements()
+        crawler.annotate_elements()
+        if isinstance(crawler, AsyncCrawler):
+            crawler.close()
+        results[crawler_class] = (
+            [(c_id, sorted(c.identifiers)) for c_id, c in crawler.concepts.items()],
+            [(e.id, list(e.concepts)) for e in crawler.elements],
+        )
+
+    assert results[Crawler] == results[AsyncCrawler]
+
+
+def test_async_crawler_expands_concepts(crawler_init_args_no_graph_extraction):
+    calls = []
+
+    class AsyncTranqlizer:
+        async def expand_identifier_async(self, identifier, query_factory, kg_filename, http):
+            calls.append(kg_filename)
+            await asyncio.sleep(0)
+            return TRANQL_ANSWERS
+
+    def make_concepts():
+        concepts = []
+        for i in range(3):
+            concept = DugConcept(concept_id=f"MONDO:{i}", name=str(i), desc="", concept_type="disease")
+            concept.add_identifier(DugIdentifier(f"MONDO:{i}", str(i), ["disease"]))
+            concepts.append(concept)
+        return concepts
+
+    expected = make_concepts()
+    Crawler(**crawler_init_args_no_graph_extraction).expand_concepts(expected)
+
+    concepts = make_concepts()
+    crawler = AsyncCrawler(**{**crawler_init_args_no_graph_extraction, "tranqlizer": AsyncTranqlizer()})
+    crawler.expand_concepts(concepts)
+    crawler.close()
+
+    assert [list(c.kg_answers) for c in concepts] == [list(c.kg_answers) for c in expected]
+    assert sorted(calls) == [f"crawl/MONDO:{i}_disease.json" for i in range(3)]
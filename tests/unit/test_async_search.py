@@ -8,6 +8,7 @@ from fastapi.testclient import TestClient
 
 from dug.core import async_search
 from dug.config import Config
+from dug.core.index import SUMMARIES_META_KEY
 
 async def _mock_search(*args, **kwargs):
     "Mock of elasticsearch search function. Ignores argument"
@@ -42,9 +43,150 @@ class SearchTestCase(TestCase):
         self.assertEqual(len(result['concept_types']), 9)
         self.assertEqual(result['concept_types']['anatomical entity'], 10)
 
+    def test_concepts_search_explain(self):
+        "Explanations are only requested when asked for, and come back compact"
+        search = async_search.Search(Config.from_env())
+        search.es = mock.AsyncMock()
+        search.es.search.side_effect = _mock_search
+        asyncio.run(search.search_concepts("brain"))
+        self.assertFalse(search.es.search.call_args.kwargs['explain'])
+
+        explanation = {"value": 3.0, "description": "sum of:", "details": [
+            {"value": 1.0, "description": "weight(name:brain in 0)", "details": []},
+            {"value": 2.0, "description": "max of:", "details": [
+                {"value": 2.0, "description": "weight(search_terms:brain in 0)", "details": []}]}]}
+        result = _brain_search_result()
+        result['hits']['hits'][0]['_explanation'] = explanation
+        search.es.search.side_effect = None
+        search.es.search.return_value = result
+        hit = asyncio.run(search.search_concepts("brain", explain=True))['hits']['hits'][0]
+        self.assertNotIn('_explanation', hit)
+        self.assertEqual(hit['_score_breakdown'], {'score': 3.0, 'clauses': [
+            {'description': 'max of:', 'value': 2.0},
+            {'description': 'weight(name:brain in 0)', 'value': 1.0}]})
+
+    def test_program_list_from_summaries(self):
+        "Program list is read from the programs summary index once its summaries are complete"
+        search = async_search.Search(Config.from_env())
+        search.es = mock.AsyncMock()
+        aggregated = {'aggregations': {'unique_program_names': {'buckets': ['bucket']}}}
+
+        # Summaries of only the studies crawled since an upgrade aren't trusted
+        search.es.indices.get_mapping.return_value = {
+            'studies_index': {'mappings': {'_meta': {}}}, 'programs_index': {'mappings': {}}}
+        search.es.search.return_value = aggregated
+        self.assertEqual(asyncio.run(search.search_program_list(use_elasticsearch=True)), ['bucket'])
+        self.assertEqual(search.es.search.call_args.kwargs['index'], 'variables_index')
+
+        complete = {'mappings': {'_meta': {SUMMARIES_META_KEY: True}}}
+        search.es.indices.get_mapping.return_value = {'studies_index': complete, 'programs_index': complete}
+        search.es.search.return_value = {'hits': {'hits': [{'_source': {
+            'program_name': 'dbGaP', 'variable_count': 40, 'study_count': 3}, 'sort': [40, 'dbGaP']}]}}
+        result = asyncio.run(search.search_program_list(use_elasticsearch=True))
+        self.assertEqual(result, [{'key': 'dbGaP', 'doc_count': 40, 'No_of_studies': {'value': 3}}])
+        self.assertEqual(search.es.search.call_args.kwargs['index'], 'programs_index')
+
+        # Complete summaries without programs or studies are answered as they are, never by
+        # aggregating the variables index
+        search.es.search.reset_mock()
+        search.es.search.return_value = {'hits': {'hits': []}}
+        self.assertEqual(asyncio.run(search.search_program_list(use_elasticsearch=True)), [])
+        self.assertEqual(asyncio.run(search.search_program('no such program', use_elasticsearch=True)), [])
+        self.assertEqual({call.kwargs['index'] for call in search.es.search.call_args_list},
+                         {'programs_index', 'studies_index'})
+
+    def test_program_studies_are_paged(self):
+        "Studies of a program are read a page at a time, so none are cut off"
+        search = async_search.Search(Config(search_max_page_size=2))
+        search.es = mock.AsyncMock()
+        complete = {'mappings': {'_meta': {SUMMARIES_META_KEY: True}}}
+        search.es.indices.get_mapping.return_value = {'studies_index': complete, 'programs_index': complete}
+        hits = [{'_source': {'collection_id': f'phs{i}'}, 'sort': [f'phs{i}']} for i in range(3)]
+        search.es.search.side_effect = [{'hits': {'hits': hits[:2]}}, {'hits': {'hits': hits[2:]}}]
+
+        result = asyncio.run(search.search_program('dbGaP', use_elasticsearch=True))
+        self.assertEqual(result, [hit['_source'] for hit in hits])
+        self.assertEqual(search.es.search.call_args.kwargs['search_after'], ['phs1'])
+
+    def test_stream_docs(self):
+        "Dumps page through a point in time with search_after"
+        search = async_search.Search(Config.from_env())
+        search.es = mock.AsyncMock()
+        search.es.search.side_effect = [
+            {'pit_id': 'pit-2', 'hits': {'hits': [{'_id': 'a', 'sort': [1]}, {'_id': 'b', 'sort': [2]}]}},
+            {'pit_id': 'pit-2', 'hits': {'hits': [{'_id': 'c', 'sort': [3]}]}},
+        ]
+
+        async def collect():
+            return [hit async for hit in search.stream_docs('pit-1', fields=['id'], page_size=2)]
+
+        hits = asyncio.run(collect())
+        self.assertEqual([hit['_id'] for hit in hits], ['a', 'b', 'c'])
+        first, second = search.es.search.call_args_list
+        self.assertEqual(first.kwargs['pit'], {'id': 'pit-1', 'keep_alive': '5m'})
+        self.assertEqual(first.kwargs['source'], ['id'])
+        self.assertNotIn('search_after', first.kwargs)
+        self.assertEqual(second.kwargs['pit']['id'], 'pit-2')
+        self.assertEqual(second.kwargs['search_after'], [2])
+        search.es.close_point_in_time.assert_awaited_once_with(id='pit-2')
+
+    def test_client_options(self):
+        "Elasticsearch client pool, timeout, retry and sniff settings come from config"
+        with mock.patch("dug.core.async_search.AsyncElasticsearch") as es_class:
+            async_search.Search(Config(elastic_connections_per_node=50, elastic_sniff=True))
+        options = es_class.call_args.kwargs
+        self.assertEqual(options['connections_per_node'], 50)
+        self.assertEqual(options['request_timeout'], 30)
+        self.assertTrue(options['retry_on_timeout'])
+        self.assertTrue(options['sniff_on_start'])
+
+    def test_warmup(self):
+        "Warmup touches every index and doesn't raise when elasticsearch is down"
+        search = async_search.Search(Config.from_env())
+        search.es = mock.AsyncMock()
+        search.es.cluster.health.return_value = {'cluster_name': 'dug', 'status': 'green'}
+        asyncio.run(search.warmup())
+        self.assertEqual(search.es.search.await_count, len(search.indices))
+
+        search.es.cluster.health.side_effect = ConnectionError("refused")
+        asyncio.run(search.warmup())
+
+    def test_server_lifespan(self):
+        "The server builds its search client on startup, keeps it on app.state and closes it on shutdown"
+        from dug import server
+        with mock.patch.object(server, 'Search') as search_class, \
+                mock.patch.object(server, 'SearchCache') as cache_class:
+            search = search_class.return_value
+            search.warmup = mock.AsyncMock()
+            search.es.close = mock.AsyncMock()
+            search.search_program_list = mock.AsyncMock(return_value=['dbGaP'])
+            cache_class.from_config.return_value.close = mock.AsyncMock()
+            search_class.assert_not_called()
+
+            with TestClient(server.APP) as client:
+                search.warmup.assert_awaited_once()
+                self.assertIs(server.APP.state.search, search)
+                response = client.get('/program_list')
+            self.assertEqual(response.json()['result'], ['dbGaP'])
+            search.es.close.assert_awaited_once()
+            cache_class.from_config.return_value.close.assert_awaited_once()
+
+    def test_variables_search_single_request(self):
+        "Variable search returns totals from one capped search request"
+        search = async_search.Search(Config(search_max_page_size=50))
+        search.es = mock.AsyncMock()
+        search.es.search.return_value = {
+            'hits': {'total': {'value': 120, 'relation': 'eq'}, 'hits': []}}
+        result = asyncio.run(search.search_variables(query="brain", size=1000))
+        search.es.count.assert_not_called()
+        self.assertEqual(search.es.search.call_args.kwargs['size'], 50)
+        self.assertTrue(search.es.search.call_args.kwargs['track_total_hits'])
+        self.assertEqual(result, {'total_items': 120})
+
 
 brain_result_json = """{
   "hits": {
+    "total": {"value": 90, "relation": "eq"},
     "hits": [
       {
         "_type": "_doc",
@@ -1,6 +1,6 @@
 from unittest.mock import patch
 
-from pytest import mark
+from pytest import mark, raises
 
 from dug.cli import main, get_argparser
 
@@ -53,3 +53,12 @@ def test_dug_cli_main_search(mock_search):
     # mock_search.search.return_value = "Searching!"
     main(["search", "-q", "heart attack", "-t", "variables", "-k", "namespace=default"])
     mock_search.assert_called_once()
+
+@mark.cli
+@patch('dug.cli.Dug')
+@patch('dug.cli.DugFactory')
+def test_dug_cli_main_crawl_workers(mock_factory, mock_dug):
+    mock_dug.return_value.crawl.return_value = ["bad.xml"]
+    with raises(SystemExit):
+        main(["crawl", "somefile.csv", "--parser", "topmedtag", "--workers", "4"])
+    assert mock_factory.call_args.args[0].crawl_workers == 4
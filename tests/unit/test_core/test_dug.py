@@ -0,0 +1,134 @@
+import os
+import time
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from dug import core
+from dug.config import Config
+from dug.core.annotators import DugIdentifier
+from dug.core.crawl_manifest import CrawlManifest
+from dug.core.crawler import Crawler
+from dug.core.parsers import DugElement
+
+
+@patch("dug.core._worker_dug", None)
+@patch.dict("dug.core._worker_parsers", clear=True)
+@patch.dict("dug.core._worker_annotators", clear=True)
+@patch("dug.core.get_annotator")
+@patch("dug.core.Dug")
+def test_crawl_target_reports_failure(mock_dug, mock_get_annotator):
+    mock_dug.return_value._crawl.side_effect = [ValueError("bad xml"), None]
+    config = Config(annotation_cache_backend="", crawl_failures_path="")
+
+    target, error = core._crawl_target(config, Path("bad.xml"), "dbgap", "monarch", None)
+    assert target == Path("bad.xml")
+    assert error == "ValueError: bad xml"
+
+    # Worker keeps its Dug instance, parser and annotator for the next target
+    assert core._crawl_target(config, Path("good.xml"), "dbgap", "monarch", None) == (Path("good.xml"), None)
+    mock_dug.assert_called_once()
+    mock_get_annotator.assert_called_once()
+    (_, first_parser, first_annotator, _), (_, second_parser, second_annotator, _) = \
+        [call.args for call in mock_dug.return_value._crawl.call_args_list]
+    assert (first_parser, first_annotator) == (second_parser, second_annotator)
+
+
+def _crawl_or_die(config, target, parser_type, annotator_type, element_type, crawl_id=""):
+    if target.name == "crash.xml":
+        os._exit(1)
+    time.sleep(0.5)
+    return target, None
+
+
+def test_crawl_in_pool_survives_dead_worker(monkeypatch):
+    monkeypatch.setattr(core, "_crawl_target", _crawl_or_die)
+    factory = MagicMock()
+    factory.config = Config()
+    targets = [Path("crash.xml"), Path("a.xml"), Path("b.xml")]
+
+    failed = core.Dug(factory)._crawl_in_pool(targets, "dbgap", "monarch", None, workers=2)
+    # The dead worker breaks the pool, so the targets still pending fail with it
+    assert Path("crash.xml") in failed
+    assert set(failed) <= set(targets)
+
+
+def test_incremental_crawl(tmp_path, monkeypatch):
+    # The crawler writes its crawlspace into the working directory
+    monkeypatch.chdir(tmp_path)
+
+    def parser(input_file):
+        for line in Path(input_file).read_text().splitlines():
+            elem_id, desc = line.split(",")
+            yield DugElement(elem_id, elem_id, desc, "variable", collection_id="phs1")
+
+    annotated = []
+
+    def annotator(text, http_session):
+        annotated.append(text)
+        return [DugIdentifier(f"HP:{text}", text, ["phenotype"])]
+
+    factory = MagicMock()
+    factory.config = Config(crawl_incremental=True, crawl_manifest_path=str(tmp_path / "manifest.db"))
+    manifest = CrawlManifest(factory.config.crawl_manifest_path)
+    factory.build_crawl_manifest.return_value = manifest
+    factory.build_crawler.side_effect = lambda target, parser, annotator, element_type: Crawler(
+        crawl_file=str(target), parser=parser, annotator=annotator, tranqlizer=MagicMock(),
+        tranql_queries={}, http_session=None, element_type=element_type)
+    dug = core.Dug(factory)
+    index = dug._index
+    for bulk_method in (index.bulk_index_elements, index.bulk_replace_elements, index.bulk_delete,
+                        index.bulk_index_concepts, index.bulk_index_kg_answers):
+        # Ids that failed to index
+        bulk_method.return_value = []
+
+    def crawl():
+        index.reset_mock()
+        annotated.clear()
+        dug._crawl(target, parser, annotator, None)
+
+    def doc_ids(mock_method):
+        return sorted(elem.get_id() for call in mock_method.call_args_list for elem in call.args[0])
+
+    target = tmp_path / "study.csv"
+    target.write_text("v1,seizure\nv2,ataxia\nv3,fever\n")
+    crawl()
+    assert sorted(annotated) == ["ataxia", "fever", "seizure"]
+    assert doc_ids(index.bulk_index_elements) == ["v1-phs1", "v2-phs1", "v3-phs1"]
+
+    # Unchanged file is skipped entirely
+    crawl()
+    assert annotated == []
+    index.bulk_index_elements.assert_not_called()
+    index.update_summaries.assert_not_called()
+
+    # v2 changed, v3 removed, v4 added
+    target.write_text("v1,seizure\nv2,cough\nv4,rash\n")
+    crawl()
+    assert sorted(annotated) == ["cough", "rash"]
+    assert doc_ids(index.bulk_replace_elements) == ["v2-phs1"]
+    assert doc_ids(index.bulk_index_elements) == ["v4-phs1"]
+    index.bulk_delete.assert_called_once_with(["v3-phs1"], index=dug.variables_index)
+    assert index.update_summaries.call_args.args[0] == {"phs1"}
+
+    recorded = manifest.get_elements(manifest.source_key(target))
+    assert sorted(recorded) == ["v1-phs1", "v2-phs1", "v4-phs1"]
+    assert recorded["v2-phs1"].concept_ids == ["HP:cough"]
+    assert recorded["v1-phs1"].concept_ids == ["HP:seizure"]
+
+    # v4 fails to index, so the file is crawled again and only v4 retried
+    target.write_text("v1,seizure\nv2,cough\nv4,hives\n")
+    index.reset_mock()
+    index.bulk_replace_elements.return_value = ["v4-phs1"]
+    dug._crawl(target, parser, annotator, None)
+    assert manifest.get_elements(manifest.source_key(target))["v4-phs1"].fingerprint is None
+    index.bulk_replace_elements.return_value = []
+    crawl()
+    assert annotated == ["hives"]
+    assert doc_ids(index.bulk_replace_elements) == ["v4-phs1"]
+    crawl()
+    assert annotated == []
+
+    # Changing the expansion queries re-annotates every element
+    factory.config.tranql_queries = {"disease": ["disease", "phenotypic_feature"]}
+    crawl()
+    assert sorted(annotated) == ["cough", "hives", "seizure"]
@@ -1,12 +1,13 @@
 import os
 from dataclasses import dataclass, field
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 import pytest
 import pytest_asyncio
 
-from dug.core.index import Index, SearchException
+from dug.core.index import Index, SearchException, SUMMARIES_META_KEY
 from dug.config import Config
+from dug.core.parsers import DugElement, DugConcept
 
 default_indices = ["concepts_index", "variables_index", "kg_index"]
 
@@ -153,3 +154,93 @@ def test_update_doc(elastic: MockElastic):
     assert elastic.indices.get_index("concepts_index").get("ID:1") == {
         "name": "new value!"
     }
+
+
+def test_bulk_index(elastic: MockElastic):
+    search = Index(Config(elastic_bulk_chunk_size=2))
+    element = DugElement("ELEM:1", "name", "desc", "variable")
+    element.add_concept(DugConcept("MONDO:1", "concept", "disease", "desc"))
+    concept = DugConcept("MONDO:1", "concept", "disease", "desc")
+
+    sent = []
+
+    def streaming_bulk(client, actions, chunk_size, raise_on_error):
+        assert client is elastic
+        assert chunk_size == 2
+        for action in actions:
+            sent.append(action)
+            if action["_op_type"] == "create":
+                # Concept already indexed
+                yield False, {"create": {"_id": action["_id"], "status": 409}}
+            else:
+                yield True, {action["_op_type"]: {"_id": action["_id"], "status": 200}}
+
+    with patch("dug.core.index.helpers.streaming_bulk", side_effect=streaming_bulk):
+        assert search.bulk_index_elements([element], index="variables_index") == []
+        assert search.bulk_index_concepts([concept], index="concepts_index") == []
+
+    element_action, concept_action = sent
+    assert element_action["_id"] == element.get_id()
+    assert element_action["upsert"] == element.get_searchable_dict()
+    assert element_action["script"]["params"] == {"identifiers": ["MONDO:1"]}
+    assert concept_action["_source"] == concept.get_searchable_dict()
+
+
+def test_update_summaries(elastic: MockElastic):
+    search = Index(Config.from_env())
+    search.es = MagicMock()
+    search.es.search.side_effect = [
+        {"aggregations": {"studies": {"buckets": [{
+            "key": "phs001", "doc_count": 12,
+            "details": {"hits": {"hits": [{"_source": {"collection_id": "phs001",
+                                                       "collection_name": "Study",
+                                                       "collection_action": "link"}}]}},
+            "programs": {"buckets": [{"key": "dbGaP", "doc_count": 12}]}
+        }]}}},
+        {"aggregations": {"programs": {"buckets": [{
+            "key": "dbGaP", "doc_count": 40, "study_count": {"value": 3}
+        }]}}},
+    ]
+
+    # phs002 had all its variables deleted, and was the only study of its program
+    search.es.mget.return_value = {"docs": [
+        {"_id": "phs001", "found": True, "_source": {"data_type": ["dbGaP"]}},
+        {"_id": "phs002", "found": True, "_source": {"data_type": ["Retired"]}},
+    ]}
+
+    sent = []
+    with patch.object(Index, "bulk_index", side_effect=lambda actions: sent.append(list(actions))):
+        search.update_summaries(["phs001", "", "phs002", "phs001"], "variables_index", "studies_index",
+                                "programs_index")
+
+    assert search.es.search.call_args_list[0].kwargs["query"] == {"terms": {"collection_id.keyword": ["phs001", "phs002"]}}
+    assert search.es.search.call_args_list[1].kwargs["query"] == {"terms": {"data_type.keyword": ["Retired", "dbGaP"]}}
+    [study, removed_study], [program, removed_program] = sent
+    assert (removed_study["_op_type"], removed_study["_id"]) == ("delete", "phs002")
+    assert (removed_program["_op_type"], removed_program["_index"], removed_program["_id"]) == \
+           ("delete", "programs_index", "Retired")
+    assert study["_id"] == "phs001"
+    assert study["_source"] == {"collection_id": "phs001", "collection_name": "Study",
+                                "collection_action": "link", "data_type": ["dbGaP"],
+                                "variable_count": 12}
+    assert program["_source"] == {"program_name": "dbGaP", "variable_count": 40, "study_count": 3}
+
+
+def test_rebuild_summaries(elastic: MockElastic):
+    search = Index(Config.from_env())
+    search.es = MagicMock()
+    search.es.search.return_value = {"aggregations": {"studies": {"buckets": [
+        {"key": {"collection_id": "phs001"}, "doc_count": 3}]}}}
+    search.es.indices.get_mapping.side_effect = lambda index: {index: {"mappings": {"_meta": {"dug_generation": "g1"}}}}
+    summaries = {"studies_index": [{"_id": "phs009"}], "programs_index": [{"_id": "Retired"}]}
+
+    with patch("dug.core.index.helpers.scan", side_effect=lambda es, index, **kwargs: summaries[index]), \
+            patch.object(Index, "update_summaries") as update_summaries:
+        search.rebuild_summaries("variables_index", "studies_index", "programs_index")
+
+    # Every study in the variables index, plus the summaries of removed ones
+    assert update_summaries.call_args.args[0] == {"phs001", "phs009"}
+    assert update_summaries.call_args.kwargs["program_names"] == ["Retired"]
+    # Marked complete without losing the rest of _meta
+    assert search.es.indices.put_mapping.call_args.kwargs["meta"] == {"dug_generation": "g1",
+                                                                      SUMMARIES_META_KEY: True}
@@ -3,6 +3,7 @@ from unittest.mock import patch
 
 from dug.core import DugConcept
 from dug.core.parsers import DugElement
+from dug.core.annotators import DugIdentifier
 from tests.unit.mocks.MockCrawler import *
 
 
@@ -99,3 +100,131 @@ def test_expand_to_dug_element(crawler):
         tranql_source="test:graph"
     )
     assert len(new_elements) == len(TRANQL_ANSWERS)
+
+
+def test_annotate_elements_concurrent_matches_serial(crawler_init_args_no_graph_extraction):
+    def annotator(text, http_session):
+        return [DugIdentifier(f"MONDO:{word}", word, ["disease"], search_text=text)
+                for word in text.split()]
+
+    def make_elements():
+        return [
+            DugElement(f"test-{i}", "name", f"{i % 3} {i % 5} shared", "test-type")
+            for i in range(20)
+        ]
+
+    results = {}
+    for concurrency in (1, 4):
+        crawler = Crawler(**{**crawler_init_args_no_graph_extraction,
+                             "annotator": annotator,
+                             "annotation_concurrency": concurrency})
+        crawler.elements = make_elements()
+        crawler.annotate_elements()
+        results[concurrency] = (
+            [(c_id, [i.search_text for i in c.identifiers.values()])
+             for c_id, c in crawler.concepts.items()],
+            [(e.id, list(e.concepts), e.search_terms) for e in crawler.elements],
+        )
+
+    assert results[1] == results[4]
+
+
+def test_crawl_chunks(crawler_init_args_no_graph_extraction, tmp_path):
+    elements = [DugElement(f"test-{i}", "name", f"desc {i}", "test-type") for i in range(5)]
+    crawler = Crawler(**{**crawler_init_args_no_graph_extraction,
+                         "parser": lambda crawl_file: iter(elements)})
+    crawler.crawlspace = str(tmp_path)
+
+    chunks = []
+    for chunk_elements, new_concepts in crawler.crawl_chunks(chunk_size=2):
+        assert all(concept.kg_answers for concept in new_concepts if concept.id == "MONDO:0")
+        chunks.append(([e.id for e in chunk_elements], [c.id for c in new_concepts]))
+
+    assert chunks == [
+        (["test-0", "test-1"], ["MONDO:0", "PUBCHEM.COMPOUND:1"]),
+        (["test-2", "test-3"], []),
+        (["test-4"], []),
+    ]
+    # Answers are released once the chunk has been consumed, concepts are kept
+    assert set(crawler.concepts) == {"MONDO:0", "PUBCHEM.COMPOUND:1"}
+    assert all(not concept.kg_answers for concept in crawler.concepts.values())
+    assert all(element.type == "TestElement" for element in elements)
+    assert (tmp_path / "concept_file.json").exists()
+    assert len((tmp_path / "element_file.json").read_text().splitlines()) == 5
+
+
+def test_expand_concepts_concurrent_matches_serial(crawler_init_args_no_graph_extraction):
+    def make_concepts():
+        concepts = []
+        for i in range(10):
+            identifier = DugIdentifier(f"MONDO:{i}", str(i), ["disease"])
+            concept = DugConcept(concept_id=identifier.id, name=str(i), desc="", concept_type="disease")
+            concept.add_identifier(identifier)
+            concepts.append(concept)
+        return concepts
+
+    results = {}
+    for concurrency in (1, 4):
+        crawler = Crawler(**{**crawler_init_args_no_graph_extraction,
+                             "expansion_concurrency": concurrency})
+        concepts = make_concepts()
+        crawler.expand_concepts(concepts)
+        results[concurrency] = [list(concept.kg_answers) for concept in concepts]
+
+    assert results[1] == results[4]
+    assert all(len(answers) == len(TRANQL_ANSWERS) for answers in results[4])
+
+
+def test_expand_concepts_queries_shared_identifiers_once(crawler_init_args_no_graph_extraction):
+    # A tag concept shares its identifiers with the concepts it maps to
+    concepts = []
+    for concept_id, ident_ids in (("TOPMED.TAG:1", ["MONDO:1", "MONDO:2"]), ("MONDO:1", ["MONDO:1"]),
+                                  ("MONDO:2", ["MONDO:2"])):
+        concept = DugConcept(concept_id=concept_id, name=concept_id, desc="", concept_type="disease")
+        for ident_id in ident_ids:
+            concept.add_identifier(DugIdentifier(ident_id, ident_id, ["disease"]))
+        concepts.append(concept)
+
+    TranqlizerMock.expand_identifier.reset_mock()
+    crawler = Crawler(**{**crawler_init_args_no_graph_extraction, "expansion_concurrency": 4})
+    crawler.expand_concepts(concepts)
+
+    queried = sorted(call.args[0] for call in TranqlizerMock.expand_identifier.call_args_list)
+    assert queried == ["MONDO:1", "MONDO:2"]
+    assert all(len(concept.kg_answers) == len(TRANQL_ANSWERS) for concept in concepts)
+
+
+def test_annotate_elements_in_batches_matches_serial(crawler_init_args_no_graph_extraction):
+    def annotate(text):
+        return [DugIdentifier(f"MONDO:{word}", word, ["disease"], search_text=text) for word in text.split()]
+
+    class BatchAnnotator:
+        def __init__(self):
+            self.batches = []
+
+        def __call__(self, text, http_session):
+            return annotate(text)
+
+        def annotate_batch(self, texts, http_session):
+            self.batches.append(len(texts))
+            return [annotate(text) for text in texts]
+
+    def make_elements():
+        return [DugElement(f"test-{i}", "name", f"{i % 3} {i % 5} shared", "test-type") for i in range(10)]
+
+    results = {}
+    for batch_size, concurrency in ((1, 1), (4, 1), (4, 3)):
+        annotator = BatchAnnotator()
+        crawler = Crawler(**{**crawler_init_args_no_graph_extraction,
+                             "annotator": annotator,
+                             "annotation_batch_size": batch_size,
+                             "annotation_concurrency": concurrency})
+        crawler.elements = make_elements()
+        crawler.annotate_elements()
+        results[(batch_size, concurrency)] = (
+            [(c_id, [i.search_text for i in c.identifiers.values()]) for c_id, c in crawler.concepts.items()],
+            [(e.id, list(e.concepts)) for e in crawler.elements],
+        )
+        assert sorted(annotator.batches) == ([] if batch_size == 1 else [2, 4, 4])
+
+    assert results[(1, 1)] == results[(4, 1)] == results[(4, 3)]
@@ -0,0 +1,91 @@
+import itertools
+import random
+from dataclasses import dataclass
+from typing import Any, List
+
+from dug.core.facets import FacetIndex
+
+
+@dataclass
+class Filter:
+    key: str
+    value: List[Any]
+
+
+def naive_filter(variables, filters):
+    # Filter semantics of the original /search_var_grouped handler
+    filtered = variables.copy()
+    for f in filters:
+        key = f.key.lower()
+        values = [str(v).lower() for v in f.value]
+        to_keep = []
+        for var in filtered:
+            if key == "study name":
+                if any(s['c_name'].lower() in values for s in var.get('studies', [])):
+                    to_keep.append(var)
+            else:
+                keys_lower = {k.lower(): k for k in var.keys()}
+                if key in keys_lower and str(var.get(keys_lower[key], '')).lower() in values:
+                    to_keep.append(var)
+        filtered = to_keep
+        if not filtered:
+            break
+    return filtered
+
+
+def naive_counts(variables, filters, count_keys):
+    agg_counts = {}
+    for agg_key in sorted(count_keys | {"Study Name"}):
+        agg_vars = naive_filter(variables, [f for f in filters if f.key.lower() != agg_key.lower()])
+        counts = {}
+        for var in agg_vars:
+            if agg_key.lower() == "study name":
+                for s in var.get('studies', []):
+                    counts[s['c_name']] = counts.get(s['c_name'], 0) + 1
+            elif agg_key in var:
+                value = str(var[agg_key]).title()
+                counts[value] = counts.get(value, 0) + 1
+        if counts:
+            agg_counts[agg_key.title()] = counts
+    return agg_counts
+
+
+def make_variables(n, seed=0):
+    rng = random.Random(seed)
+    variables = []
+    for i in range(n):
+        var = {"id": f"phv{i}", "name": f"var {i}",
+               "studies": [{"c_id": f"phs{s}", "c_name": f"Study {s}"}
+                           for s in rng.sample(range(5), rng.randint(1, 3))]}
+        if rng.random() < 0.8:
+            var["data_type"] = rng.choice(["numeric", "Encoded", "string"])
+        if rng.random() < 0.5:
+            var["Domain"] = rng.choice(["sleep", "Heart", "lung"])
+        variables.append(var)
+    return variables
+
+
+def test_facet_index_matches_naive_filtering():
+    variables = make_variables(200)
+    count_keys = {"data_type", "Domain"}
+    filter_options = [
+        Filter("DATA_TYPE", ["numeric", "ENCODED"]),
+        Filter("study name", ["study 1", "Study 3"]),
+        Filter("domain", ["heart"]),
+        Filter("missing", ["x"]),
+    ]
+    for n in range(len(filter_options) + 1):
+        for filters in itertools.combinations(filter_options, n):
+            filters = list(filters)
+            index = FacetIndex(variables, filters)
+            assert index.filter() == naive_filter(variables, filters)
+            assert index.counts(count_keys) == naive_counts(variables, filters, count_keys)
+
+
+def test_facet_counts_ignore_own_filter():
+    variables = make_variables(50, seed=1)
+    index = FacetIndex(variables, [Filter("Study Name", ["Study 0"])])
+
+    study_counts = index.counts(set())["Study Name"]
+    assert set(study_counts) == {s["c_name"] for var in variables for s in var["studies"]}
+    assert all(any(s["c_name"] == "Study 0" for s in var["studies"]) for var in index.filter())
@@ -0,0 +1,113 @@
+import json
+import multiprocessing
+from unittest.mock import MagicMock
+
+from dug.core.annotators import AnnotateMonarch, CachedAnnotator, DugIdentifier
+from dug.core.annotators.annotation_cache import SQLiteAnnotationStore
+from dug.core.annotators.failure_sink import FailureSink, get_failure_sink
+from tests.unit.mocks.data.mock_config import MockConfig
+
+
+def test_failure_sink_buffers_and_reports(tmp_path):
+    sink = FailureSink(str(tmp_path / "failures.db"), flush_every=3, flush_interval=3600)
+    sink.record_annotation_failure("no terms here")
+    sink.record_normalization_failure("HP:0")
+    # Nothing is written until the buffer fills
+    assert FailureSink(sink.path).counts()["normalization"] == {}
+
+    sink.record_normalization_failure("HP:0")
+    assert FailureSink(sink.path).counts()["normalization"] == {"HP:0": 2}
+
+    sink.record_normalization_failure("HP:1")
+    report = sink.write_report(str(tmp_path / "reports" / "failures.json"))
+    assert json.loads((tmp_path / "reports" / "failures.json").read_text()) == report
+    assert report["annotation"] == {"total": 1, "distinct": 1,
+                                    "failures": [{"value": "no terms here", "count": 1}]}
+    assert report["normalization"] == {"total": 3, "distinct": 2,
+                                       "failures": [{"value": "HP:0", "count": 2}, {"value": "HP:1", "count": 1}]}
+
+    sink.discard()
+    assert sink.counts() == {"annotation": {}, "normalization": {}}
+
+
+def test_failure_sink_counts_per_crawl(tmp_path):
+    path = str(tmp_path / "failures.db")
+    first, second = FailureSink(path, crawl_id="first"), FailureSink(path, crawl_id="second")
+    first.record_normalization_failure("HP:0")
+    second.record_normalization_failure("HP:1")
+    first.flush()
+    second.flush()
+    assert first.counts()["normalization"] == {"HP:0": 1}
+    assert second.counts()["normalization"] == {"HP:1": 1}
+
+    # One crawl finishing doesn't clear another's counts
+    first.discard()
+    assert second.counts()["normalization"] == {"HP:1": 1}
+    second.start_crawl("third")
+    assert second.counts()["normalization"] == {}
+
+
+def _record_failures(path, curies):
+    sink = get_failure_sink(path)
+    for curie in curies:
+        sink.record_normalization_failure(curie)
+    sink.flush()
+
+
+def test_failure_sink_merges_worker_processes(tmp_path):
+    path = str(tmp_path / "failures.db")
+    # Opened in the parent before forking, as it is by a crawl
+    parent = get_failure_sink(path)
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=_record_failures, args=(path, ["HP:0", f"HP:{n}"] * 50))
+               for n in range(1, 5)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert [worker.exitcode for worker in workers] == [0] * 4
+
+    assert parent.counts()["normalization"] == {"HP:0": 200, "HP:1": 50, "HP:2": 50, "HP:3": 50, "HP:4": 50}
+
+
+def test_monarch_records_failures(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cfg = MockConfig.test_from_env()
+    normalizer = MagicMock()
+    normalizer.normalize_batch.side_effect = lambda identifiers, http_session: [None] * len(identifiers)
+    synonym_finder = MagicMock()
+    synonym_finder.find_synonyms_batch.return_value = {}
+    sink = FailureSink()
+    annotator = AnnotateMonarch(normalizer=normalizer, synonym_finder=synonym_finder, config=cfg,
+                                failure_sink=sink, **cfg.annotator_args["monarch"])
+    found = {"heart": [DugIdentifier("UBERON:0000948", "heart", ["anatomical entity"])]}
+    monkeypatch.setattr(annotator, "annotate_text", lambda text, http_session: list(found.get(text, [])))
+
+    for text in ("heart", "nothing", "heart", "nothing"):
+        assert annotator(text, None) == []
+
+    assert sink.counts() == {"annotation": {"nothing": 2}, "normalization": {"UBERON:0000948": 2}}
+    # Failures are no longer appended to files in the working directory
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_cached_annotator_records_failures(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cfg = MockConfig.test_from_env()
+    normalizer = MagicMock()
+    normalizer.normalize_batch.side_effect = lambda identifiers, http_session: [None] * len(identifiers)
+    synonym_finder = MagicMock()
+    synonym_finder.find_synonyms_batch.return_value = {}
+    sink = FailureSink()
+    annotator = AnnotateMonarch(normalizer=normalizer, synonym_finder=synonym_finder, config=cfg,
+                                failure_sink=sink, **cfg.annotator_args["monarch"])
+    found = {"heart": [DugIdentifier("UBERON:0000948", "heart", ["anatomical entity"])]}
+    monkeypatch.setattr(annotator, "annotate_text", lambda text, http_session: list(found.get(text, [])))
+    cached = CachedAnnotator(annotator, SQLiteAnnotationStore(str(tmp_path / "annotations.db")),
+                             failure_sink=sink)
+
+    for text in ("heart", "nothing", "heart", "nothing"):
+        assert cached(text, None) == []
+
+    # Texts that found identifiers which all failed to normalize count too, but only once per call
+    assert sink.counts()["annotation"] == {"heart": 2, "nothing": 2}
@@ -0,0 +1,54 @@
+import json
+from unittest.mock import MagicMock
+
+from dug.core.concept_expander import ConceptExpander
+from dug.core.kg_store import KGAnswerStore, migrate_crawlspace
+from dug.core.tranql import QueryFactory
+
+RESPONSE = {"message": {"knowledge_graph": {"nodes": {}, "edges": {}}, "results": []}}
+
+
+def test_store_round_trip(tmp_path):
+    store = KGAnswerStore(str(tmp_path / "kg.db"))
+    store.put("MONDO:1", "disease->phenotypic_feature", "redis:test", RESPONSE)
+
+    assert store.exists("MONDO:1", "disease->phenotypic_feature", "redis:test")
+    assert not store.exists("MONDO:1", "disease->phenotypic_feature", "other")
+    assert store.get("MONDO:1", "disease->phenotypic_feature", "redis:test") == RESPONSE
+    assert store.get("MONDO:2", "disease->phenotypic_feature", "redis:test") is None
+    assert len(store) == 1
+
+
+def test_migrate_crawlspace(tmp_path):
+    crawlspace = tmp_path / "crawl"
+    crawlspace.mkdir()
+    (crawlspace / "MONDO:1_disease.json").write_text(json.dumps(RESPONSE))
+    (crawlspace / "CHEBI:2_chem_to_disease.json").write_text(json.dumps(RESPONSE))
+    (crawlspace / "concept_file.json").write_text("{}")
+    queries = {"disease": ["disease", "phenotypic_feature"],
+               "chem_to_disease": ["chemical_entity", "disease"]}
+
+    store = KGAnswerStore(str(tmp_path / "kg.db"))
+    assert migrate_crawlspace(str(crawlspace), store, queries, "redis:test", remove=True) == 2
+
+    assert store.get("MONDO:1", "disease->phenotypic_feature", "redis:test") == RESPONSE
+    assert store.exists("CHEBI:2", "chemical_entity->disease", "redis:test")
+    assert sorted(p.name for p in crawlspace.iterdir()) == ["concept_file.json"]
+
+
+def test_expander_uses_store(tmp_path):
+    store = KGAnswerStore(str(tmp_path / "kg.db"))
+    expander = ConceptExpander("http://tranql", store=store)
+    expander.session = MagicMock()
+    response = {"message": {"knowledge_graph": {"nodes": {"MONDO:1": {"name": "x"}}, "edges": {}},
+                            "results": []}}
+    expander.session.post.return_value.json.return_value = response
+    query = QueryFactory(["disease", "phenotypic_feature"], "redis:test")
+    kg_filename = str(tmp_path / "MONDO:1_disease.json")
+
+    expander.expand_identifier("MONDO:1", query, kg_filename)
+    expander.expand_identifier("MONDO:1", query, kg_filename)
+
+    expander.session.post.assert_called_once()
+    assert store.get("MONDO:1", "disease->phenotypic_feature", "redis:test") == response
+    assert not (tmp_path / "MONDO:1_disease.json").exists()
@@ -0,0 +1,42 @@
+import json
+import os
+
+from dug.core.program_catalog import ProgramCatalog
+
+STUDIES = [
+    {"Program": "BACPAC", "Accession": "phs002.v1.p1.c1", "Study Name": "Back pain", "Description": "Back"},
+    {"Program": "bacpac", "Accession": "phs001", "Study Name": "Spine", "Description": "Other"},
+    {"Program": "HEAL", "Accession": "", "Study Name": "No accession", "Description": "Heal"},
+]
+
+
+def write_studies(path, studies, mtime):
+    path.write_text(json.dumps(studies))
+    os.utime(path, (mtime, mtime))
+
+
+def test_program_catalog(tmp_path):
+    studies_path = tmp_path / "studies.json"
+    write_studies(studies_path, STUDIES, 1000)
+    catalog = ProgramCatalog(str(studies_path), reload_interval=0)
+
+    assert [c["collection_id"] for c in catalog.get_collections("BacPac")] == ["phs001", "phs002.v1.p1.c1"]
+    assert catalog.get_collections("BACPAC")[1]["collection_action"].endswith("study_id=phs002.v1.p1")
+    assert catalog.get_collections("unknown") == []
+    assert len(catalog.get_collections()) == 2
+    assert [(p["key"], p["doc_count"], p["description"]) for p in catalog.get_program_summary()] == [
+        ("BACPAC", 1, "Back"), ("HEAL", 1, "Heal"), ("bacpac", 1, "Other")]
+
+    write_studies(studies_path, STUDIES[:1], 2000)
+    assert len(catalog.get_collections("bacpac")) == 1
+
+
+def test_program_catalog_reload_interval(tmp_path):
+    studies_path = tmp_path / "studies.json"
+    write_studies(studies_path, STUDIES, 1000)
+    catalog = ProgramCatalog(str(studies_path), reload_interval=3600)
+    assert len(catalog.get_collections()) == 2
+
+    # Not rechecked until the interval has passed
+    write_studies(studies_path, [], 2000)
+    assert len(catalog.get_collections()) == 2
@@ -0,0 +1,77 @@
+import asyncio
+from unittest.mock import AsyncMock
+
+from dug.core.search_cache import SearchCache
+
+
+class FakeRedis:
+    def __init__(self):
+        self.values = {}
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.values[key] = value
+
+
+def test_search_cache_hits_and_lru():
+    cache = SearchCache(ttl=60, maxsize=2)
+    fetch = AsyncMock(side_effect=lambda: {"hits": []})
+
+    async def run():
+        await cache.get_or_fetch("search", {"query": " heart  attack", "size": 20}, fetch)
+        await cache.get_or_fetch("search", {"size": 20, "query": "heart attack"}, fetch)
+        await cache.get_or_fetch("search", {"query": "lung"}, fetch)
+        await cache.get_or_fetch("search", {"query": "brain"}, fetch)
+        await cache.get_or_fetch("search_var", {"query": "heart attack", "size": 20}, fetch)
+
+    asyncio.run(run())
+    assert fetch.await_count == 4
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["evictions"] == 2
+    assert len(cache._entries) == 2
+
+
+def test_search_cache_keeps_query_case():
+    # search_kg runs a query_string query, where only uppercase operators are operators
+    assert SearchCache.make_key("search_kg", {"query": "heart AND attack"}) != \
+           SearchCache.make_key("search_kg", {"query": "heart and attack"})
+    assert SearchCache.make_key("search_kg", {"query": "heart NOT attack"}) != \
+           SearchCache.make_key("search_kg", {"query": "heart not attack"})
+    assert SearchCache.make_key("search_kg", {"query": "heart  AND attack "}) == \
+           SearchCache.make_key("search_kg", {"query": "heart AND attack"})
+
+
+def test_search_cache_ttl_and_generation():
+    generation = AsyncMock(return_value="gen-1")
+    cache = SearchCache(ttl=60, get_generation=generation, generation_interval=0)
+    fetch = AsyncMock(return_value={"hits": []})
+
+    async def run():
+        await cache.get_or_fetch("search", {"query": "brain"}, fetch)
+        await cache.get_or_fetch("search", {"query": "brain"}, fetch)
+        generation.return_value = "gen-2"
+        await cache.get_or_fetch("search", {"query": "brain"}, fetch)
+
+    asyncio.run(run())
+    assert fetch.await_count == 2
+    assert cache.stats()["invalidations"] == 1
+
+    disabled = SearchCache(ttl=0)
+    asyncio.run(disabled.get_or_fetch("search", {"query": "brain"}, fetch))
+    assert fetch.await_count == 3
+
+
+def test_search_cache_redis_backend():
+    redis = FakeRedis()
+    replicas = [SearchCache(redis_client=redis, get_generation=AsyncMock(return_value="gen-1"))
+                for _ in range(2)]
+    fetch = AsyncMock(return_value={"hits": [1, 2]})
+
+    first = asyncio.run(replicas[0].get_or_fetch("search", {"query": "brain"}, fetch))
+    second = asyncio.run(replicas[1].get_or_fetch("search", {"query": "brain"}, fetch))
+
+    assert first == second == {"hits": [1, 2]}
+    fetch.assert_awaited_once()
+    assert all(key.startswith("dug:search:gen-1:search:") for key in redis.values)